@@ -0,0 +1,7 @@
+import eventlet
+eventlet.monkey_patch()  # noqa (code before imports)
+
+from benchmarks.run import main  # noqa: E402
+
+
+main()
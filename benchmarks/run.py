@@ -0,0 +1,177 @@
+"""
+End-to-end throughput benchmark of Bayeux event delivery
+
+Runs a Nameko service with a ``subscribe`` entrypoint against an in-process
+fake CometD server and measures how many events per second get from
+the server to workers, the delivery latency and the memory used.
+
+Run with ``python -m benchmarks --help``.
+
+"""
+import argparse
+import json
+import resource
+import sys
+import time
+
+import eventlet
+from nameko.containers import ServiceContainer
+
+from nameko_bayeux_client import subscribe
+
+from benchmarks.server import FakeCometdServer, serve
+
+
+class Recorder:
+    """ Recorder of delivery latencies of events handled by workers """
+
+    def __init__(self):
+        self.latencies = []
+
+    def record(self, data):
+        self.latencies.append(time.time() - data['sent'])
+
+
+def make_service(recorder, channel_count):
+
+    class BenchmarkService:
+
+        name = 'benchmark'
+
+        def handle_event(self, channel, data):
+            recorder.record(data)
+
+    for index in range(channel_count):
+        subscribe('/benchmark/{}'.format(index))(
+            BenchmarkService.handle_event)
+
+    return BenchmarkService
+
+
+def percentile(values, percent):
+    """ Return the percentile of the sorted values """
+    if not values:
+        return None
+    index = int(round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+
+def run_benchmark(
+    rate=1000, batch_size=100, payload_size=1024, duration=10, warmup=1,
+    channel_count=1, max_workers=10, bayeux_config=None
+):
+    """
+    Run the benchmark and return a dictionary of results
+
+    Events handled during ``warmup`` seconds after start are not counted.
+
+    """
+    server = FakeCometdServer(
+        rate=rate, batch_size=batch_size, payload_size=payload_size)
+    server_thread, server_uri = serve(server)
+
+    config = {
+        'max_workers': max_workers,
+        'BAYEUX': dict(bayeux_config or {}, SERVER_URI=server_uri),
+    }
+    recorder = Recorder()
+    container = ServiceContainer(
+        make_service(recorder, channel_count), config)
+
+    container.start()
+    try:
+        eventlet.sleep(warmup)
+        del recorder.latencies[:]
+        started = time.monotonic()
+        eventlet.sleep(duration)
+        latencies = sorted(recorder.latencies)
+        elapsed = time.monotonic() - started
+    finally:
+        container.stop()
+        server_thread.kill()
+
+    return {
+        'events': len(latencies),
+        'duration': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'max_rss': get_max_rss(),
+        'requests': server.requests,
+    }
+
+
+def get_max_rss():
+    """ Return peak resident set size of the process in bytes """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss  # reported in bytes on macOS
+    return max_rss * 1024
+
+
+def format_results(results):
+    def milliseconds(seconds):
+        if seconds is None:
+            return 'n/a'
+        return '{:.2f} ms'.format(seconds * 1000)
+
+    return '\n'.join([
+        'events:       {}'.format(results['events']),
+        'duration:     {:.2f} s'.format(results['duration']),
+        'throughput:   {:.1f} events/s'.format(results['throughput']),
+        'latency p50:  {}'.format(milliseconds(results['latency_p50'])),
+        'latency p99:  {}'.format(milliseconds(results['latency_p99'])),
+        'max RSS:      {:.1f} MiB'.format(results['max_rss'] / 2 ** 20),
+        'requests:     {}'.format(results['requests']),
+    ])
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks', description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--rate', type=int, default=1000,
+        help='events per second sent by the server, 0 for unlimited')
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help='events delivered in one connect response')
+    parser.add_argument(
+        '--payload-size', type=int, default=1024,
+        help='bytes of payload of each event')
+    parser.add_argument(
+        '--duration', type=float, default=10,
+        help='seconds to measure for')
+    parser.add_argument(
+        '--warmup', type=float, default=1,
+        help='seconds to run before measuring')
+    parser.add_argument(
+        '--channels', type=int, default=1, dest='channel_count',
+        help='number of subscribed channels')
+    parser.add_argument(
+        '--max-workers', type=int, default=10,
+        help='maximum number of concurrent Nameko workers')
+    parser.add_argument(
+        '--config', action='append', default=[], metavar='KEY=VALUE',
+        help='extra BAYEUX config option with a JSON value, e.g. '
+             'JSON_CODEC=\\"orjson\\" or STREAM_RESPONSES=true')
+    return parser.parse_args(args)
+
+
+def parse_config(options):
+    config = {}
+    for option in options:
+        key, _, value = option.partition('=')
+        config[key] = json.loads(value)
+    return config
+
+
+def main(args=None):
+    args = parse_args(args)
+    results = run_benchmark(
+        rate=args.rate, batch_size=args.batch_size,
+        payload_size=args.payload_size, duration=args.duration,
+        warmup=args.warmup, channel_count=args.channel_count,
+        max_workers=args.max_workers,
+        bayeux_config=parse_config(args.config))
+    print(format_results(results))
@@ -0,0 +1,128 @@
+import itertools
+import json
+import time
+
+import eventlet
+from eventlet import wsgi
+
+
+class FakeCometdServer:
+    """
+    In-process WSGI stand-in of a CometD server
+
+    Supports handshake, subscribe, unsubscribe, connect and disconnect
+    meta channels. Events are delivered to subscribed channels in batches of
+    ``batch_size`` events at ``rate`` events per second in total, each
+    carrying a payload of ``payload_size`` bytes and the time it was sent.
+
+    """
+
+    def __init__(self, rate=1000, batch_size=100, payload_size=1024):
+        self.rate = rate
+        self.batch_size = batch_size
+        self.payload = 'x' * payload_size
+        self.subscriptions = {}
+        self.client_ids = ('client-{}'.format(n) for n in itertools.count())
+        self.replay_ids = itertools.count(1)
+        self.events_sent = 0
+        self.requests = 0
+        self._advised = set()
+        self._next_batch_at = None
+
+    def __call__(self, environ, start_response):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        messages_in = json.loads(environ['wsgi.input'].read(length))
+        self.requests += 1
+        messages_out = []
+        for message in messages_in:
+            handler = getattr(
+                self, 'handle_' + message['channel'].rsplit('/', 1)[-1])
+            messages_out.extend(handler(message))
+        body = json.dumps(messages_out).encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+    def handle_handshake(self, message):
+        client_id = next(self.client_ids)
+        self.subscriptions[client_id] = []
+        return [self._respond(
+            message, clientId=client_id, version='1.0',
+            supportedConnectionTypes=['long-polling'])]
+
+    def handle_subscribe(self, message):
+        self.subscriptions[message['clientId']].append(
+            message['subscription'])
+        return [self._respond(message, subscription=message['subscription'])]
+
+    def handle_unsubscribe(self, message):
+        self.subscriptions[message['clientId']].remove(
+            message['subscription'])
+        return [self._respond(message, subscription=message['subscription'])]
+
+    def handle_connect(self, message):
+        client_id = message['clientId']
+        response = self._respond(message)
+        if client_id not in self._advised:
+            self._advised.add(client_id)
+            response['advice'] = {'reconnect': 'retry', 'interval': 0}
+        return [response] + self._make_batch(client_id)
+
+    def handle_disconnect(self, message):
+        self.subscriptions.pop(message['clientId'], None)
+        return [self._respond(message)]
+
+    def _respond(self, message, **fields):
+        response = {
+            'id': message.get('id'),
+            'channel': message['channel'],
+            'clientId': message.get('clientId'),
+            'successful': True,
+        }
+        response.update(fields)
+        return response
+
+    def _make_batch(self, client_id):
+        channels = self.subscriptions.get(client_id)
+        if not channels:
+            eventlet.sleep(0.1)  # hold the poll as there is nothing to send
+            return []
+        self._wait_for_next_batch()
+        sent = time.time()
+        return [
+            {
+                'channel': channel,
+                'data': {
+                    'event': {'replayId': next(self.replay_ids)},
+                    'sent': sent,
+                    'payload': self.payload,
+                },
+            }
+            for channel in itertools.islice(
+                itertools.cycle(channels), self.batch_size)
+        ]
+
+    def _wait_for_next_batch(self):
+        now = time.monotonic()
+        if self._next_batch_at is None:
+            self._next_batch_at = now
+        delay = self._next_batch_at - now
+        if delay > 0:
+            eventlet.sleep(delay)
+        if self.rate:
+            self._next_batch_at += self.batch_size / self.rate
+        self.events_sent += self.batch_size
+
+
+def serve(app, host='localhost', port=0):
+    """ Serve the WSGI app in a green thread
+
+    Returns the green thread and the URI of the server.
+
+    """
+    sock = eventlet.listen((host, port))
+    uri = 'http://{}:{}/cometd'.format(host, sock.getsockname()[1])
+    thread = eventlet.spawn(wsgi.server, sock, app, log_output=False)
+    return thread, uri
@@ -1 +1,4 @@
-from nameko_bayeux_client.client import subscribe  # noqa: F401
+from nameko_bayeux_client.client import (  # noqa: F401
+    subscribe,
+    subscribe_batch,
+)
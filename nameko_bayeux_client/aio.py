@@ -0,0 +1,271 @@
+import asyncio
+import functools
+import inspect
+import logging
+import time
+
+import aiohttp
+
+from nameko_bayeux_client import channels
+from nameko_bayeux_client.constants import Reconnection
+from nameko_bayeux_client.exceptions import Reconnect
+from nameko_bayeux_client.protocol import BayeuxProtocol
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBayeuxClient(BayeuxProtocol):
+    """
+    Bayeux protocol client running on an asyncio event loop
+
+    Exchanges messages with the server over long-polling HTTP transport
+    using aiohttp, so that event delivery can share the event loop with
+    other asyncio consumers. Takes the same options as the ``BAYEUX``
+    config of the Nameko extension, those of the eventlet engine only
+    are ignored.
+
+    Event handlers are either plain functions called as the events are
+    handled or coroutine functions run as tasks of the client.
+
+    """
+
+    def __init__(self, config=None):
+
+        super().__init__()
+
+        self.configure(config or {})
+
+        self.session = None
+        """ aiohttp session for sending HTTP requests to Bayeux server """
+
+        self._runner = None
+        self._refresher = None
+        self._tasks = set()
+        self._task_events = {}
+
+    def register_event_handler(self, channel_name, callback, subscribe=True):
+        if asyncio.iscoroutinefunction(callback):
+            callback = functools.partial(self._spawn, channel_name, callback)
+        super().register_event_handler(channel_name, callback, subscribe)
+
+    def _spawn(self, channel_name, callback, data, *args):
+        task = asyncio.ensure_future(callback(data, *args))
+        self._tasks.add(task)
+        # wildcard callbacks are given the channel the event was delivered to
+        self._task_events[task] = (args[0] if args else channel_name, data)
+        task.add_done_callback(
+            functools.partial(self._task_done, self.begin_ack(None)))
+
+    def _track(self, task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _task_done(self, ack, task):
+        self._tasks.discard(task)
+        self._task_events.pop(task, None)
+        if ack is not None:
+            ack()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                'Event handler failed', exc_info=task.exception())
+
+    async def start(self):
+        """ Open the session and start the connection loop """
+        self.session = aiohttp.ClientSession()
+        self._register_meta_channels()
+        self.resolve_extensions()
+        self._runner = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """ Stop the connection loop, disconnect and wait for handlers
+
+        The pending connect request is cancelled before the disconnect
+        request is sent. Handlers still running after ``shutdown_deadline``
+        seconds are cancelled and their events reported as undelivered.
+
+        """
+        self._runner.cancel()
+        await asyncio.wait([self._runner])
+        if self._refresher is not None:
+            self._refresher.cancel()
+        try:
+            await self.disconnect()
+        except Exception:
+            logger.exception(
+                'Failed to disconnect client ID %s', self.client_id)
+        finally:
+            if self._tasks:
+                await self._wait_for_tasks()
+            await self.session.close()
+
+    async def _wait_for_tasks(self):
+        _, pending = await asyncio.wait(
+            list(self._tasks), timeout=self.shutdown_deadline)
+        undelivered = [
+            self._task_events[task] for task in pending
+            if task in self._task_events]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        if undelivered:
+            self.report_undelivered(undelivered)
+
+    async def run(self):
+        while True:
+            try:
+                if self.reconnection != Reconnection.retry:
+                    await self.handshake()
+                    await self.subscribe()
+                await self.connect()
+            except Reconnect:
+                self.connection_failed()
+            else:
+                self.connection_succeeded()
+            await asyncio.sleep(self.get_reconnect_delay())
+
+    async def handshake(self):
+        """ Send a handshake request and process the handshake response
+        """
+        self.reconnection = Reconnection.handshake  # reset reconnection
+        if not self.credentials.valid:
+            # authenticate before starting the handshake
+            await self.authorise()
+        await self.send_and_handle(channels.Handshake(self).compose())
+
+    async def authorise(self):
+        """ Log in and cache authorisation headers
+
+        Headers expiring are refreshed by a background task before they
+        expire so that reconnections do not wait for a login.
+
+        """
+        await self._login()
+        self._set_credentials()
+        if self.credentials.expires_at is not None and self._refresher is None:
+            self._refresher = asyncio.ensure_future(
+                self._refresh_credentials())
+
+    async def _login(self):
+        logged_in = self.login()  # pylint: disable=assignment-from-no-return
+        if inspect.isawaitable(logged_in):
+            await logged_in
+
+    async def _refresh_credentials(self):
+        delay = self._get_refresh_delay()
+        while delay is not None:
+            await asyncio.sleep(delay)
+            try:
+                await self._login()
+                self._set_credentials()
+            except Exception:
+                logger.exception('Failed to refresh authorisation')
+                await asyncio.sleep(self.auth.get('RETRY_DELAY', 5))
+            delay = self._get_refresh_delay()
+        self._refresher = None
+
+    async def connect(self):
+        """ Send a connect message and process response messages
+
+        Subscriptions changed at runtime and queued messages are sent in
+        the same request.
+
+        """
+        messages = self.drain_outbound()
+        connect = channels.Connect(self).compose()
+        try:
+            await self.send_and_handle(
+                messages + [connect] if messages else connect)
+        except Reconnect:
+            self.fail_replies(messages, 'Request to Bayeux server failed')
+            raise
+
+    def queue_message(self, message, callback=None, urgent=False):
+        super().queue_message(message, callback)
+        if urgent:
+            self._track(asyncio.ensure_future(self.flush_outbound()))
+
+    async def flush_outbound(self):
+        """
+        Send queued messages in a separate request straight away
+
+        Messages stay queued until the client hand shook.
+
+        """
+        if self.client_id is None:
+            return
+        messages = self.drain_outbound()
+        if not messages:
+            return
+        try:
+            await self.send_and_handle(messages)
+        except Reconnect:
+            logger.warning(
+                'Failed to send %s queued messages', len(messages),
+                exc_info=True)
+            self.fail_replies(messages, 'Request to Bayeux server failed')
+
+    async def disconnect(self):
+        """ Send a disconnect request and process response messages
+        """
+        await self.send_and_handle(channels.Disconnect(self).compose())
+
+    async def subscribe(self):
+        """ Send all subscription messages and process response messages
+        """
+        await self.send_and_handle(self.compose_subscriptions())
+
+    async def send_and_handle(self, messages):
+        """ Send request messages and handle received response messages
+        """
+        messages = self._prepare_outgoing(messages)
+        self.handle(await self.send_and_receive(messages))
+
+    async def send_and_receive(self, messages):
+        """ Send request messages and receive response messages
+        """
+        try:
+            content = await asyncio.wait_for(
+                self._post(messages), self.timeout)
+        except aiohttp.ClientError as exc:
+            if isinstance(exc, aiohttp.ClientResponseError):
+                self._credentials_rejected(exc.status)
+            raise Reconnect(
+                'Failed to post request messages to Bayeux server'
+            ) from exc
+        except asyncio.TimeoutError as exc:
+            raise Reconnect('Request to Bayeux server timed out') from exc
+        return self.decode(content)
+
+    async def _post(self, messages_out):
+
+        messages_out = self._as_list(messages_out)
+
+        logger.debug('Sending Bayeux messages %s', messages_out)
+
+        body, headers = self._encode_request(messages_out)
+        started = time.perf_counter()
+        async with self.session.post(
+            self.server_uri,
+            headers=headers,
+            data=body,
+        ) as response:
+            response.raise_for_status()
+            content = await self._read_content(response)
+        self.metrics.observe(
+            'request_duration_seconds', time.perf_counter() - started,
+            channel=self._get_channel_label(messages_out))
+
+        return content
+
+    async def _read_content(self, response):
+        if self.compression.max_response_size is None:
+            return await response.read()
+        chunks = []
+        size = 0
+        async for chunk in response.content.iter_any():
+            size += len(chunk)
+            self.compression.check_size(size)
+            chunks.append(chunk)
+        return b''.join(chunks)
@@ -0,0 +1,46 @@
+import time
+
+
+class Credentials:
+    """
+    Cache of HTTP headers authorising requests to the Bayeux server
+
+    Headers are built once per login and reused by all requests until they
+    expire or are invalidated, e.g. after the server rejected them.
+
+    """
+
+    def __init__(self):
+
+        self.headers = None
+        """ Authorisation headers or None if there are none cached """
+
+        self.expires_at = None
+        """ Monotonic time the headers expire at or None if they do not """
+
+    def set(self, headers, ttl=None):
+        """ Cache headers valid for ``ttl`` seconds or until invalidated
+        """
+        self.headers = headers
+        self.expires_at = None if ttl is None else time.monotonic() + ttl
+
+    def invalidate(self):
+        self.headers = None
+        self.expires_at = None
+
+    @property
+    def valid(self):
+        return self.headers is not None and (
+            self.expires_at is None or time.monotonic() < self.expires_at)
+
+    def get_refresh_delay(self, margin):
+        """
+        Return number of seconds to wait before refreshing the headers
+
+        Headers are due for refresh ``margin`` seconds before they expire.
+        Returns None if the headers do not expire.
+
+        """
+        if self.expires_at is None:
+            return None
+        return max(0, self.expires_at - margin - time.monotonic())
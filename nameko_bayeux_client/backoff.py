@@ -0,0 +1,64 @@
+import random
+import time
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter
+
+    The delay before the next reconnection attempt is picked randomly
+    between zero and an exponentially growing ceiling, limited by the cap.
+    The randomness spreads reconnection attempts of many clients failing
+    at the same moment.
+
+    Delays are in milliseconds.
+
+    """
+
+    def __init__(self, base=100, cap=30000):
+
+        self.base = base
+        """ Ceiling of the delay after the first failure """
+
+        self.cap = cap
+        """ Maximum ceiling of the delay """
+
+        self.failures = 0
+        """ Number of consecutive failures """
+
+        self.failing_since = None
+        """ Monotonic time of the first of consecutive failures """
+
+        self.last_failures = 0
+        """ Number of consecutive failures before the last recovery """
+
+        self.last_outage = None
+        """ Seconds it took to recover from the last consecutive failures """
+
+    def failed(self):
+        """ Record a failure """
+        if not self.failures:
+            self.failing_since = time.monotonic()
+        self.failures += 1
+
+    def succeeded(self):
+        """ Record a success, resetting the consecutive failures """
+        if self.failures:
+            self.last_failures = self.failures
+            self.last_outage = time.monotonic() - self.failing_since
+            self.failures = 0
+            self.failing_since = None
+
+    def get_delay(self, floor=0):
+        """
+        Return milliseconds to wait before the next attempt
+
+        The floor is respected as the minimum delay, e.g. the interval
+        advised by the server.
+
+        """
+        if not self.failures:
+            return floor
+        exponent = min(self.failures - 1, 32)
+        ceiling = min(self.cap, self.base * 2 ** exponent)
+        return max(floor, random.uniform(0, ceiling))
@@ -1,7 +1,7 @@
 import logging
 
 from nameko_bayeux_client.exceptions import BayeuxError, Reconnect
-from nameko_bayeux_client.constants import Reconnection
+from nameko_bayeux_client.constants import ConnectionType, Reconnection
 
 
 logger = logging.getLogger(__name__)
@@ -11,8 +11,6 @@ class Channel:
     """
     Bayeux channel base class
 
-    Only long-polling connection type is supported by this implementation.
-
     """
 
     name = NotImplemented
@@ -58,7 +56,10 @@ class Handshake(Channel):
             channel=self.name,
             version=self.client.version,
             minimumVersion=self.client.minimum_version,
-            supportedConnectionTypes=['long-polling'],
+            supportedConnectionTypes=[
+                connection_type.value
+                for connection_type in self.client.connection_types
+            ],
         )
 
     def handle(self, message):
@@ -69,6 +70,9 @@ class Handshake(Channel):
         back with the first handshake response. Ignores advices on handshake
         level.
 
+        Picks the first of client's connection types supported by the server
+        falling back to long-polling if the server supports none of them.
+
         """
         if not message['successful']:
             raise BayeuxError(
@@ -77,6 +81,17 @@ class Handshake(Channel):
         else:
             logger.info('Hand shook client ID %s', message['clientId'])
             self.client.client_id = message['clientId']
+            self._set_connection_type(message)
+
+    def _set_connection_type(self, message):
+        supported = message.get('supportedConnectionTypes', [])
+        for connection_type in self.client.connection_types:
+            if connection_type.value in supported:
+                break
+        else:
+            connection_type = ConnectionType.long_polling
+        logger.info('Negotiated connection type %s', connection_type.value)
+        self.client.connection_type = connection_type
 
 
 class Connect(Channel):
@@ -94,7 +109,8 @@ class Connect(Channel):
 
     def compose(self):
         """ Compose a connection request message """
-        return super().compose(connectionType='long-polling')
+        return super().compose(
+            connectionType=self.client.connection_type.value)
 
     def handle(self, message):
         """ Handle connection response message """
@@ -167,8 +183,15 @@ class Subscribe(Channel):
         return super().compose(subscription=channel_name)
 
     def handle(self, message):
-        """ Handle subscribe response message """
-        if not message['successful']:
+        """
+        Handle subscribe response message
+
+        Failures of subscriptions made at runtime are recorded by the
+        client, failures of subscriptions made at startup are raised.
+
+        """
+        runtime = self.client.handle_subscription_response(message, True)
+        if not message['successful'] and not runtime:
             raise BayeuxError(
                 'Unsuccessful subscribe response: {}'
                 .format(message.get('error')))
@@ -196,7 +219,8 @@ class Unsubscribe(Channel):
 
     def handle(self, message):
         """ Handle unsubscribe response message """
-        if not message['successful']:
+        runtime = self.client.handle_subscription_response(message, False)
+        if not message['successful'] and not runtime:
             raise BayeuxError(
                 'Unsuccessful unsubscribe response: {}'
                 .format(message.get('error')))
@@ -236,3 +260,19 @@ class Event(Channel):
         """ Handle delivered event message """
         for callback in self.callbacks:
             callback(message['data'])
+
+
+class WildcardEvent(Event):
+    """
+    Wildcard event channel
+
+    Handles events of all channels matching the channel name pattern.
+    Callbacks are given the name of the channel the event was delivered
+    to along with the event data.
+
+    """
+
+    def handle(self, message):
+        """ Handle delivered event message """
+        for callback in self.callbacks:
+            callback(message['data'], message['channel'])
@@ -0,0 +1,195 @@
+import collections
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore:
+    """
+    Checkpoint store base class
+
+    Persists the last processed replay ID of each channel.
+
+    """
+
+    def load(self):
+        """ Return a dictionary of replay IDs by channel names """
+        raise NotImplementedError
+
+    def save(self, checkpoints):
+        """ Persist replay IDs given in a dictionary by channel names
+
+        Replay IDs of channels not given are kept as they are.
+
+        """
+        raise NotImplementedError
+
+
+class FileCheckpointStore(CheckpointStore):
+    """
+    Checkpoint store keeping replay IDs in a local JSON file
+
+    The file is replaced atomically on each save.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def save(self, checkpoints):
+        stored = self.load()
+        stored.update(checkpoints)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(descriptor, 'w') as file:
+                json.dump(stored, file)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+class SqliteCheckpointStore(CheckpointStore):
+    """
+    Checkpoint store keeping replay IDs in a SQLite database
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoints '
+                '(channel TEXT PRIMARY KEY, replay_id INTEGER NOT NULL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path)
+
+    def load(self):
+        connection = self._connect()
+        try:
+            return dict(connection.execute(
+                'SELECT channel, replay_id FROM checkpoints'))
+        finally:
+            connection.close()
+
+    def save(self, checkpoints):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO checkpoints (channel, replay_id) '
+                    'VALUES (?, ?)',
+                    checkpoints.items())
+        finally:
+            connection.close()
+
+
+STORES = {
+    'file': FileCheckpointStore,
+    'sqlite': SqliteCheckpointStore,
+}
+
+
+class Checkpointer:
+    """
+    Tracker of the last processed replay ID per channel
+
+    Events are tracked from their dispatch to the completion of their
+    workers. As workers run concurrently and finish in any order, the
+    checkpoint of a channel only advances to the highest replay ID with
+    no unfinished event dispatched before it. An event of a failed worker
+    never finishes so it is replayed after restart together with all
+    the events following it.
+
+    Checkpoints are kept in memory and saved to the store in batches. After
+    ``flush_size`` updates the ``on_flush_due`` callback is called to ask
+    for a flush, saving is up to the caller.
+
+    """
+
+    def __init__(self, store, default=-1, flush_size=100, on_flush_due=None):
+        self.store = store
+        self.default = default
+        self.flush_size = flush_size
+        self.on_flush_due = on_flush_due
+        self.checkpoints = store.load()
+        self.dirty = set()
+        self.updates = 0
+        self.in_flight = collections.defaultdict(collections.OrderedDict)
+
+    def get(self, channel_name):
+        """ Return replay ID to resume the channel from """
+        return self.checkpoints.get(channel_name, self.default)
+
+    def begin(self, channel_name, replay_id):
+        """ Record a replay ID of the channel dispatched to a worker
+
+        An event dispatched to multiple workers is finished once
+        all of them complete.
+
+        """
+        in_flight = self.in_flight[channel_name]
+        in_flight[replay_id] = in_flight.get(replay_id, 0) + 1
+
+    def complete(self, channel_name, replay_id):
+        """ Record a replay ID of the channel completed by a worker
+
+        Advances the checkpoint over all finished events up to the first
+        one still in flight.
+
+        """
+        in_flight = self.in_flight[channel_name]
+        if replay_id not in in_flight:
+            return
+        in_flight[replay_id] -= 1
+        while in_flight:
+            first_replay_id, unfinished = next(iter(in_flight.items()))
+            if unfinished:
+                break
+            del in_flight[first_replay_id]
+            self.update(channel_name, first_replay_id)
+
+    def update(self, channel_name, replay_id):
+        """ Record a processed replay ID of the channel
+
+        Replay IDs are increasing, the checkpoint never moves back.
+
+        """
+        if replay_id > self.checkpoints.get(channel_name, replay_id - 1):
+            self.checkpoints[channel_name] = replay_id
+            self.dirty.add(channel_name)
+            self.updates += 1
+            if (
+                self.updates >= self.flush_size and
+                self.on_flush_due is not None
+            ):
+                self.on_flush_due()
+
+    def flush(self):
+        """ Save updated checkpoints to the store """
+        if self.dirty:
+            dirty, self.dirty = self.dirty, set()
+            self.updates = 0
+            checkpoints = {
+                channel_name: self.checkpoints[channel_name]
+                for channel_name in dirty
+            }
+            try:
+                self.store.save(checkpoints)
+            except Exception:
+                self.dirty |= dirty
+                raise
+            logger.debug('Saved checkpoints %s', checkpoints)
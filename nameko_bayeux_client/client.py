@@ -1,21 +1,34 @@
-import collections
-import json
+import functools
+from contextlib import closing, contextmanager
 import logging
+import re
+import time
+import zlib
 
 import eventlet
+from eventlet.event import Event
+from eventlet.queue import Queue
 import requests
 
-from nameko.extensions import Entrypoint, ProviderCollector, SharedExtension
+from nameko.extensions import (
+    DependencyProvider, Entrypoint, ProviderCollector, SharedExtension)
 
 from nameko_bayeux_client import channels
-from nameko_bayeux_client.exceptions import Reconnect
-from nameko_bayeux_client.constants import Reconnection
+from nameko_bayeux_client.checkpoints import Checkpointer, STORES
+from nameko_bayeux_client.streaming import iter_array_items
+from nameko_bayeux_client.exceptions import PublishError, Reconnect
+from nameko_bayeux_client.ordering import KeyedScheduler
+from nameko_bayeux_client.extensions import AckExtension, ReplayExtension
+from nameko_bayeux_client.protocol import BayeuxProtocol
+from nameko_bayeux_client.sessions import configure_session
+from nameko_bayeux_client.constants import ConnectionType, Reconnection
+from nameko_bayeux_client.transports import WebSocketTransport
 
 
 logger = logging.getLogger(__name__)
 
 
-class BayeuxClient(SharedExtension, ProviderCollector):
+class BayeuxClient(SharedExtension, ProviderCollector, BayeuxProtocol):
     """
     Bayeux protocol communication client for inbound event delivery
 
@@ -25,158 +38,742 @@ class BayeuxClient(SharedExtension, ProviderCollector):
 
         super().__init__()
 
-        self.version = None
-        """ Bayeux protocol version """
+        self.session = requests.Session()
+        """ Requests session for sending HTTP requests to Bayeux server """
 
-        self.minimum_version = None
+        self.control_session = requests.Session()
         """
-        Minimum Bayeux protocol version
+        Requests session for sending control requests to Bayeux server
 
-        Indicates the oldest protocol version that can be handled
-        by the client/server
+        Control requests have their own connection so that they never queue
+        behind a pending long poll.
 
         """
 
-        self.server_uri = None
-        """ Bayeux server URI """
+        self.http = {}
+        """ HTTP connection pooling, keep-alive and retry options """
 
-        self.client_id = None
+        self.control_timeout = 10
+        """ Number of seconds to wait for a response to a control request
         """
-        Unique identification of the client to the Bayeux server
 
-        The id is given to the client during the handshake negotiation.
+        self.websocket_uri = None
+        """ Bayeux server WebSocket URI """
+
+        self.websocket = None
+        """ WebSocket transport when websocket connection type is in use """
 
+        self.stream_responses = False
         """
+        Streaming decode of response messages
 
-        self.message_id = 0
-        """ Unique identification of a message """
+        If set, response messages are decoded and handled one by one
+        as the response body arrives instead of waiting for the whole
+        response to be received and decoded.
 
-        self.session = requests.Session()
-        """ Requests session for sending HTTP requests to Bayeux server """
+        """
+
+        self.stream_chunk_size = 8192
+        """ Number of bytes read at once when streaming responses """
+
+        self.max_pending_events = None
+        """
+        Maximum number of events waiting for a worker
+
+        If set, delivered events are passed to workers via a bounded queue.
+        When the queue is full, handling of delivered events blocks and
+        no other connect request is sent until the queue drains.
+
+        """
 
-        self.timeout = 110000
+        self.replay = {}
         """
-        Long polling timeout
+        Replay options
 
-        The number of milliseconds the server will hold the long poll request
+        If set, the last processed replay ID of each channel is checkpointed
+        and subscriptions ask for replaying events following it.
 
         """
 
-        self.interval = 1
+        self.shard_count = 1
         """
-        Long polling interval
+        Number of shards
 
-        The number of milliseconds the client SHOULD wait before issuing
-        another long poll request.
+        If greater than one, subscriptions are split across the given number
+        of independent sessions, each having its own client ID and its own
+        connection loop, so that slow channels do not delay the others.
 
         """
 
-        self.reconnection = Reconnection.handshake
+        self.shard_map = {}
         """
-        Reconnection options
+        Explicit assignment of channel names to shard indexes
 
-        Indicates how the client should act in the case of a failure
-        to connect.
+        Channels not listed are assigned by hash of their name.
 
         """
 
-        self._channels = {}
-        self._subscriptions = set()
+        self.shards = []
+        """ Clients of individual shards when sharding is enabled """
+
+        self.startup = {}
+        """
+        Startup options
+
+        If pipelined, subscriptions are sent in chunks and the first connect
+        request follows the first chunk without waiting for the others.
+
+        """
+
+        self.startup_timings = {}
+        """
+        Durations of phases of the first startup in seconds by phase name
+
+        Phases are ``login``, ``handshake``, ``subscribe`` and ``connect``
+        in the order they run, and ``subscriptions`` covering all chunks
+        of a pipelined startup.
+
+        """
+
+        self._running_shards = []
+        self._connection_threads = []
+        self._subscriber = None
+        self._subscribe_pool = None
+        self._started_up = False
+        self._in_flight = {}
+        self._undelivered = []
+        self._stopping = False
+        self._workers_done = Event()
+        self._pending_events = None
+        self._checkpoints_flush_due = Event()
+        self._credentials_refresher = None
 
     def setup(self):
         config = self.container.config.get('BAYEUX', {})
-        self.version = config.get('VERSION', '1.0')
-        self.minimum_version = config.get('MINIMUM_VERSION', '1.0')
-        self.server_uri = config.get('SERVER_URI', 'http://localhost/cometd')
+        self.configure(config)
+        self.websocket_uri = config.get(
+            'WEBSOCKET_URI', re.sub('^http', 'ws', self.server_uri))
+        self.connection_types = self._get_connection_types(
+            config.get('CONNECTION_TYPES', ['long-polling']))
+        self.stream_responses = config.get('STREAM_RESPONSES', False)
+        self.stream_chunk_size = config.get('STREAM_CHUNK_SIZE', 8192)
+        self.max_pending_events = config.get('MAX_PENDING_EVENTS')
+        self.replay = config.get('REPLAY', {})
+        self.http = config.get('HTTP', {})
+        self.control_timeout = self.http.get('CONTROL_TIMEOUT', 10)
+        configure_session(self.session, self.http)
+        configure_session(self.control_session, self.http)
+        self.startup = config.get('STARTUP', {})
+        self.shard_count = config.get('SHARDS', 1)
+        self.shard_map = config.get('SHARD_MAP', {})
+        invalid = sorted(
+            channel_name for channel_name, index in self.shard_map.items()
+            if not 0 <= index < self.shard_count)
+        if invalid:
+            raise ValueError(
+                'Shard indexes out of range of {} shards: {}'
+                .format(self.shard_count, ', '.join(invalid)))
+
+    def _get_connection_types(self, names):
+        connection_types = [ConnectionType(name) for name in names]
+        if (
+            ConnectionType.websocket in connection_types and
+            not WebSocketTransport.is_available()
+        ):
+            logger.warning(
+                'WebSocket client library is not installed, '
+                'websocket connection type is disabled')
+            connection_types.remove(ConnectionType.websocket)
+        return connection_types
 
     def start(self):
-        self._register_channels()
-        self.container.spawn_managed_thread(self.run)
+        if self.replay:
+            self.checkpointer = Checkpointer(
+                self.get_checkpoint_store(),
+                default=self.replay.get('DEFAULT', -1),
+                flush_size=self.replay.get('FLUSH_SIZE', 100),
+                on_flush_due=self._request_checkpoints_flush)
+            self.register_extension(ReplayExtension(self.checkpointer))
+            self.container.spawn_managed_thread(self._flush_checkpoints)
+        if self.max_pending_events:
+            self._pending_events = Queue(self.max_pending_events)
+            self.container.spawn_managed_thread(self._dispatch_pending_events)
+        if self.shard_count > 1:
+            self._start_shards()
+        else:
+            self._register_channels()
+            self.resolve_extensions()
+            self._connection_threads.append(
+                self.container.spawn_managed_thread(self.run))
 
     def _register_channels(self):
-        self.register_channel(channels.Handshake(self))
-        self.register_channel(channels.Connect(self))
-        self.register_channel(channels.Disconnect(self))
-        self.register_channel(channels.Subscribe(self))
-        self.register_channel(channels.Unsubscribe(self))
+        self._register_meta_channels()
         for provider in self._providers:
             self.register_event_handler(
-                provider.channel_name, provider.handle_message)
+                provider.channel_name, provider.handle_message,
+                subscribe=not provider.dynamic)
+
+    def _start_shards(self):
+        self.shards = [self._make_shard() for _ in range(self.shard_count)]
+        for provider in self._providers:
+            if provider.dynamic:
+                # channels subscribed at runtime may go to any shard
+                shards = self.shards
+            else:
+                shards = [
+                    self.shards[self.get_shard_index(provider.channel_name)]]
+            for shard in shards:
+                shard.register_event_handler(
+                    provider.channel_name, provider.handle_message,
+                    subscribe=not provider.dynamic)
+        for index, shard in enumerate(self.shards):
+            shard.resolve_extensions()
+            if shard._subscriptions:
+                self._start_shard(index)
+
+    def _ensure_shard_running(self, index):
+        if self.shards[index] not in self._running_shards:
+            self._start_shard(index)
+
+    def _start_shard(self, index):
+        shard = self.shards[index]
+        logger.info(
+            'Starting shard %s subscribed to %s',
+            index, sorted(shard._subscriptions))
+        self._running_shards.append(shard)
+        self._connection_threads.append(
+            self.container.spawn_managed_thread(shard.run))
+
+    def _make_shard(self):
+        # construct the shard with the arguments the client was given
+        # the same way Nameko clones extensions when binding them
+        args, kwargs = self._Extension__params  # pylint: disable=no-member
+        shard = type(self)(*args, **kwargs)
+        shard.container = self.container
+        shard.setup()
+        shard.shard_count = 1
+        shard.checkpointer = self.checkpointer
+        shard.metrics = self.metrics
+        for extension in self.extensions.extensions:
+            # acks are specific to the session of each shard
+            if not isinstance(extension, AckExtension):
+                shard.register_extension(extension)
+        shard._pending_events = self._pending_events
+        shard._register_meta_channels()
+        return shard
+
+    def get_checkpoint_store(self):
+        """
+        Return store of replay checkpoints
+
+        Override to plug in a custom store.
+
+        """
+        store_class = STORES[self.replay.get('STORE', 'file')]
+        return store_class(self.replay.get('PATH', 'bayeux-checkpoints'))
+
+    def _flush_checkpoints(self):
+        while True:
+            self._checkpoints_flush_due.wait(
+                self.replay.get('FLUSH_INTERVAL', 5))
+            self._checkpoints_flush_due = Event()
+            self._save_checkpoints()
+
+    def _request_checkpoints_flush(self):
+        if not self._checkpoints_flush_due.ready():
+            self._checkpoints_flush_due.send()
+
+    def _save_checkpoints(self):
+        try:
+            self.checkpointer.flush()
+        except Exception:
+            logger.exception('Failed to save checkpoints')
+
+    def begin_checkpoint(self, channel_name, data):
+        """ Record the event of the given channel as dispatched to a worker
+        """
+        if self.checkpointer is not None:
+            replay_id = self.get_replay_id(data)
+            if replay_id is not None:
+                self.checkpointer.begin(channel_name, replay_id)
 
-    def register_channel(self, channel):
-        self._channels[channel.name] = channel
+    def checkpoint(self, channel_name, data):
+        """ Record the event of the given channel as processed
+        """
+        if self.checkpointer is not None:
+            replay_id = self.get_replay_id(data)
+            if replay_id is not None:
+                self.checkpointer.complete(channel_name, replay_id)
+
+    def begin_ack(self, channel_name):
+        if self.shards:
+            shard = self.shards[self.get_shard_index(channel_name)]
+            return shard.begin_ack(channel_name)
+        return super().begin_ack(channel_name)
+
+    def add_subscription(self, channel_name, callback=None):
+        if not self.shards:
+            super().add_subscription(channel_name, callback)
+            return
+        index = self.get_shard_index(channel_name)
+        self.shards[index].add_subscription(channel_name, callback)
+        self._ensure_shard_running(index)
+
+    def remove_subscription(self, channel_name):
+        self._get_client(channel_name).remove_subscription(channel_name)
+
+    def get_subscription_state(self, channel_name):
+        return self._get_client(channel_name).get_subscription_state(
+            channel_name)
+
+    def get_subscription_error(self, channel_name):
+        return self._get_client(channel_name).get_subscription_error(
+            channel_name)
+
+    def _get_client(self, channel_name):
+        if self.shards:
+            return self.shards[self.get_shard_index(channel_name)]
+        return super()
+
+    def get_shard_index(self, channel_name):
+        """ Return index of the shard the channel is assigned to
+        """
+        index = self.shard_map.get(channel_name)
+        if index is None:
+            index = zlib.crc32(channel_name.encode('utf-8')) % self.shard_count
+        return index
+
+    def unregister_provider(self, provider):
+        super().unregister_provider(provider)
+        if not self._providers:
+            self.shut_down()
+
+    def shut_down(self):
+        """
+        Stop receiving events and wait for in-flight workers
+
+        Called once the last entrypoint stopped. Connection loops are
+        stopped straight away, aborting pending connect requests, while
+        the client stays connected for workers to complete. Events not
+        passed to workers yet are not passed any more. Workers still
+        running after ``shutdown_deadline`` seconds are killed. Events of
+        both are reported by ``report_undelivered``.
 
-    def register_event_handler(self, channel_name, callback):
-        channel = self._channels.get(channel_name)
-        if not channel:
-            channel = channels.Event(self, channel_name)
-            self.register_channel(channel)
-        channel.register_callback(callback)
-        self._subscriptions.add(channel_name)
+        """
+        if self._stopping:
+            return
+        self._stopping = True
+        for thread in self._connection_threads:
+            thread.kill()
+        for client in [self] + self.shards:
+            client._stop_subscribing()  # pylint: disable=protected-access
+        with eventlet.Timeout(self.shutdown_deadline, False):
+            if self._pending_events is not None:
+                self._pending_events.join()
+            if self._in_flight:
+                self._workers_done.wait()
+        # kill worker threads the way the container kills them
+        # pylint: disable=protected-access
+        worker_threads = self.container._worker_threads
+        for worker_ctx, events in list(self._in_flight.items()):
+            thread = worker_threads.get(worker_ctx)
+            if thread is not None:
+                thread.kill()
+            self._undelivered.extend(events)
+        self._in_flight.clear()
+        if self._undelivered:
+            self.report_undelivered(self._undelivered)
+
+    def track_worker(self, worker_ctx, events):
+        """ Record a worker handling the given events as in flight
+
+        Events are given as ``(channel name, data)`` pairs.
+
+        """
+        self._in_flight[worker_ctx] = events
+
+    def complete_worker(self, worker_ctx):
+        """ Record a worker as completed """
+        self._in_flight.pop(worker_ctx, None)
+        if (
+            self._stopping and not self._in_flight and
+            not self._workers_done.ready()
+        ):
+            self._workers_done.send()
+
+    def record_undelivered(self, events):
+        """ Record events not passed to workers as the client is stopping
+        """
+        self._undelivered.extend(events)
 
     def stop(self):
-        self.disconnect()
+        self.shut_down()
+        if self.shards:
+            clients = self._running_shards
+        else:
+            clients = [self]
+        try:
+            for client in clients:
+                try:
+                    client.disconnect()
+                except Exception:
+                    logger.exception(
+                        'Failed to disconnect client ID %s', client.client_id)
+        finally:
+            if self.checkpointer is not None:
+                self._save_checkpoints()
+        if self._pending_events is not None and self._pending_events.qsize():
+            logger.warning(
+                'Stopping with %s events pending',
+                self._pending_events.qsize())
         super().stop()
 
     def run(self):
+        started = time.perf_counter()
         while True:
             try:
                 if self.reconnection != Reconnection.retry:
                     self.handshake()
-                    self.subscribe()
-                self.connect()
+                    with self._timing('subscribe'):
+                        self.subscribe()
+                with self._timing('connect'):
+                    self.connect()
             except Reconnect:
-                logger.warning(
-                    'Need to reconnect to Bayeux server ...', exc_info=True)
-            eventlet.sleep(self.interval * 10 ** -3)  # from milliseconds
+                self.connection_failed()
+            else:
+                self.connection_succeeded()
+                if not self._started_up:
+                    self._started_up = True
+                    self.report_startup_timings(
+                        time.perf_counter() - started)
+            eventlet.sleep(self.get_reconnect_delay())
+
+    @contextmanager
+    def _timing(self, phase):
+        started = time.perf_counter()
+        yield
+        if not self._started_up:
+            self.startup_timings[phase] = time.perf_counter() - started
+
+    def report_startup_timings(self, duration):
+        """
+        Report durations of startup phases once the first connect succeeded
+
+        The duration is the total time to start up, including failed
+        attempts. Logs the durations and records those of phases in the
+        ``startup_phase_duration_seconds`` metric.
+
+        """
+        logger.info(
+            'Started up in %.3f seconds (%s)', duration,
+            ', '.join(
+                '{} {:.3f}s'.format(phase, duration)
+                for phase, duration in self.startup_timings.items()))
+        for phase, duration in self.startup_timings.items():
+            self.metrics.observe(
+                'startup_phase_duration_seconds', duration, phase=phase)
 
     def handshake(self):
         """ Send a handshake request and process the handshake response
+
+        Handshake is always sent over HTTP, a WebSocket connection is opened
+        afterwards if websocket connection type was negotiated.
+
         """
         self.reconnection = Reconnection.handshake  # reset reconnection
-        self.login()  # authenticate before starting the handshake
-        self.send_and_handle(channels.Handshake(self).compose())
+        self._close_websocket()
+        self._stop_subscribing()
+        if not self.credentials.valid:
+            with self._timing('login'):
+                # authenticate before starting the handshake
+                self.authorise()
+        with self._timing('handshake'):
+            self.send_and_handle(channels.Handshake(self).compose())
+        if self.connection_type == ConnectionType.websocket:
+            self._open_websocket()
+
+    def authorise(self):
+        """ Log in and cache authorisation headers
+
+        Headers expiring are refreshed by a background thread before they
+        expire so that reconnections do not wait for a login.
+
+        """
+        self.login()
+        self._set_credentials()
+        if (
+            self.credentials.expires_at is not None and
+            self._credentials_refresher is None
+        ):
+            self._credentials_refresher = self.container.spawn_managed_thread(
+                self._refresh_credentials)
+
+    def _refresh_credentials(self):
+        delay = self._get_refresh_delay()
+        while delay is not None:
+            eventlet.sleep(delay)
+            try:
+                self.login()
+                self._set_credentials()
+            except Exception:
+                logger.exception('Failed to refresh authorisation')
+                eventlet.sleep(self.auth.get('RETRY_DELAY', 5))
+            delay = self._get_refresh_delay()
+        self._credentials_refresher = None
+
+    def _open_websocket(self):
+        websocket = WebSocketTransport(self.websocket_uri, self.codec)
+        try:
+            websocket.open(self._get_authorisation_headers(), self.timeout)
+        except Reconnect:
+            logger.warning(
+                'Falling back to long-polling connection type ...',
+                exc_info=True)
+            self.connection_type = ConnectionType.long_polling
+        else:
+            self.websocket = websocket
+
+    def _close_websocket(self):
+        websocket, self.websocket = self.websocket, None
+        if websocket is not None:
+            websocket.close()
 
     def connect(self):
-        """ Send a connect message and precess response messages """
-        self.send_and_handle(channels.Connect(self).compose())
+        """ Send a connect message and precess response messages
+
+        Subscriptions changed at runtime and queued messages are sent in
+        the same request. If the queue of pending events is full, waits for
+        the queue to drain before asking the server for more events.
+
+        """
+        if self._pending_events is not None and self._pending_events.full():
+            logger.info(
+                'Waiting for %s pending events to drain ...',
+                self._pending_events.qsize())
+            self._pending_events.join()
+        messages = self.drain_outbound()
+        connect = channels.Connect(self).compose()
+        try:
+            self.send_and_handle(messages + [connect] if messages else connect)
+        except Reconnect:
+            self.fail_replies(messages, 'Request to Bayeux server failed')
+            raise
+
+    def queue_message(self, message, callback=None, urgent=False):
+        if self.shards:
+            index = self.get_shard_index(message['channel'])
+            self.shards[index].queue_message(message, callback, urgent)
+            self._ensure_shard_running(index)
+            return
+        super().queue_message(message, callback)
+        if urgent:
+            self.flush_outbound()
+
+    def flush_outbound(self):
+        """
+        Send queued messages in a separate request straight away
+
+        The request goes over the control session so that it does not wait
+        for the pending long poll. Messages stay queued until the client
+        hand shook.
+
+        """
+        if self.shards:
+            for shard in self._running_shards:
+                shard.flush_outbound()
+            return
+        if self.client_id is None:
+            return
+        messages = self.drain_outbound()
+        if not messages:
+            return
+        try:
+            self.send_and_handle_control(messages)
+        except Reconnect:
+            logger.warning(
+                'Failed to send %s queued messages', len(messages),
+                exc_info=True)
+            self.fail_replies(messages, 'Request to Bayeux server failed')
 
     def disconnect(self):
         """ Send a disconnect request and process response messages
+
+        The disconnect request is sent over HTTP using the control session
+        as both the WebSocket connection and the long-polling connection may
+        be in use by a pending connect request.
+
         """
-        self.send_and_handle(channels.Disconnect(self).compose())
+        websocket, self.websocket = self.websocket, None
+        try:
+            self.send_and_handle_control(channels.Disconnect(self).compose())
+        finally:
+            if websocket is not None:
+                websocket.close()
 
     def subscribe(self):
         """ Send all subscription messages and process response messages
+
+        With pipelined startup, the messages are sent in chunks of
+        ``CHUNK_SIZE``. The first chunk is sent straight away, the others
+        concurrently over the control session, and subscribing returns as
+        soon as the first chunk succeeded so that the first connect request
+        does not wait for the other chunks.
+
+        """
+        messages = self.compose_subscriptions()
+        chunk_size = self.startup.get('CHUNK_SIZE', 100)
+        if not self.startup.get('PIPELINED') or len(messages) <= chunk_size:
+            self.send_and_handle(messages)
+            return
+        chunks = [
+            messages[index:index + chunk_size]
+            for index in range(0, len(messages), chunk_size)]
+        self._subscriber = self.container.spawn_managed_thread(
+            functools.partial(
+                self._subscribe_chunks, chunks[1:], time.perf_counter()))
+        self.send_and_handle(chunks[0])
+
+    def _subscribe_chunks(self, chunks, started):
+        self._subscribe_pool = eventlet.GreenPool(
+            self.startup.get('CONCURRENCY', 4))
+        pile = eventlet.GreenPile(self._subscribe_pool)
+        for chunk in chunks:
+            pile.spawn(self._subscribe_chunk, chunk)
+        for _ in pile:
+            pass  # raises if subscribing failed
+        duration = time.perf_counter() - started
+        logger.info(
+            'Subscribed to channels in %s chunks in %.3f seconds',
+            len(chunks) + 1, duration)
+        if 'subscriptions' not in self.startup_timings:
+            self.startup_timings['subscriptions'] = duration
+            if self._started_up:
+                # completed after the startup was reported
+                self.metrics.observe(
+                    'startup_phase_duration_seconds', duration,
+                    phase='subscriptions')
+        self._subscriber = self._subscribe_pool = None
+
+    def _subscribe_chunk(self, messages):
+        try:
+            self.send_and_handle_control(messages)
+        except Reconnect:
+            # a failing connect request leads to subscribing again anyway
+            logger.warning(
+                'Failed to subscribe to %s channels, retrying along with '
+                'the next connect request', len(messages), exc_info=True)
+            for message in messages:
+                self.queue_message(message)
+
+    def _stop_subscribing(self):
+        """ Stop sending chunks of subscriptions of a previous handshake
+        """
+        if self._subscriber is not None:
+            self._subscriber.kill()
+        if self._subscribe_pool is not None:
+            for thread in list(self._subscribe_pool.coroutines_running):
+                thread.kill()
+        self._subscriber = self._subscribe_pool = None
+
+    def dispatch(self, callback, *args):
         """
-        self.send_and_handle([
-            channels.Subscribe(self).compose(channel)
-            for channel in self._subscriptions
-        ])
+        Dispatch a delivered event to the given callback
+
+        The callback is called straight away, or if the number of pending
+        events is limited, the event is put to the bounded queue of pending
+        events and the call blocks while the queue is full.
 
-    def handle(self, messages):
-        """ Handle incoming messages
         """
-        for message in messages:
-            channel = self._channels[message['channel']]
-            channel.handle(message)
+        if self._pending_events is None:
+            callback(*args)
+        else:
+            self._pending_events.put((callback, args))
+
+    def _dispatch_pending_events(self):
+        while True:
+            callback, args = self._pending_events.get()
+            try:
+                callback(*args)
+            finally:
+                self._pending_events.task_done()
 
     def send_and_handle(self, messages):
         """ Send request messages and handle received response messages
+
+        A stream of response messages is closed when handling fails part way
+        so that the response is released straight away.
+
+        """
+        messages = self._prepare_outgoing(messages)
+        if self.stream_responses and self.websocket is None:
+            with closing(self.send_and_stream(messages)) as messages_in:
+                self.handle(messages_in)
+        else:
+            self.handle(self.send_and_receive(messages))
+
+    def send_and_handle_control(self, messages):
+        """ Send request messages using the control session and handle
+        received response messages
         """
-        self.handle(self.send_and_receive(messages))
+        messages = self._prepare_outgoing(messages)
+        with self._reconnect_on_failure():
+            with eventlet.Timeout(self.control_timeout):
+                response = self._post(
+                    messages, session=self.control_session,
+                    timeout=self.control_timeout,
+                    stream=self.compression.max_response_size is not None)
+                messages_in = self.decode(self._read_content(response))
+        self.handle(messages_in)
 
     def send_and_receive(self, messages):
         """ Send request messages and receive response messages
         """
-        try:
+        with self._reconnect_on_failure():
             with eventlet.Timeout(self.timeout):
                 return self._send_and_receive(messages)
+
+    def send_and_stream(self, messages):
+        """
+        Send request messages and yield response messages as they arrive
+
+        The timeout applies to receiving the response headers, reading
+        of the response body is guarded by the socket read timeout so that
+        the time spent on handling yielded messages does not count.
+
+        """
+        with self._reconnect_on_failure():
+            with eventlet.Timeout(self.timeout):
+                response = self._post(messages, stream=True)
+            size = decode_duration = 0
+            try:
+                chunks = self.compression.limit(
+                    response.iter_content(self.stream_chunk_size))
+                items = iter_array_items(chunks, self.lazy_events)
+                for item in items:
+                    size += len(item[0] if self.lazy_events else item)
+                    started = time.perf_counter()
+                    message = self.load_message(item)
+                    decode_duration += time.perf_counter() - started
+                    logger.debug('Received Bayeux message %s', message)
+                    yield message
+            finally:
+                response.close()
+                self.metrics.observe('response_size_bytes', size)
+                self.metrics.observe(
+                    'decode_duration_seconds', decode_duration)
+
+    @contextmanager
+    def _reconnect_on_failure(self):
+        try:
+            yield
         except (
             requests.ConnectionError,
             requests.HTTPError,
+            requests.exceptions.ChunkedEncodingError,
         ) as exc:
             # TODO 400 HTTPErrors maybe should not be reconnected?
+            if getattr(exc, 'response', None) is not None:
+                self._credentials_rejected(exc.response.status_code)
             raise Reconnect(
                 'Failed to post request messages to Bayeux server'
             ) from exc
@@ -188,75 +785,428 @@ class BayeuxClient(SharedExtension, ProviderCollector):
 
     def _send_and_receive(self, messages_out):
 
-        if not isinstance(messages_out, collections.Sequence):
-            messages_out = [messages_out]
+        if self.websocket is not None:
+            return self._exchange_over_websocket(messages_out)
 
-        headers = {
-            'Content-Type': 'application/json',
-        }
-        auth_schema, auth_param = self.get_authorisation()
-        if auth_schema and auth_param:
-            headers['Authorization'] = '{} {}'.format(auth_schema, auth_param)
+        response = self._post(
+            messages_out,
+            stream=self.compression.max_response_size is not None)
+        return self.decode(self._read_content(response))
 
-        logger.debug('Sending Bayeux messages %s', messages_out)
+    def _read_content(self, response):
+        """ Read the response body within the maximum response size
+        """
+        if self.compression.max_response_size is None:
+            return response.content
+        with closing(response):
+            return b''.join(self.compression.limit(
+                response.iter_content(self.stream_chunk_size)))
 
-        response = self.session.post(
-            self.server_uri,
-            timeout=self.timeout,
-            headers=headers,
-            data=json.dumps(messages_out))
-        response.raise_for_status()
-        messages_in = response.json()
+    def _exchange_over_websocket(self, messages_out):
+
+        messages_out = self._as_list(messages_out)
+
+        logger.debug('Sending Bayeux messages over WebSocket %s', messages_out)
+
+        started = time.perf_counter()
+        try:
+            messages_in = self.websocket.send_and_receive(messages_out)
+        except (Reconnect, eventlet.Timeout):
+            # the connection is broken or out of sync with pending
+            # responses, it is reopened after another handshake
+            self._close_websocket()
+            self.reconnection = Reconnection.handshake
+            raise
+        self.metrics.observe(
+            'request_duration_seconds', time.perf_counter() - started,
+            channel=self._get_channel_label(messages_out))
 
         logger.debug('Received Bayeux messages %s', messages_in)
 
         return messages_in
 
-    def login(self):
-        """
-        Log in and set authentication data
+    def _post(self, messages_out, stream=False, session=None, timeout=None):
 
-        Override if authentication is required.
+        messages_out = self._as_list(messages_out)
 
-        """
+        logger.debug('Sending Bayeux messages %s', messages_out)
 
-    def get_authorisation(self):
-        """
-        Return schema and param of HTTP Authorization header
+        body, headers = self._encode_request(messages_out)
+        started = time.perf_counter()
+        response = (session or self.session).post(
+            self.server_uri,
+            timeout=timeout or self.timeout,
+            headers=headers,
+            data=body,
+            stream=stream)
+        response.raise_for_status()
+        self.metrics.observe(
+            'request_duration_seconds', time.perf_counter() - started,
+            channel=self._get_channel_label(messages_out))
 
-        Override if authentication is required.
+        return response
 
-        """
-        return None, None
 
-    def get_next_message_id(self):
-        self.message_id += 1
-        return self.message_id
+class BayeuxMessageHandler(Entrypoint):
+    """
+    Entrypoint handling delivered events
+
+    Each event is passed to a worker straight away unless a ``key``
+    extractor is given. Then events of the same key, as returned by
+    ``key`` called with the event data, are passed to workers one at
+    a time in the order they were delivered. Events of different keys
+    are handled concurrently by up to ``max_concurrency`` workers.
 
+    A ``dynamic`` entrypoint does not subscribe to its channel, it handles
+    events of channels subscribed at runtime matching its channel name,
+    usually a wildcard pattern.
 
-class BayeuxMessageHandler(Entrypoint):
+    """
 
     client = BayeuxClient()
 
-    def __init__(self, channel_name):
+    def __init__(
+        self, channel_name, key=None, max_concurrency=None, dynamic=False
+    ):
         self.channel_name = channel_name
+        self.dynamic = dynamic
+        self.key = key
+        self.max_concurrency = max_concurrency
+        self._scheduler = KeyedScheduler(max_concurrency)
+        self._stopped = False
 
     def setup(self):
         self.client.register_provider(self)
 
     def stop(self):
+        """ Stop passing events to workers
+
+        Ordered events waiting for their turn are recorded as undelivered.
+
+        """
+        self._stopped = True
+        tasks = self._scheduler.clear()
+        if tasks:
+            logger.warning(
+                'Stopping with %s ordered events of channel %s pending',
+                len(tasks), self.channel_name)
+            self.client.record_undelivered([
+                (task.args[1] or self.channel_name, task.args[0])
+                for task in tasks])
         self.client.unregister_provider(self)
 
-    def handle_message(self, message):
-        args = (self.channel_name, message)
+    def handle_message(self, message, channel_name=None):
+        self.client.begin_checkpoint(
+            channel_name or self.channel_name, message)
+        ack = self.client.begin_ack(self.channel_name)
+        self.client.dispatch(self.spawn_worker, message, channel_name, ack)
+
+    def spawn_worker(self, message, channel_name=None, ack=None):
+        if self._stopped:
+            self.client.record_undelivered(
+                [(channel_name or self.channel_name, message)])
+            return
+        key = self.get_key(message)
+        if key is None:
+            self._spawn_worker(message, channel_name, ack)
+        else:
+            self._scheduler.submit(key, functools.partial(
+                self._spawn_worker, message, channel_name, ack))
+
+    def get_key(self, message):
+        """ Return ordering key of the event data or None to not order it
+        """
+        if self.key is None:
+            return None
+        try:
+            return self.key(message)
+        except Exception:
+            logger.exception(
+                'Failed to get ordering key of event of channel %s',
+                self.channel_name)
+            return None
+
+    def _spawn_worker(self, message, channel_name=None, ack=None, done=None):
+        args = (channel_name or self.channel_name, message)
         kwargs = {}
         context_data = {}
-        self.container.spawn_worker(
+        started = time.perf_counter()
+        worker_ctx = self.container.spawn_worker(
             self, args, kwargs, context_data=context_data,
-            handle_result=self.handle_result)
+            handle_result=functools.partial(
+                self.handle_result, ack=ack, done=done))
+        self.client.track_worker(worker_ctx, [args])
+        self.client.metrics.observe(
+            'spawn_worker_duration_seconds', time.perf_counter() - started,
+            channel=self.channel_name)
+
+    def handle_result(
+        self, worker_ctx, result=None, exc_info=None, ack=None, done=None
+    ):
+        """ Checkpoint the event if the worker succeeded and ack it
+        once the worker completed either way
+
+        The next event of the same ordering key is passed to a worker from
+        a thread of its own as the worker pool may be exhausted.
+
+        """
+        self.client.complete_worker(worker_ctx)
+        if exc_info is None:
+            channel_name, data = worker_ctx.args
+            self.client.checkpoint(channel_name, data)
+        if ack is not None:
+            ack()
+        if done is not None:
+            self.container.spawn_managed_thread(done)
+        return result, exc_info
+
+
+class BayeuxBatchMessageHandler(BayeuxMessageHandler):
+    """
+    Entrypoint handling delivered events in batches
+
+    Events are collected and passed to one worker as a list when there
+    are ``max_size`` events collected or ``max_wait`` seconds after
+    the first event of the batch was delivered, whichever comes first.
+    Events delivered in the same response always share a worker unless
+    there are more than ``max_size`` of them.
+
+    For wildcard channels, the worker is given the channel name pattern
+    as a batch can mix events of several channels. Replay IDs are still
+    checkpointed per the channel each event was delivered to.
+
+    """
+
+    def __init__(
+        self, channel_name, max_size=100, max_wait=0.1, dynamic=False
+    ):
+        super().__init__(channel_name, dynamic=dynamic)
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._batch = []
+        self._flush_timer = None
+
+    def stop(self):
+        """ Pass collected events to a worker and stop collecting
+
+        The last batch bypasses the queue of pending events as its
+        dispatcher may not be running any more.
 
-    def handle_result(self, message, worker_ctx, result=None, exc_info=None):
+        """
+        batch = self._take_batch()
+        if batch:
+            self._spawn_batch_worker(*batch)
+        super().stop()
+
+    def handle_message(self, message, channel_name=None):
+        if self._stopped:
+            logger.warning(
+                'Ignoring event of channel %s delivered after stop',
+                channel_name or self.channel_name)
+            return
+        channel_name = channel_name or self.channel_name
+        self.client.begin_checkpoint(channel_name, message)
+        ack = self.client.begin_ack(self.channel_name)
+        self._batch.append((channel_name, message, ack))
+        if len(self._batch) >= self.max_size:
+            self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = self.container.spawn_managed_thread(
+                self._flush_after_max_wait)
+
+    def _flush_after_max_wait(self):
+        eventlet.sleep(self.max_wait)
+        self._flush_timer = None
+        self.flush()
+
+    def spawn_worker(self, messages, channel_names=None, acks=None):
+        if self._stopped:
+            self.client.record_undelivered(
+                self._get_events(messages, channel_names))
+            return
+        self._spawn_batch_worker(messages, channel_names, acks)
+
+    def _spawn_batch_worker(self, messages, channel_names=None, acks=None):
+        args = (self.channel_name, messages)
+        kwargs = {}
+        context_data = {}
+        started = time.perf_counter()
+        worker_ctx = self.container.spawn_worker(
+            self, args, kwargs, context_data=context_data,
+            handle_result=functools.partial(
+                self.handle_result, channel_names=channel_names, acks=acks))
+        self.client.track_worker(
+            worker_ctx, self._get_events(messages, channel_names))
+        self.client.metrics.observe(
+            'spawn_worker_duration_seconds', time.perf_counter() - started,
+            channel=self.channel_name)
+
+    def _get_events(self, messages, channel_names=None):
+        channel_names = channel_names or [self.channel_name] * len(messages)
+        return list(zip(channel_names, messages))
+
+    def handle_result(
+        self, worker_ctx, result=None, exc_info=None, channel_names=None,
+        acks=None
+    ):
+        self.client.complete_worker(worker_ctx)
+        if exc_info is None:
+            _, batch = worker_ctx.args
+            for channel_name, data in self._get_events(batch, channel_names):
+                self.client.checkpoint(channel_name, data)
+        for ack in acks or ():
+            if ack is not None:
+                ack()
         return result, exc_info
 
+    def flush(self):
+        """ Pass collected events to a worker """
+        batch = self._take_batch()
+        if batch:
+            self.client.dispatch(self.spawn_worker, *batch)
+
+    def _take_batch(self):
+        if self._flush_timer is not None:
+            self._flush_timer.kill()
+            self._flush_timer = None
+        batch, self._batch = self._batch, []
+        if batch:
+            channel_names, messages, acks = zip(*batch)
+            return list(messages), list(channel_names), list(acks)
+        return None
+
+
+class BayeuxMetrics(DependencyProvider):
+    """
+    Dependency provider giving workers the metrics collector of the client
+
+    E.g. to expose metrics of ``PrometheusCollector`` over HTTP.
+
+    """
+
+    client = BayeuxClient()
+
+    def get_dependency(self, worker_ctx):
+        return self.client.metrics
+
+
+class BayeuxSubscriptions(DependencyProvider):
+    """
+    Dependency provider giving workers the client to change subscriptions
+    at runtime
+
+    Workers call ``add_subscription`` and ``remove_subscription`` of
+    the client and check the result by ``get_subscription_state``.
+
+    """
+
+    client = BayeuxClient()
+
+    def get_dependency(self, worker_ctx):
+        return self.client
+
+
+class PublishResult:
+    """
+    Future result of publishing an event
+
+    Resolves once the server replied to the published event, or once
+    the request carrying it failed.
+
+    """
+
+    def __init__(self, channel_name):
+
+        self.channel_name = channel_name
+        """ Name of the channel the event was published to """
+
+        self._reply = Event()
+
+    def set_reply(self, message):
+        self._reply.send(message)
+
+    def done(self):
+        """ Return True if the server replied or the request failed """
+        return self._reply.ready()
+
+    def result(self, timeout=None):
+        """
+        Wait for the reply of the server and return it
+
+        Raises ``PublishError`` if the server did not accept the event
+        and ``eventlet.Timeout`` if there is no reply within ``timeout``
+        seconds.
+
+        """
+        with eventlet.Timeout(timeout):
+            message = self._reply.wait()
+        if not message['successful']:
+            raise PublishError(
+                'Failed to publish event to channel {}: {}'.format(
+                    self.channel_name, message.get('error')))
+        return message
+
+
+class BayeuxPublisher(DependencyProvider):
+    """
+    Dependency provider giving workers a function to publish events
+
+    Events are sent over the session and client ID of the client that
+    delivers events. Events published by all workers are collected and
+    sent in one request when there are ``MAX_SIZE`` of them or ``MAX_WAIT``
+    seconds after the first of them was published, whichever comes first,
+    unless a connect request takes them along before.
+
+    The publish function returns a ``PublishResult`` of the event.
+
+    """
+
+    client = BayeuxClient()
+
+    def __init__(self):
+        self.max_size = 100
+        self.max_wait = 0.05
+        self._pending = 0
+        self._flush_timer = None
+
+    def setup(self):
+        config = self.container.config.get('BAYEUX', {}).get('PUBLISH', {})
+        self.max_size = config.get('MAX_SIZE', 100)
+        self.max_wait = config.get('MAX_WAIT', 0.05)
+
+    def stop(self):
+        """ Send events published but not sent yet """
+        self.flush()
+
+    def get_dependency(self, worker_ctx):
+        return self.publish
+
+    def publish(self, channel_name, data):
+        """ Publish an event to the channel and return its result """
+        result = PublishResult(channel_name)
+        message = channels.Event(self.client, channel_name).compose(data)
+        self.client.queue_message(message, result.set_reply)
+        self._pending += 1
+        if self._pending >= self.max_size:
+            self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = self.container.spawn_managed_thread(
+                self._flush_after_max_wait)
+        return result
+
+    def _flush_after_max_wait(self):
+        eventlet.sleep(self.max_wait)
+        self._flush_timer = None
+        self.flush()
+
+    def flush(self):
+        """ Send published events in one request straight away """
+        if self._flush_timer is not None:
+            self._flush_timer.kill()
+            self._flush_timer = None
+        self._pending = 0
+        self.client.flush_outbound()
+
 
 subscribe = BayeuxMessageHandler.decorator
+subscribe_batch = BayeuxBatchMessageHandler.decorator
@@ -0,0 +1,126 @@
+import logging
+import zlib
+
+from nameko_bayeux_client.exceptions import ResponseTooLarge
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def _compress_gzip(body, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def _compress_deflate(body, level):
+    return zlib.compress(body, level)
+
+
+def _compress_brotli(body, level):
+    return brotli.compress(body, quality=min(level, 11))
+
+
+COMPRESSORS = {
+    'gzip': _compress_gzip,
+    'deflate': _compress_deflate,
+    'br': _compress_brotli,
+}
+
+
+def is_available(encoding):
+    """ Return whether the library backing the encoding is installed """
+    return encoding != 'br' or brotli is not None
+
+
+class Compression:
+    """
+    Compression of request bodies and size limit of response bodies
+
+    Request bodies of at least ``min_size`` bytes are compressed with
+    ``encoding`` if set. The server must then accept compressed requests.
+    Responses are decompressed by the HTTP library, ``accept_encoding``
+    lists the encodings to accept or None to accept those the library
+    supports.
+
+    """
+
+    def __init__(
+        self, encoding=None, min_size=1024, level=6, accept_encoding=None,
+        max_response_size=None
+    ):
+        if encoding is not None and encoding not in COMPRESSORS:
+            raise ValueError(
+                'Unknown request encoding {}, choose one of: {}'
+                .format(encoding, ', '.join(sorted(COMPRESSORS))))
+        if encoding is not None and not is_available(encoding):
+            logger.warning(
+                'Request encoding %s is not installed, falling back to gzip',
+                encoding)
+            encoding = 'gzip'
+
+        self.encoding = encoding
+        """ Content encoding of request bodies or None to send them as is """
+
+        self.min_size = min_size
+        """ Minimum size of request bodies to compress in bytes """
+
+        self.level = level
+        """ Compression level """
+
+        self.accept_encoding = accept_encoding
+        """ Encodings of response bodies to accept or None for defaults """
+        if accept_encoding is not None:
+            self.accept_encoding = [
+                name for name in accept_encoding if is_available(name)]
+
+        self.max_response_size = max_response_size
+        """ Maximum size of decompressed response bodies in bytes or None
+        if there is no limit
+        """
+
+    def get_headers(self, body):
+        """ Return request headers describing the compressed body """
+        headers = {}
+        if self.accept_encoding is not None:
+            headers['Accept-Encoding'] = (
+                ', '.join(self.accept_encoding) or 'identity')
+        if self.should_compress(body):
+            headers['Content-Encoding'] = self.encoding
+        return headers
+
+    def should_compress(self, body):
+        return self.encoding is not None and len(body) >= self.min_size
+
+    def compress(self, body):
+        """ Return the request body compressed if it is worth it """
+        if not self.should_compress(body):
+            return body
+        return COMPRESSORS[self.encoding](body, self.level)
+
+    def limit(self, chunks):
+        """
+        Iterate over chunks of a decompressed response body
+
+        Raises ``ResponseTooLarge`` as soon as the body exceeds the maximum
+        size, so that a small body decompressing to a huge one is never
+        read whole.
+
+        """
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            self.check_size(size)
+            yield chunk
+
+    def check_size(self, size):
+        if self.max_response_size is not None and (
+            size > self.max_response_size
+        ):
+            raise ResponseTooLarge(
+                'Response of Bayeux server exceeds {} bytes'
+                .format(self.max_response_size))
@@ -37,3 +37,49 @@ class Reconnection(Enum):
     reconnect advice none and MUST NOT automatically retry or handshake.
 
     """
+
+
+class ConnectionType(Enum):
+    """
+    Connection types
+
+    Transports the client and server can use for carrying Bayeux messages,
+    negotiated during the handshake.
+
+    """
+
+    long_polling = 'long-polling'
+    """
+    Long polling HTTP transport
+
+    Each connect message is posted in a new HTTP request which the server
+    holds until there are events to deliver or the timeout is reached.
+
+    """
+
+    websocket = 'websocket'
+    """
+    WebSocket transport
+
+    Messages are exchanged over one persistent WebSocket connection.
+
+    """
+
+
+class SubscriptionState(Enum):
+    """
+    States of subscriptions changed at runtime
+
+    """
+
+    pending = 'pending'
+    """ Subscribe request is waiting for its response """
+
+    subscribed = 'subscribed'
+    """ Server confirmed the subscription """
+
+    unsubscribing = 'unsubscribing'
+    """ Unsubscribe request is waiting for its response """
+
+    failed = 'failed'
+    """ Server rejected the subscribe or unsubscribe request """
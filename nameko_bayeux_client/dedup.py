@@ -0,0 +1,53 @@
+import collections
+import time
+
+
+class DeduplicationCache:
+    """
+    Bounded cache of recently seen event keys
+
+    Keys are kept in the order they were last seen. The least recently
+    seen keys are evicted once there are more than ``max_size`` of them
+    and, if ``ttl`` is set, keys not seen for ``ttl`` seconds expire.
+
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+
+        self.max_size = max_size
+        """ Maximum number of keys kept """
+
+        self.ttl = ttl
+        """ Number of seconds a key is kept for, or None to keep it until
+        evicted
+        """
+
+        self._seen = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, key):
+        """
+        Return True if the key was seen before, record it as seen otherwise
+
+        Seeing a key again refreshes it.
+
+        """
+        now = time.monotonic()
+        self._expire(now)
+        duplicate = key in self._seen
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return duplicate
+
+    def _expire(self, now):
+        if self.ttl is None:
+            return
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.ttl:
+                break
+            del self._seen[key]
@@ -0,0 +1,71 @@
+from nameko_bayeux_client.streaming import split_object
+
+
+_UNKNOWN = object()
+
+
+class EventEnvelope:
+    """
+    Delivered event with lazily decoded data
+
+    The envelope carries the channel, ID and replay ID of the event along
+    with the raw JSON bytes of its data. The data are decoded the first
+    time they are accessed, so events whose data are never read, or read
+    in a worker only, cost no decoding in the connection loop.
+
+    The replay ID is looked up in the raw data without decoding them,
+    by scanning the ``event`` object only.
+
+    """
+
+    __slots__ = ('channel', 'id', '_raw_data', '_data', '_replay_id', '_loads')
+
+    def __init__(self, channel, id, raw_data, loads):
+
+        self.channel = channel
+        """ Name of the channel the event was delivered to """
+
+        self.id = id
+        """ Message ID or None if the message has none """
+
+        self._raw_data = raw_data
+        self._data = None
+        self._replay_id = _UNKNOWN
+        self._loads = loads
+
+    def __repr__(self):
+        return '<EventEnvelope {} id={}>'.format(self.channel, self.id)
+
+    @property
+    def data(self):
+        """ Event data, decoded on first access """
+        if self._raw_data is not None:
+            self._data = self._loads(self._raw_data)
+            self._raw_data = None
+        return self._data
+
+    @property
+    def decoded(self):
+        """ True if the data were decoded already """
+        return self._raw_data is None
+
+    @property
+    def replay_id(self):
+        """ Replay ID of the event or None if there is none """
+        if self._replay_id is _UNKNOWN:
+            self._replay_id = self._get_replay_id()
+        return self._replay_id
+
+    def _get_replay_id(self):
+        if self.decoded:
+            try:
+                return self._data['event']['replayId']
+            except (KeyError, TypeError):
+                return None
+        members = split_object(self._raw_data)
+        if members is None or 'event' not in members:
+            return None
+        members = split_object(members['event'])
+        if members is None or 'replayId' not in members:
+            return None
+        return self._loads(members['replayId'])
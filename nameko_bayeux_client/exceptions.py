@@ -4,3 +4,11 @@ class BayeuxError(Exception):
 
 class Reconnect(BayeuxError):
     pass
+
+
+class ResponseTooLarge(Reconnect):
+    pass
+
+
+class PublishError(BayeuxError):
+    pass
@@ -0,0 +1,217 @@
+import collections
+import functools
+
+
+class MessageExtension:
+    """
+    Bayeux message extension base class
+
+    Extensions read and add ``ext`` fields of messages. Outgoing messages
+    are passed through ``outgoing`` before they are sent and incoming
+    messages through ``incoming`` before they are handled by channels.
+    Each hook returns the message to pass on, or None to drop it.
+
+    Hooks are only called for messages of channels listed in
+    ``channel_names``, or for all channels if it is None.
+
+    """
+
+    channel_names = None
+
+    def matches(self, channel_name):
+        """ Return True if the extension applies to the channel """
+        if self.channel_names is None:
+            return True
+        # pylint: disable=unsupported-membership-test
+        return channel_name in self.channel_names
+
+    def outgoing(self, message):
+        """ Process a message before it is sent """
+        return message
+
+    def incoming(self, message):
+        """ Process a received message before it is handled """
+        return message
+
+
+class ExtensionPipeline:
+    """
+    Ordered extensions resolved into hooks per channel
+
+    Outgoing hooks are called in the order the extensions were registered,
+    incoming hooks in the reverse order. Hooks of known channels are
+    resolved once by ``resolve``, those of other channels the first time
+    a message of the channel is seen, and only hooks overridden by
+    an extension are called.
+
+    """
+
+    def __init__(self):
+        self.extensions = []
+        self._outgoing = {}
+        self._incoming = {}
+
+    def __bool__(self):
+        return bool(self.extensions)
+
+    def register(self, extension):
+        self.extensions.append(extension)
+        self._outgoing.clear()
+        self._incoming.clear()
+
+    def resolve(self, channel_names):
+        """ Resolve hooks of the given channels """
+        for channel_name in channel_names:
+            self._resolve(channel_name)
+
+    def _resolve(self, channel_name):
+        extensions = [
+            extension for extension in self.extensions
+            if extension.matches(channel_name)
+        ]
+        self._outgoing[channel_name] = tuple(
+            extension.outgoing for extension in extensions
+            if _overrides(extension, 'outgoing'))
+        self._incoming[channel_name] = tuple(
+            extension.incoming for extension in reversed(extensions)
+            if _overrides(extension, 'incoming'))
+
+    def outgoing(self, message):
+        """ Pass an outgoing message through the hooks of its channel """
+        return self._call(self._outgoing, message)
+
+    def incoming(self, message):
+        """ Pass an incoming message through the hooks of its channel """
+        return self._call(self._incoming, message)
+
+    def _call(self, resolved, message):
+        channel_name = message.get('channel')
+        hooks = resolved.get(channel_name)
+        if hooks is None:
+            self._resolve(channel_name)
+            hooks = resolved[channel_name]
+        for hook in hooks:
+            message = hook(message)
+            if message is None:
+                break
+        return message
+
+
+def _overrides(extension, hook_name):
+    return (
+        getattr(type(extension), hook_name) is not
+        getattr(MessageExtension, hook_name))
+
+
+class ReplayExtension(MessageExtension):
+    """
+    Replay extension asking the server for replaying events
+
+    Asks for replay support during the handshake and for replaying events
+    following the last checkpointed replay ID of each subscribed channel.
+
+    """
+
+    channel_names = ('/meta/handshake', '/meta/subscribe')
+
+    def __init__(self, checkpointer):
+        self.checkpointer = checkpointer
+
+    def outgoing(self, message):
+        ext = message.setdefault('ext', {})
+        if message['channel'] == '/meta/handshake':
+            ext['replay'] = True
+        else:
+            channel_name = message['subscription']
+            ext['replay'] = {channel_name: self.checkpointer.get(channel_name)}
+        return message
+
+
+class AckExtension(MessageExtension):
+    """
+    Ack extension acknowledging batches of delivered events
+
+    Asks for ack support during the handshake. If the server supports it,
+    each connect response carries ID of the batch of events it delivered
+    and each connect request acknowledges the last batch of events whose
+    workers completed. The server delivers events of batches not
+    acknowledged again, e.g. after the connection dropped.
+
+    Events are tracked from being dispatched by ``begin`` to their workers
+    completing. Events dispatched before the connect response of their
+    batch was handled are counted in the batch, events delivered after are
+    conservatively counted in the next one.
+
+    """
+
+    channel_names = ('/meta/handshake', '/meta/connect')
+
+    def __init__(self):
+
+        self.enabled = False
+        """ Server supports acks """
+
+        self.acked = 0
+        """ ID of the last acknowledged batch """
+
+        self._batches = collections.deque()
+        self._receiving = None
+
+    def outgoing(self, message):
+        ext = message.setdefault('ext', {})
+        if message['channel'] == '/meta/handshake':
+            ext['ack'] = True
+        elif self.enabled:
+            self._advance()
+            ext['ack'] = self.acked
+        return message
+
+    def incoming(self, message):
+        ext = message.get('ext') or {}
+        if message['channel'] == '/meta/handshake':
+            self.enabled = ext.get('ack') is True
+            self.acked = 0
+            self._batches = collections.deque()
+            self._receiving = None
+        elif message.get('successful') and isinstance(ext.get('ack'), int):
+            batch = self._receiving
+            if batch is None:
+                batch = _Batch()
+                self._batches.append(batch)
+            batch.id = ext['ack']
+            self._receiving = None
+        return message
+
+    def begin(self):
+        """
+        Record an event as dispatched to a worker
+
+        Returns a function to call once the worker completes.
+
+        """
+        if self._receiving is None:
+            self._receiving = _Batch()
+            self._batches.append(self._receiving)
+        self._receiving.pending += 1
+        return functools.partial(_complete, self._receiving)
+
+    def _advance(self):
+        while self._batches:
+            batch = self._batches[0]
+            if batch.id is None or batch.pending:
+                break
+            self._batches.popleft()
+            self.acked = batch.id
+
+
+class _Batch:
+
+    __slots__ = ('id', 'pending')
+
+    def __init__(self):
+        self.id = None
+        self.pending = 0
+
+
+def _complete(batch):
+    batch.pending -= 1
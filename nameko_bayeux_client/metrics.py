@@ -0,0 +1,184 @@
+import bisect
+import collections
+
+
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30, 60, 120,
+)
+""" Default histogram buckets of durations in seconds """
+
+SIZE_BUCKETS = (
+    256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216,
+)
+""" Default histogram buckets of sizes in bytes """
+
+
+class MetricsCollector:
+    """
+    Metrics collector base class
+
+    Collects nothing. Subclasses record counters and histogram
+    observations identified by name and labels.
+
+    """
+
+    def increment(self, name, value=1, **labels):
+        """ Increment a counter """
+
+    def observe(self, name, value, **labels):
+        """ Record an observation of a histogram """
+
+
+class Histogram:
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """ Return pairs of bucket upper bounds and cumulative counts """
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield bound, cumulative
+
+
+class InMemoryCollector(MetricsCollector):
+    """
+    Metrics collector keeping counters and histograms in memory
+
+    Histograms of metrics named with ``_bytes`` suffix use size buckets,
+    others use duration buckets.
+
+    """
+
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name, value, **labels):
+        key = name, tuple(sorted(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(
+                self.get_buckets(name))
+        histogram.observe(value)
+
+    def get_buckets(self, name):
+        if name.endswith('_bytes'):
+            return SIZE_BUCKETS
+        return DURATION_BUCKETS
+
+    def get_counter(self, name, **labels):
+        """ Return value of a counter """
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def get_histogram(self, name, **labels):
+        """ Return a histogram or None if nothing was observed """
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+
+class PrometheusCollector(InMemoryCollector):
+    """
+    Metrics collector exporting metrics in Prometheus text format
+    """
+
+    def __init__(self, prefix='bayeux_'):
+        super().__init__()
+        self.prefix = prefix
+
+    def render(self):
+        """ Return collected metrics in Prometheus text exposition format
+        """
+        lines = []
+
+        for name, items in self._group(self.counters):
+            lines.append('# TYPE {}{} counter'.format(self.prefix, name))
+            for labels, value in items:
+                lines.append('{}{}{} {}'.format(
+                    self.prefix, name, self._format_labels(labels), value))
+
+        for name, items in self._group(self.histograms):
+            lines.append('# TYPE {}{} histogram'.format(self.prefix, name))
+            for labels, histogram in items:
+                for bound, count in histogram.cumulative_counts():
+                    bucket_labels = labels + (('le', self._format_le(bound)),)
+                    lines.append('{}{}_bucket{} {}'.format(
+                        self.prefix, name,
+                        self._format_labels(bucket_labels), count))
+                formatted_labels = self._format_labels(labels)
+                lines.append('{}{}_sum{} {}'.format(
+                    self.prefix, name, formatted_labels, histogram.sum))
+                lines.append('{}{}_count{} {}'.format(
+                    self.prefix, name, formatted_labels, histogram.count))
+
+        return ''.join(line + '\n' for line in lines)
+
+    @staticmethod
+    def _group(metrics):
+        grouped = collections.defaultdict(list)
+        for (name, labels), value in metrics.items():
+            grouped[name].append((labels, value))
+        return sorted(
+            (name, sorted(items, key=lambda item: item[0]))
+            for name, items in grouped.items()
+        )
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(key, PrometheusCollector._escape(value))
+            for key, value in labels
+        ))
+
+    @staticmethod
+    def _escape(value):
+        return (
+            str(value)
+            .replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+    @staticmethod
+    def _format_le(bound):
+        if bound == float('inf'):
+            return '+Inf'
+        return repr(float(bound))
+
+
+COLLECTORS = {
+    'memory': InMemoryCollector,
+    'prometheus': PrometheusCollector,
+}
+
+
+def get_collector(name=None):
+    """
+    Return metrics collector instance of the given name
+
+    Returns a collector collecting nothing if no name is given.
+
+    """
+    if name is None:
+        return MetricsCollector()
+    try:
+        return COLLECTORS[name]()
+    except KeyError:
+        raise ValueError(
+            'Unknown metrics collector {}, choose one of: {}'
+            .format(name, ', '.join(sorted(COLLECTORS))))
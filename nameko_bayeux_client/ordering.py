@@ -0,0 +1,81 @@
+import collections
+import functools
+
+
+class KeyedScheduler:
+    """
+    Scheduler running tasks of the same key one at a time in order
+
+    Tasks of different keys run concurrently, up to ``max_concurrency``
+    of them at once if set. Keys waiting for a free slot take turns in
+    the order they became ready.
+
+    A task is a callable given a ``done`` callback to call once the task
+    completed, which starts the next task.
+
+    """
+
+    def __init__(self, max_concurrency=None):
+
+        self.max_concurrency = max_concurrency
+        """ Maximum number of tasks running at once """
+
+        self.running = 0
+        """ Number of tasks running """
+
+        self._pending = {}
+        self._ready = collections.deque()
+
+    def __len__(self):
+        """ Return number of tasks waiting to run """
+        return sum(len(tasks) for tasks in self._pending.values())
+
+    def submit(self, key, task):
+        """ Run the task after tasks of the same key submitted before
+        """
+        tasks = self._pending.get(key)
+        if tasks is not None:
+            tasks.append(task)
+            return
+        self._pending[key] = collections.deque([task])
+        self._ready.append(key)
+        self._run()
+
+    def clear(self):
+        """ Drop tasks waiting to run and return them
+
+        Tasks running already still start the next tasks of their keys
+        once done, provided any are submitted in the meantime.
+
+        """
+        tasks = []
+        for pending in self._pending.values():
+            tasks.extend(pending)
+            pending.clear()
+        for key in self._ready:
+            del self._pending[key]
+        self._ready.clear()
+        return tasks
+
+    def _run(self):
+        while self._ready and (
+            self.max_concurrency is None or
+            self.running < self.max_concurrency
+        ):
+            key = self._ready.popleft()
+            task = self._pending[key].popleft()
+            self.running += 1
+            done = functools.partial(self._done, key)
+            try:
+                task(done)
+            except Exception:
+                done()
+                raise
+
+    def _done(self, key):
+        self.running -= 1
+        if self._pending[key]:
+            self._ready.append(key)
+        else:
+            del self._pending[key]
+        self._run()
@@ -0,0 +1,746 @@
+import collections
+import collections.abc
+import logging
+import time
+
+from nameko_bayeux_client import channels
+from nameko_bayeux_client.auth import Credentials
+from nameko_bayeux_client.backoff import Backoff
+from nameko_bayeux_client.compression import Compression
+from nameko_bayeux_client.constants import (
+    ConnectionType, Reconnection, SubscriptionState)
+from nameko_bayeux_client.dedup import DeduplicationCache
+from nameko_bayeux_client.envelope import EventEnvelope
+from nameko_bayeux_client.extensions import AckExtension, ExtensionPipeline
+from nameko_bayeux_client.metrics import get_collector, MetricsCollector
+from nameko_bayeux_client.serialization import get_codec, JsonCodec
+from nameko_bayeux_client.streaming import ArraySplitter
+from nameko_bayeux_client.trie import (
+    ChannelTrie, is_wildcard, validate_pattern)
+
+
+logger = logging.getLogger(__name__)
+
+
+class BayeuxProtocol:
+    """
+    Bayeux protocol core shared by client engines
+
+    Keeps the protocol state, composes request messages and handles
+    response messages using the channels. Engines add the transport
+    and the connection loop, the eventlet engine being the Nameko extension
+    and the asyncio engine being built on aiohttp.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        self.version = None
+        """ Bayeux protocol version """
+
+        self.minimum_version = None
+        """
+        Minimum Bayeux protocol version
+
+        Indicates the oldest protocol version that can be handled
+        by the client/server
+
+        """
+
+        self.server_uri = None
+        """ Bayeux server URI """
+
+        self.client_id = None
+        """
+        Unique identification of the client to the Bayeux server
+
+        The id is given to the client during the handshake negotiation.
+
+        """
+
+        self.message_id = 0
+        """ Unique identification of a message """
+
+        self.timeout = 110000
+        """
+        Long polling timeout
+
+        The number of milliseconds the server will hold the long poll request
+
+        """
+
+        self.interval = 1
+        """
+        Long polling interval
+
+        The number of milliseconds the client SHOULD wait before issuing
+        another long poll request.
+
+        """
+
+        self.reconnection = Reconnection.handshake
+        """
+        Reconnection options
+
+        Indicates how the client should act in the case of a failure
+        to connect.
+
+        """
+
+        self.connection_types = [ConnectionType.long_polling]
+        """ Connection types supported by the client in order of preference
+        """
+
+        self.connection_type = ConnectionType.long_polling
+        """ Connection type negotiated during the handshake """
+
+        self.backoff = Backoff()
+        """
+        Reconnection backoff
+
+        Spaces out reconnection attempts after consecutive failures
+        and keeps track of the failures.
+
+        """
+
+        self.codec = JsonCodec()
+        """ JSON codec encoding request and decoding response messages """
+
+        self.compression = Compression()
+        """ Compression of request bodies and size limit of responses """
+
+        self.lazy_events = False
+        """
+        Deliver events as envelopes with lazily decoded data
+
+        If enabled, event callbacks are given ``EventEnvelope`` instances
+        instead of event data.
+
+        """
+
+        self.checkpointer = None
+        """ Tracker of processed replay IDs when replay is enabled """
+
+        self.metrics = MetricsCollector()
+        """
+        Metrics collector
+
+        Collects round-trip times, sizes and decode times of responses,
+        delivered events, reconnections and time spent handling messages
+        and spawning workers. Collects nothing unless configured.
+
+        """
+
+        self.deduplication = None
+        """
+        Cache of recently delivered event keys when deduplication is enabled
+
+        Events delivered again, e.g. resent by the server after
+        a reconnection, are dropped before reaching the channels.
+
+        """
+
+        self.extensions = ExtensionPipeline()
+        """
+        Pipeline of message extensions
+
+        Extensions read and add ``ext`` fields of outgoing and incoming
+        messages. Their hooks are resolved per channel on start.
+
+        """
+
+        self.ack_extension = None
+        """ Ack extension when acknowledging delivered events is enabled """
+
+        self.auth = {}
+        """ Authorisation options """
+
+        self.credentials = Credentials()
+        """
+        Cached authorisation headers
+
+        Headers are built once per login and reused by all requests. If
+        they expire, they are refreshed in the background before they do.
+
+        """
+
+        self.subscription_states = {}
+        """
+        State of each subscription changed at runtime by channel name
+
+        Channels are dropped once unsubscribed.
+
+        """
+
+        self.subscription_errors = {}
+        """ Error of each failed subscription change by channel name """
+
+        self.shutdown_deadline = None
+        """
+        Number of seconds to wait for in-flight event handlers on stop
+
+        Handlers still running after the deadline are stopped and their
+        events reported as undelivered. If None, stop waits for all
+        handlers to complete.
+
+        """
+
+        self._channels = {}
+        self._wildcard_channels = ChannelTrie()
+        self._subscriptions = set()
+        self._subscription_changes = {}
+        self._subscription_changes_sent = {}
+        self._outbound = collections.deque()
+        self._reply_callbacks = {}
+
+    def configure(self, config):
+        """ Set options common to all engines from the ``BAYEUX`` config
+        """
+        self.version = config.get('VERSION', '1.0')
+        self.minimum_version = config.get('MINIMUM_VERSION', '1.0')
+        self.server_uri = config.get('SERVER_URI', 'http://localhost/cometd')
+        self.backoff = Backoff(
+            base=config.get('BACKOFF_BASE', 100),
+            cap=config.get('BACKOFF_CAP', 30000))
+        self.codec = get_codec(config.get('JSON_CODEC', 'json'))
+        self.lazy_events = config.get('LAZY_EVENTS', False)
+        compression = config.get('COMPRESSION', {})
+        self.compression = Compression(
+            encoding=compression.get('REQUEST_ENCODING'),
+            min_size=compression.get('MIN_SIZE', 1024),
+            level=compression.get('LEVEL', 6),
+            accept_encoding=compression.get('ACCEPT_ENCODING'),
+            max_response_size=compression.get('MAX_RESPONSE_SIZE'))
+        self.metrics = self.get_metrics_collector(config.get('METRICS'))
+        dedup = config.get('DEDUP')
+        if dedup:
+            self.deduplication = DeduplicationCache(
+                max_size=dedup.get('MAX_SIZE', 10000),
+                ttl=dedup.get('TTL'))
+        self.auth = config.get('AUTH', {})
+        self.shutdown_deadline = config.get('SHUTDOWN_DEADLINE')
+        if config.get('ACK') and self.ack_extension is None:
+            self.ack_extension = AckExtension()
+            self.register_extension(self.ack_extension)
+
+    def report_undelivered(self, events):
+        """
+        Report events delivered but not handled because the client stopped
+
+        Events are given as ``(channel name, data)`` pairs. Logs a warning
+        per channel and counts them in the ``undelivered_events_total``
+        metric, override to e.g. keep the events for later.
+
+        """
+        counts = collections.Counter(
+            channel_name for channel_name, _ in events)
+        for channel_name, count in sorted(counts.items()):
+            logger.warning(
+                'Stopping with %s undelivered events of channel %s',
+                count, channel_name)
+            self.metrics.increment(
+                'undelivered_events_total', count, channel=channel_name)
+
+    def get_metrics_collector(self, name):
+        """
+        Return metrics collector of the configured name
+
+        Override to plug in a custom collector.
+
+        """
+        return get_collector(name)
+
+    def register_channel(self, channel):
+        self._channels[channel.name] = channel
+
+    def register_extension(self, extension):
+        """ Register a message extension
+
+        Extensions process outgoing messages in the order of registration
+        and incoming messages in the reverse order.
+
+        """
+        self.extensions.register(extension)
+
+    def resolve_extensions(self):
+        """ Resolve hooks of message extensions of registered channels
+        """
+        self.extensions.resolve(self._channels)
+
+    def begin_ack(self, channel_name):
+        """
+        Record an event of the channel as dispatched to a worker
+
+        Returns a function to call once the worker completes, or None
+        if acks are not enabled.
+
+        """
+        if self.ack_extension is None:
+            return None
+        return self.ack_extension.begin()
+
+    def register_event_handler(self, channel_name, callback, subscribe=True):
+        """
+        Register a callback handling events of the given channel
+
+        The channel name can be a wildcard pattern, e.g. ``/foo/*`` matching
+        all channels one segment deeper than ``/foo`` or ``/foo/**``
+        matching all channels under ``/foo``. Callbacks of wildcard channels
+        are given the name of the channel each event was delivered to.
+        Wildcards are only allowed as the last segment of the name.
+
+        If ``subscribe`` is False, the channel is not subscribed to and the
+        callback only handles events of channels subscribed at runtime by
+        ``add_subscription``.
+
+        """
+        validate_pattern(channel_name)
+        channel = self._channels.get(channel_name)
+        if not channel:
+            if is_wildcard(channel_name):
+                channel = channels.WildcardEvent(self, channel_name)
+                self._wildcard_channels.add(channel_name, channel)
+            else:
+                channel = channels.Event(self, channel_name)
+            self.register_channel(channel)
+        channel.register_callback(callback)
+        if subscribe:
+            self._subscriptions.add(channel_name)
+
+    def add_subscription(self, channel_name, callback=None):
+        """
+        Subscribe to a channel while connected
+
+        The subscribe request is sent along with the next connect request.
+        Events of the channel are handled by the callback if given and by
+        callbacks of wildcard channels matching the channel name.
+
+        """
+        validate_pattern(channel_name)
+        if callback is not None:
+            self.register_event_handler(
+                channel_name, callback, subscribe=False)
+        if channel_name in self._subscriptions:
+            return
+        self._subscriptions.add(channel_name)
+        if self._subscription_changes.pop(channel_name, None) is None:
+            self._subscription_changes[channel_name] = True
+            self.subscription_states[channel_name] = SubscriptionState.pending
+        else:
+            # cancels the removal not sent yet
+            self.subscription_states[channel_name] = (
+                SubscriptionState.subscribed)
+
+    def remove_subscription(self, channel_name):
+        """
+        Unsubscribe from a channel while connected
+
+        The unsubscribe request is sent along with the next connect request.
+        Callbacks registered for the channel are kept.
+
+        """
+        if channel_name not in self._subscriptions:
+            return
+        self._subscriptions.discard(channel_name)
+        if self._subscription_changes.pop(channel_name, None) is None:
+            self._subscription_changes[channel_name] = False
+            self.subscription_states[channel_name] = (
+                SubscriptionState.unsubscribing)
+        else:
+            # cancels the subscription not sent yet
+            self.subscription_states.pop(channel_name, None)
+
+    def get_subscription_state(self, channel_name):
+        """ Return state of a subscription changed at runtime or None
+        """
+        return self.subscription_states.get(channel_name)
+
+    def get_subscription_error(self, channel_name):
+        """ Return error of a failed subscription change or None
+        """
+        return self.subscription_errors.get(channel_name)
+
+    def compose_subscriptions(self):
+        """
+        Compose subscribe messages of all subscriptions
+
+        Sent after a handshake, which discards all subscriptions on the
+        server, so that pending removals are complete and pending
+        subscriptions are sent along.
+
+        """
+        for channel_name, subscribe in self._get_subscription_changes():
+            if not subscribe:
+                self.subscription_states.pop(channel_name, None)
+        self._subscription_changes_sent = {
+            channel_name: True for channel_name in self.subscription_states
+            if channel_name in self._subscriptions
+        }
+        return [
+            channels.Subscribe(self).compose(channel_name)
+            for channel_name in self._subscriptions
+        ]
+
+    def compose_subscription_changes(self):
+        """
+        Compose subscribe and unsubscribe messages of subscriptions changed
+        at runtime
+
+        Changes sent before whose responses were lost, e.g. because the
+        request failed, are sent again.
+
+        """
+        changes = self._get_subscription_changes()
+        self._subscription_changes_sent = dict(changes)
+        return [
+            (channels.Subscribe if subscribe else channels.Unsubscribe)(
+                self).compose(channel_name)
+            for channel_name, subscribe in changes
+        ]
+
+    def queue_message(self, message, callback=None):
+        """
+        Queue a message to be sent along with the next connect request
+
+        The message is given a message ID of the client. The callback,
+        if given, is called with the response message, or with a failure
+        response composed by the client if the request failed. Responses
+        of non-meta channels are replies to published events and are not
+        handled by the channel.
+
+        Engines also take an ``urgent`` flag to send queued messages in
+        a separate request straight away.
+
+        """
+        message['id'] = self.get_next_message_id()
+        self._outbound.append(message)
+        if callback is not None:
+            self._reply_callbacks[str(message['id'])] = callback
+
+    def drain_outbound(self):
+        """
+        Return messages to send along with a connect request
+
+        Subscription changes come first, queued messages follow in the order
+        they were queued. Queued messages get the current client ID as they
+        may have been queued before a handshake.
+
+        """
+        messages = self.compose_subscription_changes()
+        while self._outbound:
+            message = self._outbound.popleft()
+            message['clientId'] = self.client_id
+            messages.append(message)
+        return messages
+
+    def fail_replies(self, messages, error):
+        """ Call reply callbacks of messages sent in a failed request
+        """
+        for message in messages:
+            callback = self._reply_callbacks.pop(str(message.get('id')), None)
+            if callback is not None:
+                callback({
+                    'channel': message['channel'],
+                    'id': message['id'],
+                    'successful': False,
+                    'error': error,
+                })
+
+    def _get_subscription_changes(self):
+        changes = dict(self._subscription_changes_sent)
+        changes.update(self._subscription_changes)
+        self._subscription_changes = {}
+        self._subscription_changes_sent = {}
+        return list(changes.items())
+
+    def handle_subscription_response(self, message, subscribe):
+        """
+        Record the result of a subscribe or unsubscribe request
+
+        Returns True if the request changed a subscription at runtime,
+        False if it subscribed to a channel at startup.
+
+        """
+        channel_name = message.get('subscription')
+        if self._subscription_changes_sent.get(channel_name) is not subscribe:
+            return False
+        del self._subscription_changes_sent[channel_name]
+        if channel_name in self._subscription_changes:
+            # changed again meanwhile, the state is set by the next change
+            return True
+        if message['successful']:
+            logger.info(
+                '%s channel %s',
+                'Subscribed to' if subscribe else 'Unsubscribed from',
+                channel_name)
+            self.subscription_errors.pop(channel_name, None)
+            if subscribe:
+                self.subscription_states[channel_name] = (
+                    SubscriptionState.subscribed)
+            else:
+                self.subscription_states.pop(channel_name, None)
+        else:
+            error = message.get('error')
+            logger.warning(
+                'Failed to %s channel %s: %s',
+                'subscribe to' if subscribe else 'unsubscribe from',
+                channel_name, error)
+            self.subscription_states[channel_name] = SubscriptionState.failed
+            self.subscription_errors[channel_name] = error
+            self._subscriptions.discard(channel_name)
+        return True
+
+    def handle(self, messages):
+        """ Handle incoming messages
+
+        Messages are passed through message extensions first, then handled
+        by the channel of the exact name and by all wildcard channels
+        matching the name.
+
+        """
+        for message in messages:
+            if self.extensions:
+                message = self.extensions.incoming(message)
+                if message is None:
+                    continue
+            channel_name = message['channel']
+            if 'successful' in message:
+                callback = self._reply_callbacks.pop(
+                    str(message.get('id')), None)
+                if callback is not None:
+                    callback(message)
+                if not channel_name.startswith('/meta/'):
+                    # reply to a published event, not a delivered one
+                    continue
+            matching_channels = self._match_channels(channel_name)
+            if not matching_channels:
+                logger.warning(
+                    'Unexpected message of channel %s', channel_name)
+            elif not channel_name.startswith('/meta/'):
+                if self.is_duplicate(message):
+                    logger.debug(
+                        'Dropping duplicate event of channel %s',
+                        channel_name)
+                    self.metrics.increment(
+                        'duplicate_events_total', channel=channel_name)
+                    continue
+                self.metrics.increment('events_total', channel=channel_name)
+            for channel in matching_channels:
+                started = time.perf_counter()
+                channel.handle(message)
+                self.metrics.observe(
+                    'channel_handle_duration_seconds',
+                    time.perf_counter() - started, channel=channel.name)
+
+    def is_duplicate(self, message):
+        """ Return True if the event message was delivered before
+        """
+        if self.deduplication is None:
+            return False
+        key = self.get_event_key(message)
+        if key is None:
+            return False
+        return self.deduplication.seen((message['channel'], key))
+
+    def get_event_key(self, message):
+        """
+        Return key identifying the event message or None if there is none
+
+        Events are identified by their replay ID, or by message ID if they
+        have no replay ID. Override to identify events differently.
+
+        """
+        replay_id = self.get_replay_id(message.get('data'))
+        if replay_id is not None:
+            return replay_id
+        return message.get('id')
+
+    def get_replay_id(self, data):
+        """
+        Return replay ID of the event data or None if there is none
+
+        Data may be an ``EventEnvelope`` if events are decoded lazily.
+        Override if the server puts replay IDs elsewhere.
+
+        """
+        if isinstance(data, EventEnvelope):
+            return data.replay_id
+        try:
+            return data['event']['replayId']
+        except (KeyError, TypeError):
+            return None
+
+    def _match_channels(self, channel_name):
+        channel = self._channels.get(channel_name)
+        matching_channels = [] if channel is None else [channel]
+        if self._wildcard_channels and not channel_name.startswith('/meta/'):
+            matching_channels.extend(
+                self._wildcard_channels.match(channel_name))
+        return matching_channels
+
+    @staticmethod
+    def _get_channel_label(messages):
+        return messages[0].get('channel') if messages else None
+
+    @staticmethod
+    def _as_list(messages):
+        if not isinstance(messages, collections.abc.Sequence):
+            messages = [messages]
+        return messages
+
+    def _prepare_outgoing(self, messages):
+        messages = self._as_list(messages)
+        if self.extensions:
+            messages = [
+                message for message in map(self.extensions.outgoing, messages)
+                if message is not None
+            ]
+        return messages
+
+    def _encode_request(self, messages_out):
+        """ Return body and headers of a request posting the messages """
+        body = self.codec.dumps(messages_out)
+        headers = {
+            'Content-Type': 'application/json',
+        }
+        headers.update(self.compression.get_headers(body))
+        headers.update(self._get_authorisation_headers())
+        body = self.compression.compress(body)
+        self.metrics.observe('request_size_bytes', len(body))
+        return body, headers
+
+    def _get_authorisation_headers(self):
+        if self.credentials.headers is None:
+            self.credentials.set(self._build_authorisation_headers())
+        return self.credentials.headers
+
+    def _build_authorisation_headers(self):
+        auth_schema, auth_param = self.get_authorisation()
+        if auth_schema and auth_param:
+            return {
+                'Authorization': '{} {}'.format(auth_schema, auth_param)
+            }
+        return {}
+
+    def _set_credentials(self):
+        self.credentials.set(
+            self._build_authorisation_headers(),
+            self.get_authorisation_ttl())
+
+    def _credentials_rejected(self, status):
+        if status in (401, 403):
+            logger.warning(
+                'Authorisation rejected by Bayeux server (HTTP %s)', status)
+            self.credentials.invalidate()
+            self.reconnection = Reconnection.handshake
+
+    def _get_refresh_delay(self):
+        return self.credentials.get_refresh_delay(
+            self.auth.get('REFRESH_MARGIN', 60))
+
+    def login(self):
+        """
+        Log in and set authentication data
+
+        Called before a handshake unless cached authorisation headers are
+        still valid, and before the headers expire. Override if
+        authentication is required.
+
+        """
+
+    def get_authorisation_ttl(self):
+        """
+        Return number of seconds authorisation stays valid after login
+
+        Returns None if it does not expire. Override if the lifetime
+        is only known after login.
+
+        """
+        return self.auth.get('TTL')
+
+    def get_authorisation(self):
+        """
+        Return schema and param of HTTP Authorization header
+
+        Override if authentication is required.
+
+        """
+        return None, None
+
+    def get_next_message_id(self):
+        self.message_id += 1
+        return self.message_id
+
+    def _register_meta_channels(self):
+        self.register_channel(channels.Handshake(self))
+        self.register_channel(channels.Connect(self))
+        self.register_channel(channels.Disconnect(self))
+        self.register_channel(channels.Subscribe(self))
+        self.register_channel(channels.Unsubscribe(self))
+
+    def decode(self, content):
+        """ Decode response messages from the response body """
+        self.metrics.observe('response_size_bytes', len(content))
+
+        started = time.perf_counter()
+        if self.lazy_events:
+            splitter = ArraySplitter(members=True)
+            messages_in = [
+                self.load_message(item) for item in splitter.feed(content)]
+            splitter.close()
+        else:
+            messages_in = self.codec.loads(content)
+        self.metrics.observe(
+            'decode_duration_seconds', time.perf_counter() - started)
+
+        logger.debug('Received Bayeux messages %s', messages_in)
+
+        return messages_in
+
+    def load_message(self, item):
+        """
+        Decode a raw response message split from the response body
+
+        If events are decoded lazily, the item comes with its raw members
+        and data of an event message are wrapped in an ``EventEnvelope``
+        left undecoded.
+
+        """
+        if not self.lazy_events:
+            return self.codec.loads(item)
+        raw, members = item
+        if members is None:
+            return self.codec.loads(raw)
+        loads = self.codec.loads
+        message = {
+            name: loads(value) for name, value in members if name != 'data'}
+        for name, value in members:
+            if name == 'data':
+                message['data'] = EventEnvelope(
+                    message.get('channel'), message.get('id'), value, loads)
+        return message
+
+    def connection_failed(self):
+        """ Record a failure of the connection loop """
+        self.metrics.increment(
+            'reconnects_total', reconnection=self.reconnection.value)
+        self.backoff.failed()
+        logger.warning(
+            'Need to reconnect to Bayeux server '
+            '(consecutive failures: %s) ...',
+            self.backoff.failures, exc_info=True)
+
+    def connection_succeeded(self):
+        """ Record a successful round of the connection loop """
+        if self.backoff.failures:
+            logger.info(
+                'Reconnected to Bayeux server after %s failures',
+                self.backoff.failures)
+        self.backoff.succeeded()
+
+    def get_reconnect_delay(self):
+        """ Return number of seconds to wait before the next connect """
+        delay = self.backoff.get_delay(floor=self.interval)
+        return delay * 10 ** -3  # from milliseconds
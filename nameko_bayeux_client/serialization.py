@@ -0,0 +1,95 @@
+import functools
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class JsonCodec:
+    """
+    Standard library JSON codec
+
+    Codecs encode messages straight to bytes ready to be posted and decode
+    messages from bytes as received from the server.
+
+    """
+
+    name = 'json'
+
+    def dumps(self, messages):
+        """ Encode messages to JSON bytes """
+        return json.dumps(messages).encode('utf-8')
+
+    def loads(self, data):
+        """ Decode messages from JSON bytes """
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """ Codec using orjson which encodes to bytes natively """
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.dumps = orjson.dumps  # pylint: disable=no-member
+        self.loads = orjson.loads  # pylint: disable=no-member
+
+
+class UjsonCodec(JsonCodec):
+    """ Codec using ujson """
+
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._dumps = functools.partial(
+            ujson.dumps, escape_forward_slashes=False)
+        self.loads = ujson.loads
+
+    def dumps(self, messages):
+        return self._dumps(messages).encode('utf-8')
+
+
+class RapidjsonCodec(JsonCodec):
+    """ Codec using python-rapidjson """
+
+    name = 'rapidjson'
+
+    def __init__(self):
+        import rapidjson
+        self._dumps = rapidjson.dumps
+        self.loads = rapidjson.loads
+
+    def dumps(self, messages):
+        return self._dumps(messages).encode('utf-8')
+
+
+CODECS = {
+    codec.name: codec
+    for codec in (JsonCodec, OrjsonCodec, UjsonCodec, RapidjsonCodec)
+}
+
+
+def get_codec(name):
+    """
+    Return JSON codec instance of the given name
+
+    Falls back to the standard library codec if the library backing
+    the requested codec is not installed.
+
+    """
+    try:
+        codec_class = CODECS[name]
+    except KeyError:
+        raise ValueError(
+            'Unknown JSON codec {}, choose one of: {}'
+            .format(name, ', '.join(sorted(CODECS))))
+    try:
+        return codec_class()
+    except ImportError:
+        logger.warning(
+            'JSON codec %s is not installed, falling back to %s',
+            name, JsonCodec.name)
+        return JsonCodec()
@@ -0,0 +1,75 @@
+import socket
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+
+TCP_KEEPALIVE_OPTIONS = (
+    # (config key, option name on Linux, option name on macOS)
+    ('IDLE', 'TCP_KEEPIDLE', 'TCP_KEEPALIVE'),
+    ('INTERVAL', 'TCP_KEEPINTVL', 'TCP_KEEPINTVL'),
+    ('COUNT', 'TCP_KEEPCNT', 'TCP_KEEPCNT'),
+)
+
+
+class SessionAdapter(HTTPAdapter):
+    """
+    HTTP adapter setting socket options of pooled connections
+    """
+
+    def __init__(self, socket_options=None, **kwargs):
+        self.socket_options = socket_options
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+def get_socket_options(tcp_keepalive):
+    """
+    Return socket options of pooled connections
+
+    Returns None to keep the defaults if TCP keepalive is not enabled.
+    Keepalive timing options not supported by the platform are skipped.
+
+    """
+    if not tcp_keepalive:
+        return None
+    socket_options = list(HTTPConnection.default_socket_options)
+    socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    if isinstance(tcp_keepalive, dict):
+        for key, linux_name, macos_name in TCP_KEEPALIVE_OPTIONS:
+            value = tcp_keepalive.get(key)
+            option = getattr(
+                socket, linux_name, getattr(socket, macos_name, None))
+            if value is not None and option is not None:
+                socket_options.append((socket.IPPROTO_TCP, option, value))
+    return socket_options
+
+
+def configure_session(session, options):
+    """
+    Configure connection pooling, keep-alive and retries of the session
+
+    Only failures to establish a connection are retried as nothing was
+    sent to the server then.
+
+    """
+    retries = options.get('RETRIES', 0)
+    adapter = SessionAdapter(
+        socket_options=get_socket_options(options.get('TCP_KEEPALIVE')),
+        pool_connections=1,
+        pool_maxsize=options.get('POOL_SIZE', 10),
+        pool_block=options.get('POOL_BLOCK', False),
+        max_retries=Retry(
+            total=retries, connect=retries, read=0, redirect=0, status=0,
+            backoff_factor=options.get('RETRY_BACKOFF_FACTOR', 0),
+            raise_on_status=False))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not options.get('KEEP_ALIVE', True):
+        session.headers['Connection'] = 'close'
+    return session
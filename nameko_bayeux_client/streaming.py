@@ -0,0 +1,196 @@
+import json
+import re
+
+
+class ArraySplitter:
+    """
+    Incremental splitter of a JSON array into raw item slices
+
+    Bayeux responses are JSON arrays of messages. The splitter is fed with
+    chunks of the response body as they arrive and returns raw bytes of
+    each top-level array item as soon as the item is complete, without
+    decoding anything.
+
+    The scanning only looks at structural characters (brackets, braces,
+    commas and string quotes), everything else is skipped by the regular
+    expression engine.
+
+    If ``members`` is True, each item is returned along with raw members
+    of the item found while scanning it: a list of ``(name, value)`` pairs
+    of raw value bytes if the item is an object, or None if it is not.
+    Values can then be decoded selectively.
+
+    """
+
+    _structural = re.compile(rb'[\[\]{},"]')
+    _string_special = re.compile(rb'["\\]')
+
+    def __init__(self, members=False):
+        self.members = members
+        self.buffer = bytearray()
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.item_start = None
+        self.finished = False
+        self._member_starts = None
+        self._members_end = None
+
+    def feed(self, chunk):
+        """
+        Feed a chunk of the array and return a list of completed items
+
+        """
+        if self.finished:
+            if chunk.strip():
+                raise ValueError('Unexpected data after the end of array')
+            return []
+
+        buffer = self.buffer
+        buffer += chunk
+        position = self.position
+        items = []
+
+        while True:
+
+            if self.in_string:
+                match = self._string_special.search(buffer, position)
+                if match is None:
+                    position = len(buffer)
+                    break
+                if buffer[match.start()] == 0x5c:  # backslash
+                    if match.end() == len(buffer):
+                        # the escaped character is not here yet,
+                        # rescan the backslash with the next chunk
+                        position = match.start()
+                        break
+                    position = match.end() + 1
+                else:
+                    position = match.end()
+                    self.in_string = False
+                continue
+
+            match = self._structural.search(buffer, position)
+            if match is None:
+                position = len(buffer)
+                break
+            position = match.end()
+            char = buffer[match.start()]
+
+            if self.depth == 0 and char != 0x5b:  # opening bracket
+                raise ValueError('Expected a JSON array')
+
+            if char == 0x22:  # double quote
+                self.in_string = True
+            elif char in b'[{':
+                self.depth += 1
+                if self.depth == 1:
+                    self.item_start = position
+                elif self.depth == 2 and self.members and char == 0x7b:
+                    # opening brace of an object item
+                    self._member_starts = [position - self.item_start]
+            elif char in b']}':
+                self.depth -= 1
+                if self.depth == 1 and self._member_starts is not None:
+                    self._members_end = match.start() - self.item_start
+                elif self.depth == 0:
+                    self._append_item(items, match.start())
+                    self.finished = True
+                    if buffer[position:].strip():
+                        raise ValueError(
+                            'Unexpected data after the end of array')
+                    break
+            elif self.depth == 1:  # comma separating top-level items
+                self._append_item(items, match.start())
+                self.item_start = position
+            elif self.depth == 2 and self._member_starts is not None:
+                # comma separating members of an object item
+                self._member_starts.append(position - self.item_start)
+
+        # drop consumed data so the buffer holds one incomplete item at most
+        if self.finished:
+            consumed = position = len(buffer)
+        elif self.item_start is None:
+            consumed = position
+        else:
+            consumed = self.item_start
+        del buffer[:consumed]
+        self.position = position - consumed
+        if self.item_start is not None:
+            self.item_start -= consumed
+
+        return items
+
+    def close(self):
+        """ Check that the whole array was fed in
+        """
+        if not self.finished:
+            raise ValueError('Incomplete JSON array')
+
+    def _append_item(self, items, end):
+        raw = bytes(self.buffer[self.item_start:end])
+        item = raw.strip()
+        if not self.members:
+            if item:
+                items.append(item)
+            return
+        starts, self._member_starts = self._member_starts, None
+        if not item:
+            return
+        if starts is None:
+            items.append((item, None))
+            return
+        ends = [start - 1 for start in starts[1:]] + [self._members_end]
+        members = [
+            _split_member(raw[start:end])
+            for start, end in zip(starts, ends)
+            if raw[start:end].strip()
+        ]
+        items.append((item, members))
+
+
+def _split_member(raw):
+    # a member is a string name followed by a colon and a value
+    name_start = raw.index(b'"') + 1
+    position = name_start
+    while True:
+        match = ArraySplitter._string_special.search(raw, position)
+        if raw[match.start()] == 0x22:  # double quote
+            break
+        position = match.end() + 1
+    name = raw[name_start:match.start()]
+    if b'\\' in name:
+        name = json.loads(raw[name_start - 1:match.end()])
+    else:
+        name = name.decode('utf-8')
+    value = raw[raw.index(b':', match.end()) + 1:].strip()
+    return name, value
+
+
+def split_object(raw):
+    """
+    Return a dict of raw member values of a JSON object by member name
+
+    Returns None if the JSON value is not an object.
+
+    """
+    splitter = ArraySplitter(members=True)
+    splitter.feed(b'[')
+    ((_, members),) = splitter.feed(raw + b']')
+    if members is None:
+        return None
+    return dict(members)
+
+
+def iter_array_items(chunks, members=False):
+    """
+    Iterate over raw items of a JSON array streamed in chunks
+
+    Items are yielded as soon as they are complete, along with their raw
+    members if ``members`` is True (see ``ArraySplitter``).
+
+    """
+    splitter = ArraySplitter(members)
+    for chunk in chunks:
+        yield from splitter.feed(chunk)
+    splitter.close()
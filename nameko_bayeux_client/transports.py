@@ -0,0 +1,79 @@
+import logging
+
+from nameko_bayeux_client.exceptions import Reconnect
+
+try:
+    import websocket
+except ImportError:  # pragma: no cover
+    websocket = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class WebSocketTransport:
+    """
+    WebSocket transport
+
+    Carries Bayeux messages over one persistent WebSocket connection
+    instead of posting a new HTTP request for each exchange.
+
+    """
+
+    def __init__(self, uri, codec):
+        self.uri = uri
+        self.codec = codec
+        self.connection = None
+
+    @staticmethod
+    def is_available():
+        """ Return whether the WebSocket client library is installed """
+        return websocket is not None
+
+    def open(self, headers, timeout):
+        """ Open the WebSocket connection """
+        try:
+            self.connection = websocket.create_connection(
+                self.uri, timeout=timeout, header=headers)
+        except (websocket.WebSocketException, OSError) as exc:
+            raise Reconnect(
+                'Failed to open WebSocket connection to Bayeux server'
+            ) from exc
+        logger.info('Opened WebSocket connection to %s', self.uri)
+
+    def close(self):
+        """ Close the WebSocket connection """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def send_and_receive(self, messages_out):
+        """
+        Send request messages and receive response messages
+
+        Receives frames until all meta request messages sent are responded,
+        event messages delivered in the meantime are returned as well.
+
+        """
+        expected_ids = {
+            str(message['id']) for message in messages_out
+            if 'id' in message
+        }
+        messages_in = []
+        try:
+            self.connection.send(self.codec.dumps(messages_out))
+            while expected_ids:
+                opcode, data = self.connection.recv_data()
+                if opcode == websocket.ABNF.OPCODE_CLOSE:
+                    raise websocket.WebSocketConnectionClosedException(
+                        'Connection closed by Bayeux server')
+                for message in self.codec.loads(data):
+                    if message.get('channel', '').startswith('/meta/'):
+                        expected_ids.discard(str(message.get('id')))
+                    messages_in.append(message)
+        except (websocket.WebSocketException, OSError) as exc:
+            self.close()
+            raise Reconnect(
+                'Failed to exchange messages over WebSocket'
+            ) from exc
+        return messages_in
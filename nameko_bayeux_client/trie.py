@@ -0,0 +1,95 @@
+SINGLE_SEGMENT_WILDCARD = '*'
+"""
+Wildcard matching exactly one channel segment
+
+E.g. ``/foo/*`` matches ``/foo/bar`` but does not match ``/foo/bar/baz``.
+
+"""
+
+MULTI_SEGMENT_WILDCARD = '**'
+"""
+Wildcard matching one or more channel segments
+
+E.g. ``/foo/**`` matches both ``/foo/bar`` and ``/foo/bar/baz``.
+
+"""
+
+WILDCARDS = (SINGLE_SEGMENT_WILDCARD, MULTI_SEGMENT_WILDCARD)
+
+
+def split(channel_name):
+    return channel_name.strip('/').split('/')
+
+
+def is_wildcard(channel_name):
+    """ Return whether the channel name is a wildcard pattern """
+    return split(channel_name)[-1] in WILDCARDS
+
+
+def validate_pattern(pattern):
+    """ Raise ValueError if a wildcard is not the last segment of pattern
+    """
+    if any(segment in WILDCARDS for segment in split(pattern)[:-1]):
+        raise ValueError(
+            'Wildcard is allowed as the last segment only: {}'
+            .format(pattern))
+
+
+class Node:
+
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class ChannelTrie:
+    """
+    Segment trie of channel name patterns
+
+    Looking up values of patterns matching a channel name takes one step
+    per channel name segment no matter how many patterns are stored.
+
+    Wildcards are only allowed as the last segment of a pattern.
+
+    """
+
+    def __init__(self):
+        self.root = Node()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, pattern, value):
+        """ Add a value stored under the channel name pattern """
+        validate_pattern(pattern)
+        node = self.root
+        for segment in split(pattern):
+            node = node.children.setdefault(segment, Node())
+        node.values.append(value)
+        self.size += 1
+
+    def match(self, channel_name):
+        """ Return values stored under patterns matching the channel name
+        """
+        segments = split(channel_name)
+        last = len(segments) - 1
+        matches = []
+        node = self.root
+        for index, segment in enumerate(segments):
+            children = node.children
+            multi = children.get(MULTI_SEGMENT_WILDCARD)
+            if multi is not None:
+                matches.extend(multi.values)
+            if index == last:
+                single = children.get(SINGLE_SEGMENT_WILDCARD)
+                if single is not None:
+                    matches.extend(single.values)
+            node = children.get(segment)
+            if node is None:
+                break
+        else:
+            matches.extend(node.values)
+        return matches
@@ -9,18 +9,29 @@ setup(
     ),
     author='Student.com',
     url='http://github.com/nameko/nameko-bayeux-client',
-    packages=find_packages(exclude=['test', 'test.*']),
+    packages=find_packages(exclude=['test', 'test.*', 'benchmarks', 'benchmarks.*']),
     install_requires=[
         "nameko>=2.8.5",
     ],
     extras_require={
         'dev': [
+            "aiohttp",
             "coverage",
             "flake8",
+            "orjson",
             "pylint",
             "pytest",
+            "python-rapidjson",
             "requests-mock",
-        ]
+            "ujson",
+            "websocket-client",
+        ],
+        'asyncio': ["aiohttp"],
+        'brotli': ["brotli"],
+        'orjson': ["orjson"],
+        'rapidjson': ["python-rapidjson"],
+        'ujson': ["ujson"],
+        'websocket': ["websocket-client"],
     },
     dependency_links=[],
     zip_safe=True,
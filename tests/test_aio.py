@@ -0,0 +1,416 @@
+import asyncio
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+from nameko.testing.utils import find_free_port  # noqa: E402
+
+from nameko_bayeux_client.aio import AsyncBayeuxClient  # noqa: E402
+from nameko_bayeux_client.exceptions import (  # noqa: E402
+    Reconnect, ResponseTooLarge)
+from nameko_bayeux_client.metrics import InMemoryCollector  # noqa: E402
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+class CometdApp:
+    """ Bayeux server delivering queued events on connect """
+
+    def __init__(self):
+        self.requests = []
+        self.events = asyncio.Queue()
+        self.status = 200
+
+    async def handle(self, request):
+        messages = await request.json()
+        self.requests.append((request, messages))
+        if self.status != 200:
+            return web.Response(status=self.status)
+        messages_in = []
+        for message in messages:
+            channel_name = message['channel']
+            messages_in.append({
+                'channel': channel_name,
+                'id': message.get('id'),
+                'clientId': 'client-id',
+                'supportedConnectionTypes': ['long-polling'],
+                'successful': True,
+                'advice': {'reconnect': 'retry'},
+            })
+            if channel_name == '/meta/connect':
+                # long poll for an event
+                try:
+                    messages_in.append(
+                        await asyncio.wait_for(self.events.get(), 0.05))
+                except asyncio.TimeoutError:
+                    pass
+        return web.json_response(messages_in)
+
+
+@pytest.fixture
+def app():
+    return CometdApp()
+
+
+@pytest.fixture
+def server(loop, app):
+    web_app = web.Application()
+    web_app.router.add_post('/cometd', app.handle)
+    server = TestServer(web_app)
+    loop.run_until_complete(server.start_server())
+    yield server
+    loop.run_until_complete(server.close())
+
+
+@pytest.fixture
+def client(loop, server):
+    client = AsyncBayeuxClient(
+        {'SERVER_URI': str(server.make_url('/cometd'))})
+    yield client
+    if client.session is not None:
+        loop.run_until_complete(client.session.close())
+
+
+def test_deliver_events(loop, app, client):
+
+    delivered = asyncio.Queue()
+
+    async def handle_event(data):
+        await delivered.put(data)
+
+    async def run():
+        client.register_event_handler('/topic/a', handle_event)
+        await client.start()
+        await app.events.put({'channel': '/topic/a', 'data': 'spam'})
+        data = await asyncio.wait_for(delivered.get(), 5)
+        await client.stop()
+        return data
+
+    assert loop.run_until_complete(run()) == 'spam'
+    channel_names = [
+        [message['channel'] for message in messages]
+        for _, messages in app.requests
+    ]
+    assert channel_names[:3] == [
+        ['/meta/handshake'], ['/meta/subscribe'], ['/meta/connect']]
+    assert channel_names[-1] == ['/meta/disconnect']
+    assert client.session.closed
+
+
+def test_handler_failure_is_logged(loop, app, client, caplog):
+
+    handled = asyncio.Event()
+
+    async def handle_event(data):
+        handled.set()
+        raise ValueError(data)
+
+    async def run():
+        client.register_event_handler('/topic/a', handle_event)
+        await client.start()
+        await app.events.put({'channel': '/topic/a', 'data': 'spam'})
+        await asyncio.wait_for(handled.wait(), 5)
+        await client.stop()
+
+    loop.run_until_complete(run())
+    assert 'Event handler failed' in caplog.text
+
+
+def test_stop_waits_for_handlers(loop, app, client):
+
+    handled = []
+    started = asyncio.Event()
+
+    async def handle_event(data):
+        started.set()
+        await asyncio.sleep(0.05)
+        handled.append(data)
+
+    async def run():
+        client.register_event_handler('/topic/a', handle_event)
+        await client.start()
+        await app.events.put({'channel': '/topic/a', 'data': 'spam'})
+        await asyncio.wait_for(started.wait(), 5)
+        await client.stop()
+
+    loop.run_until_complete(run())
+    assert handled == ['spam']
+
+
+def test_stop_deadline(loop, app, server, caplog):
+    client = AsyncBayeuxClient({
+        'SERVER_URI': str(server.make_url('/cometd')),
+        'SHUTDOWN_DEADLINE': 0.05,
+    })
+    started = asyncio.Event()
+    completed = []
+
+    async def handle_event(data, channel_name):
+        started.set()
+        await asyncio.sleep(60)
+        completed.append(data)
+
+    async def run():
+        client.register_event_handler('/topic/*', handle_event)
+        await client.start()
+        await app.events.put({'channel': '/topic/a', 'data': 'spam'})
+        await asyncio.wait_for(started.wait(), 5)
+        await asyncio.wait_for(client.stop(), 5)
+
+    loop.run_until_complete(run())
+    assert completed == []
+    assert (
+        'Stopping with 1 undelivered events of channel /topic/a'
+        in caplog.text)
+    assert client._task_events == {}
+
+
+def test_ack_after_handler_completes(loop, app, server):
+    client = AsyncBayeuxClient({
+        'SERVER_URI': str(server.make_url('/cometd')),
+        'ACK': True,
+    })
+    completed = []
+
+    async def handle_event(data):
+        completed.append(data)
+
+    async def run():
+        client.register_event_handler('/topic/a', handle_event)
+        await client.start()
+        await app.events.put({'channel': '/topic/a', 'data': 'spam'})
+        while not completed:
+            await asyncio.sleep(0.01)
+        await client.stop()
+
+    loop.run_until_complete(run())
+    assert [
+        batch.pending for batch in client.ack_extension._batches] == [0]
+
+
+def test_stop_logs_failed_disconnect(loop, app, client, caplog):
+
+    async def run():
+        await client.start()
+        app.status = 500
+        await client.stop()
+
+    loop.run_until_complete(run())
+    assert 'Failed to disconnect client ID' in caplog.text
+
+
+def test_login_and_authorisation(loop, app, client):
+
+    class Client(AsyncBayeuxClient):
+
+        async def login(self):
+            await asyncio.sleep(0)
+            self.token = 'secret'
+
+        def get_authorisation(self):
+            return 'Bearer', self.token
+
+    client = Client({'SERVER_URI': client.server_uri})
+    client._register_meta_channels()
+
+    async def run():
+        client.session = aiohttp.ClientSession()
+        try:
+            await client.handshake()
+        finally:
+            await client.session.close()
+
+    loop.run_until_complete(run())
+    request, _ = app.requests[0]
+    assert request.headers['Authorization'] == 'Bearer secret'
+
+
+def test_refresh_authorisation(loop, app, server, caplog):
+
+    class Client(AsyncBayeuxClient):
+
+        logins = 0
+
+        async def login(self):
+            self.logins += 1
+            if self.logins == 2:
+                raise ValueError('Boom')
+
+        def get_authorisation(self):
+            return 'Bearer', 'token-{}'.format(self.logins)
+
+    client = Client({
+        'SERVER_URI': str(server.make_url('/cometd')),
+        'AUTH': {'TTL': 0.05, 'REFRESH_MARGIN': 0.04, 'RETRY_DELAY': 0},
+    })
+
+    async def run():
+        await client.start()
+        while client.logins < 3:
+            await asyncio.sleep(0.01)
+        refresher = client._refresher
+        await client.stop()
+        return refresher
+
+    refresher = loop.run_until_complete(run())
+    assert refresher.cancelled()
+    assert 'Failed to refresh authorisation' in caplog.text
+    request, _ = app.requests[0]
+    assert request.headers['Authorization'] == 'Bearer token-1'
+
+
+def test_refresh_ends_when_authorisation_does_not_expire(loop, client):
+    client.auth = {'TTL': 0, 'REFRESH_MARGIN': 0}
+
+    async def run():
+        await client.authorise()
+        client.auth = {}
+        await client._refresher
+
+    loop.run_until_complete(run())
+    assert client._refresher is None
+    assert client.credentials.expires_at is None
+
+
+def test_rejected_authorisation_is_invalidated(loop, app, client):
+    app.status = 401
+    client.credentials.set({'Authorization': 'Bearer token'})
+
+    async def run():
+        client.session = aiohttp.ClientSession()
+        await client.send_and_receive({'channel': '/meta/connect'})
+
+    with pytest.raises(Reconnect):
+        loop.run_until_complete(run())
+    assert not client.credentials.valid
+
+
+def test_send_and_receive(loop, app, client):
+    client.metrics = InMemoryCollector()
+
+    async def run():
+        client.session = aiohttp.ClientSession()
+        return await client.send_and_receive(
+            {'channel': '/meta/handshake'})
+
+    assert loop.run_until_complete(run())[0]['clientId'] == 'client-id'
+    request, messages = app.requests[0]
+    assert messages == [{'channel': '/meta/handshake'}]
+    assert request.headers['Content-Type'] == 'application/json'
+    assert client.metrics.get_histogram(
+        'request_duration_seconds', channel='/meta/handshake').count == 1
+    assert client.metrics.get_histogram('response_size_bytes').count == 1
+
+
+def test_send_and_receive_http_error(loop, app, client):
+    app.status = 503
+
+    async def run():
+        client.session = aiohttp.ClientSession()
+        await client.send_and_receive({'channel': '/meta/handshake'})
+
+    with pytest.raises(Reconnect) as exc:
+        loop.run_until_complete(run())
+    assert str(exc.value) == (
+        'Failed to post request messages to Bayeux server')
+
+
+def test_send_and_receive_connection_error(loop, client):
+    client.server_uri = 'http://127.0.0.1:{}/cometd'.format(find_free_port())
+
+    async def run():
+        client.session = aiohttp.ClientSession()
+        await client.send_and_receive({'channel': '/meta/handshake'})
+
+    with pytest.raises(Reconnect):
+        loop.run_until_complete(run())
+
+
+def test_send_and_receive_timeout(loop, client):
+    client.timeout = 0.01
+
+    async def run():
+        client.session = aiohttp.ClientSession()
+        await client.send_and_receive({'channel': '/meta/connect'})
+
+    with pytest.raises(Reconnect) as exc:
+        loop.run_until_complete(run())
+    assert str(exc.value) == 'Request to Bayeux server timed out'
+
+
+def test_compression(loop, app, server):
+    client = AsyncBayeuxClient({
+        'SERVER_URI': str(server.make_url('/cometd')),
+        'COMPRESSION': {
+            'REQUEST_ENCODING': 'gzip',
+            'MIN_SIZE': 0,
+            'ACCEPT_ENCODING': ['gzip'],
+            'MAX_RESPONSE_SIZE': 1000,
+        },
+    })
+
+    async def run():
+        client.session = aiohttp.ClientSession()
+        try:
+            return await client.send_and_receive(
+                {'channel': '/meta/handshake'})
+        finally:
+            await client.session.close()
+
+    assert loop.run_until_complete(run())[0]['clientId'] == 'client-id'
+    # the test server decompresses the request body
+    request, messages = app.requests[0]
+    assert messages == [{'channel': '/meta/handshake'}]
+    assert request.headers['Content-Encoding'] == 'gzip'
+    assert request.headers['Accept-Encoding'] == 'gzip'
+
+
+def test_response_too_large(loop, app, client):
+    client.compression.max_response_size = 10
+
+    async def run():
+        client.session = aiohttp.ClientSession()
+        await client.send_and_receive({'channel': '/meta/handshake'})
+
+    with pytest.raises(ResponseTooLarge) as exc:
+        loop.run_until_complete(run())
+    assert str(exc.value) == 'Response of Bayeux server exceeds 10 bytes'
+
+
+def test_urgent_message(loop, app, client):
+
+    replied = asyncio.Event()
+    replies = []
+
+    def handle_reply(message):
+        replies.append(message)
+        replied.set()
+
+    async def run():
+        await client.start()
+        while client.client_id is None:
+            await asyncio.sleep(0.01)
+        client.queue_message(
+            {'channel': '/topic/a', 'data': 'spam'}, handle_reply,
+            urgent=True)
+        await asyncio.wait_for(replied.wait(), 5)
+        await client.stop()
+
+    loop.run_until_complete(run())
+    assert replies[0]['successful'] is True
+    published = [
+        messages for _, messages in app.requests
+        if messages and messages[0]['channel'] == '/topic/a'
+    ]
+    assert published == [[{
+        'channel': '/topic/a', 'data': 'spam', 'id': replies[0]['id'],
+        'clientId': 'client-id',
+    }]]
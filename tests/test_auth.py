@@ -0,0 +1,42 @@
+from mock import patch
+
+from nameko_bayeux_client.auth import Credentials
+
+
+def test_no_credentials():
+    credentials = Credentials()
+    assert not credentials.valid
+    assert credentials.get_refresh_delay(60) is None
+
+
+def test_credentials_not_expiring():
+    credentials = Credentials()
+    credentials.set({'Authorization': 'Bearer token'})
+    assert credentials.valid
+    assert credentials.get_refresh_delay(60) is None
+
+
+@patch('nameko_bayeux_client.auth.time.monotonic')
+def test_credentials_expiring(monotonic):
+    credentials = Credentials()
+    monotonic.return_value = 100
+    credentials.set({}, ttl=300)
+    assert credentials.expires_at == 400
+    assert credentials.valid
+    assert credentials.get_refresh_delay(60) == 240
+
+    monotonic.return_value = 380
+    assert credentials.valid
+    assert credentials.get_refresh_delay(60) == 0
+
+    monotonic.return_value = 400
+    assert not credentials.valid
+
+
+def test_invalidate():
+    credentials = Credentials()
+    credentials.set({'Authorization': 'Bearer token'}, ttl=300)
+    credentials.invalidate()
+    assert credentials.headers is None
+    assert credentials.expires_at is None
+    assert not credentials.valid
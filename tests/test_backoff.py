@@ -0,0 +1,84 @@
+from mock import patch
+import pytest
+
+from nameko_bayeux_client.backoff import Backoff
+
+
+@pytest.fixture
+def uniform():
+    with patch('nameko_bayeux_client.backoff.random.uniform') as uniform:
+        uniform.side_effect = lambda low, high: high
+        yield uniform
+
+
+@pytest.fixture
+def monotonic():
+    with patch('nameko_bayeux_client.backoff.time.monotonic') as monotonic:
+        yield monotonic
+
+
+def test_no_delay_without_failures(uniform):
+    backoff = Backoff(base=100, cap=1000)
+    assert backoff.get_delay() == 0
+    assert backoff.get_delay(floor=5) == 5
+    assert uniform.call_count == 0
+
+
+def test_exponential_delay_ceiling(uniform):
+    backoff = Backoff(base=100, cap=1000)
+    delays = []
+    for _ in range(6):
+        backoff.failed()
+        delays.append(backoff.get_delay())
+    assert delays == [100, 200, 400, 800, 1000, 1000]
+
+
+def test_full_jitter(uniform):
+    uniform.side_effect = None
+    uniform.return_value = 42
+    backoff = Backoff(base=100, cap=1000)
+    backoff.failed()
+    backoff.failed()
+    assert backoff.get_delay() == 42
+    assert uniform.call_args[0] == (0, 200)
+
+
+def test_floor(uniform):
+    uniform.side_effect = None
+    uniform.return_value = 42
+    backoff = Backoff(base=100, cap=1000)
+    backoff.failed()
+    assert backoff.get_delay(floor=50) == 50
+    assert backoff.get_delay(floor=10) == 42
+
+
+def test_ceiling_of_many_failures(uniform):
+    backoff = Backoff(base=100, cap=1000)
+    backoff.failures = 10000
+    assert backoff.get_delay() == 1000
+
+
+def test_failures_tracking(monotonic):
+    backoff = Backoff()
+
+    monotonic.return_value = 10
+    backoff.failed()
+    monotonic.return_value = 12
+    backoff.failed()
+    backoff.failed()
+
+    assert backoff.failures == 3
+    assert backoff.failing_since == 10
+    assert backoff.last_failures == 0
+    assert backoff.last_outage is None
+
+    monotonic.return_value = 15.5
+    backoff.succeeded()
+
+    assert backoff.failures == 0
+    assert backoff.failing_since is None
+    assert backoff.last_failures == 3
+    assert backoff.last_outage == 5.5
+
+    backoff.succeeded()
+    assert backoff.last_failures == 3
@@ -0,0 +1,40 @@
+import pytest
+
+from benchmarks.run import (
+    format_results,
+    parse_args,
+    parse_config,
+    percentile,
+    run_benchmark,
+)
+
+
+def test_run_benchmark():
+    results = run_benchmark(
+        rate=0, batch_size=10, payload_size=10, duration=0.3, warmup=0.1,
+        channel_count=2, bayeux_config={'JSON_CODEC': 'json'})
+    assert results['events'] > 0
+    assert results['throughput'] > 0
+    assert 0 < results['latency_p50'] <= results['latency_p99']
+    assert results['max_rss'] > 0
+    assert 'throughput:' in format_results(results)
+
+
+@pytest.mark.parametrize(('percent', 'expected'), (
+    (0, 1), (50, 3), (99, 5), (100, 5),
+))
+def test_percentile(percent, expected):
+    assert percentile([1, 2, 3, 4, 5], percent) == expected
+
+
+def test_percentile_of_nothing():
+    assert percentile([], 50) is None
+
+
+def test_parse_args():
+    args = parse_args([
+        '--rate', '500', '--config', 'JSON_CODEC="orjson"',
+        '--config', 'STREAM_RESPONSES=true'])
+    assert args.rate == 500
+    assert parse_config(args.config) == {
+        'JSON_CODEC': 'orjson', 'STREAM_RESPONSES': True}
@@ -8,7 +8,9 @@ class TestChannel:
 
     @pytest.fixture
     def client(self):
-        return Mock()
+        return Mock(
+            connection_types=[constants.ConnectionType.long_polling],
+            connection_type=constants.ConnectionType.long_polling)
 
 
 class TestHandshake(TestChannel):
@@ -40,6 +42,43 @@ class TestHandshake(TestChannel):
         }
         channel.handle(response_message)
         assert client.client_id == '5b1jdngw1jz9g9w176s5z4jha0h8'
+        assert (
+            client.connection_type == constants.ConnectionType.long_polling)
+
+    def test_compose_connection_types(self, channel, client):
+        client.connection_types = [
+            constants.ConnectionType.websocket,
+            constants.ConnectionType.long_polling,
+        ]
+        message = channel.compose()
+        assert (
+            message['supportedConnectionTypes'] ==
+            ['websocket', 'long-polling'])
+
+    @pytest.mark.parametrize(('client_types', 'server_types', 'expected'), (
+        (['websocket', 'long-polling'], ['long-polling', 'websocket'],
+         'websocket'),
+        (['websocket', 'long-polling'], ['long-polling'], 'long-polling'),
+        (['long-polling', 'websocket'], ['websocket', 'long-polling'],
+         'long-polling'),
+        (['websocket'], ['long-polling'], 'long-polling'),
+        (['websocket'], None, 'long-polling'),
+    ))
+    def test_handle_negotiates_connection_type(
+        self, channel, client, client_types, server_types, expected
+    ):
+        client.connection_types = [
+            constants.ConnectionType(name) for name in client_types]
+        response_message = {
+            'successful': True,
+            'id': '1',
+            'channel': '/meta/handshake',
+            'clientId': '5b1jdngw1jz9g9w176s5z4jha0h8',
+        }
+        if server_types is not None:
+            response_message['supportedConnectionTypes'] = server_types
+        channel.handle(response_message)
+        assert client.connection_type == constants.ConnectionType(expected)
 
     @pytest.mark.parametrize('response_message', [
         {'successful': False},
@@ -80,8 +119,15 @@ class TestSubscribe(TestChannel):
         {'successful': False, 'error': 'Boom!'},
     ])
     def test_handle_failure(self, channel, client, response_message):
+        client.handle_subscription_response.return_value = False
         with pytest.raises(exceptions.BayeuxError):
             channel.handle(response_message)
+        assert client.handle_subscription_response.call_args == call(
+            response_message, True)
+
+    def test_handle_failure_of_runtime_change(self, channel, client):
+        client.handle_subscription_response.return_value = True
+        channel.handle({'successful': False, 'error': 'Boom!'})
 
 
 class TestUnsubscribe(TestChannel):
@@ -114,8 +160,15 @@ class TestUnsubscribe(TestChannel):
         {'successful': False, 'error': 'Boom!'},
     ])
     def test_handle_failure(self, channel, client, response_message):
+        client.handle_subscription_response.return_value = False
         with pytest.raises(exceptions.BayeuxError):
             channel.handle(response_message)
+        assert client.handle_subscription_response.call_args == call(
+            response_message, False)
+
+    def test_handle_failure_of_runtime_change(self, channel, client):
+        client.handle_subscription_response.return_value = True
+        channel.handle({'successful': False, 'error': 'Boom!'})
 
 
 class TestConnect(TestChannel):
@@ -133,6 +186,10 @@ class TestConnect(TestChannel):
         }
         assert channel.compose() == expected_message
 
+    def test_compose_websocket(self, channel, client):
+        client.connection_type = constants.ConnectionType.websocket
+        assert channel.compose()['connectionType'] == 'websocket'
+
     def test_handle_success(self, channel, client):
         response_message = {
             'successful': True,
@@ -243,3 +300,24 @@ class TestEvent(TestChannel):
         assert (
             callback_two.call_args_list ==
             [call({'foo': 'bar'})])
+
+
+class TestWildcardEvent(TestChannel):
+
+    @pytest.fixture
+    def channel(self, client):
+        return channels.WildcardEvent(client, '/spam/*')
+
+    def test_handle_event_delivery(self, client, channel):
+        callback = Mock()
+        channel.register_callback(callback)
+        response_message = {
+            'id': '1',
+            'channel': '/spam/ham',
+            'clientId': '5b1jdngw1jz9g9w176s5z4jha0h8',
+            'data': {'foo': 'bar'}
+        }
+        channel.handle(response_message)
+        assert (
+            callback.call_args_list ==
+            [call({'foo': 'bar'}, '/spam/ham')])
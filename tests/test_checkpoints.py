@@ -0,0 +1,150 @@
+import json
+
+from mock import Mock
+import pytest
+
+from nameko_bayeux_client.checkpoints import (
+    Checkpointer,
+    CheckpointStore,
+    FileCheckpointStore,
+    SqliteCheckpointStore,
+)
+
+
+class TestCheckpointStore:
+
+    def test_not_implemented(self):
+        store = CheckpointStore()
+        with pytest.raises(NotImplementedError):
+            store.load()
+        with pytest.raises(NotImplementedError):
+            store.save({'/topic/example': 1})
+
+
+@pytest.fixture(params=['file', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'file':
+        return FileCheckpointStore(str(tmp_path / 'checkpoints.json'))
+    else:
+        return SqliteCheckpointStore(str(tmp_path / 'checkpoints.db'))
+
+
+def test_store_empty(store):
+    assert store.load() == {}
+
+
+def test_store_save_and_load(store):
+    store.save({'/topic/a': 1, '/topic/b': 2})
+    store.save({'/topic/b': 3, '/topic/c': 4})
+    assert store.load() == {'/topic/a': 1, '/topic/b': 3, '/topic/c': 4}
+
+
+def test_file_store_content(tmp_path):
+    path = tmp_path / 'checkpoints.json'
+    FileCheckpointStore(str(path)).save({'/topic/a': 1})
+    assert json.loads(path.read_text()) == {'/topic/a': 1}
+
+
+def test_file_store_failing_save_leaves_no_temp_file(tmp_path):
+    path = tmp_path / 'checkpoints.json'
+    store = FileCheckpointStore(str(path))
+    store.save({'/topic/a': 1})
+    with pytest.raises(TypeError):
+        store.save({'/topic/a': object()})
+    assert [item.name for item in tmp_path.iterdir()] == ['checkpoints.json']
+    assert store.load() == {'/topic/a': 1}
+
+
+def test_sqlite_store_reopened(tmp_path):
+    path = str(tmp_path / 'checkpoints.db')
+    SqliteCheckpointStore(path).save({'/topic/a': 1})
+    assert SqliteCheckpointStore(path).load() == {'/topic/a': 1}
+
+
+class TestCheckpointer:
+
+    @pytest.fixture
+    def store(self):
+        return Mock(load=Mock(return_value={'/topic/a': 10}))
+
+    @pytest.fixture
+    def checkpointer(self, store):
+        return Checkpointer(store, default=-2, flush_size=3)
+
+    def test_get(self, checkpointer):
+        assert checkpointer.get('/topic/a') == 10
+        assert checkpointer.get('/topic/b') == -2
+
+    def test_update(self, checkpointer, store):
+        checkpointer.update('/topic/a', 11)
+        checkpointer.update('/topic/a', 9)  # never moves back
+        checkpointer.update('/topic/b', 1)
+        assert checkpointer.get('/topic/a') == 11
+        assert checkpointer.get('/topic/b') == 1
+        assert store.save.call_count == 0
+
+    def test_flush_due_after_flush_size_updates(self, store):
+        on_flush_due = Mock()
+        checkpointer = Checkpointer(
+            store, flush_size=3, on_flush_due=on_flush_due)
+        checkpointer.update('/topic/a', 11)
+        checkpointer.update('/topic/a', 12)
+        assert on_flush_due.call_count == 0
+        checkpointer.update('/topic/b', 1)
+        assert on_flush_due.call_count == 1
+        # saving is left to the caller
+        assert store.save.call_count == 0
+        assert checkpointer.dirty == {'/topic/a', '/topic/b'}
+
+    def test_no_flush_without_callback(self, checkpointer, store):
+        for replay_id in range(11, 15):
+            checkpointer.update('/topic/a', replay_id)
+        assert store.save.call_count == 0
+
+    def test_complete_out_of_order(self, checkpointer):
+        for replay_id in (11, 12, 13):
+            checkpointer.begin('/topic/a', replay_id)
+        checkpointer.complete('/topic/a', 12)
+        checkpointer.complete('/topic/a', 13)
+        # event 11 is still in flight
+        assert checkpointer.get('/topic/a') == 10
+        checkpointer.complete('/topic/a', 11)
+        assert checkpointer.get('/topic/a') == 13
+        assert checkpointer.in_flight['/topic/a'] == {}
+
+    def test_failed_event_blocks_checkpoint(self, checkpointer):
+        for replay_id in (11, 12, 13):
+            checkpointer.begin('/topic/a', replay_id)
+        checkpointer.complete('/topic/a', 11)
+        # the worker of event 12 fails and never completes
+        checkpointer.complete('/topic/a', 13)
+        assert checkpointer.get('/topic/a') == 11
+
+    def test_complete_event_of_multiple_workers(self, checkpointer):
+        checkpointer.begin('/topic/a', 11)
+        checkpointer.begin('/topic/a', 11)
+        checkpointer.complete('/topic/a', 11)
+        assert checkpointer.get('/topic/a') == 10
+        checkpointer.complete('/topic/a', 11)
+        assert checkpointer.get('/topic/a') == 11
+
+    def test_complete_untracked(self, checkpointer):
+        checkpointer.complete('/topic/a', 11)
+        assert checkpointer.get('/topic/a') == 10
+
+    def test_flush(self, checkpointer, store):
+        checkpointer.flush()
+        assert store.save.call_count == 0
+        checkpointer.update('/topic/b', 1)
+        checkpointer.flush()
+        assert store.save.call_args_list == [(({'/topic/b': 1},),)]
+
+    def test_flush_failing(self, checkpointer, store):
+        store.save.side_effect = OSError('Disk full')
+        checkpointer.update('/topic/b', 1)
+        with pytest.raises(OSError):
+            checkpointer.flush()
+        assert checkpointer.dirty == {'/topic/b'}
+        store.save.side_effect = None
+        checkpointer.flush()
+        assert store.save.call_args == (({'/topic/b': 1},),)
@@ -1,17 +1,51 @@
 import collections
 import json
+import logging
+import time
+import zlib
 
 import eventlet
 from eventlet.event import Event
 from mock import call, Mock, patch
-from nameko.testing.utils import find_free_port
+from nameko.extensions import SharedExtension
+from nameko.testing.services import dummy, entrypoint_hook
+from nameko.testing.utils import find_free_port, get_extension
 from nameko.web.handlers import http
 import pytest
 import requests
 import requests_mock
-
-from nameko_bayeux_client.client import BayeuxClient, Reconnection, subscribe
-from nameko_bayeux_client.exceptions import Reconnect
+import websocket
+
+from nameko_bayeux_client.client import (
+    BayeuxBatchMessageHandler,
+    BayeuxClient,
+    BayeuxMessageHandler,
+    BayeuxMetrics,
+    BayeuxPublisher,
+    BayeuxSubscriptions,
+    PublishResult,
+    Reconnection,
+    subscribe,
+    subscribe_batch,
+)
+from nameko_bayeux_client.channels import Connect, Disconnect, Subscribe
+from nameko_bayeux_client.checkpoints import (
+    FileCheckpointStore,
+    SqliteCheckpointStore,
+)
+from nameko_bayeux_client.compression import Compression
+from nameko_bayeux_client.constants import (
+    ConnectionType, SubscriptionState)
+from nameko_bayeux_client.envelope import EventEnvelope
+from nameko_bayeux_client.exceptions import (
+    PublishError, Reconnect, ResponseTooLarge)
+from nameko_bayeux_client.extensions import AckExtension
+from nameko_bayeux_client.metrics import (
+    InMemoryCollector,
+    MetricsCollector,
+    PrometheusCollector,
+)
+from nameko_bayeux_client.transports import WebSocketTransport
 
 
 class TestBayeuxClient:
@@ -43,6 +77,17 @@ class TestBayeuxClient:
         assert config['BAYEUX']['VERSION'] == client.version
         assert config['BAYEUX']['MINIMUM_VERSION'] == client.minimum_version
         assert config['BAYEUX']['SERVER_URI'] == client.server_uri
+        assert client.codec.name == 'json'
+        assert client.connection_types == [ConnectionType.long_polling]
+        assert client.websocket_uri == 'ws://localhost/bayeux/'
+        assert client.stream_responses is False
+        assert client.stream_chunk_size == 8192
+
+    @pytest.mark.parametrize('codec', ['json', 'orjson'])
+    def test_setup_codec(self, client, config, codec):
+        config['BAYEUX']['JSON_CODEC'] = codec
+        client.setup()
+        assert client.codec.name == codec
 
     def test_get_authorisation(self, client):
         assert (None, None) == client.get_authorisation()
@@ -53,7 +98,7 @@ class TestBayeuxClient:
         messages_out = [{'spam': 'egg out one'}, {'spam': 'egg out two'}]
 
         response = Mock(
-            status_code=200, json=Mock(return_value=messages_out))
+            status_code=200, content=json.dumps(messages_out).encode())
         client.session.post.return_value = response
 
         received = client.send_and_receive(messages_in)
@@ -65,7 +110,8 @@ class TestBayeuxClient:
                 client.server_uri,
                 timeout=client.timeout,
                 headers={'Content-Type': 'application/json'},
-                data='[{"spam": "egg in one"}]'
+                data=b'[{"spam": "egg in one"}]',
+                stream=False,
             ) ==
             client.session.post.call_args
         )
@@ -77,7 +123,7 @@ class TestBayeuxClient:
         messages_out = [{'spam': 'egg out one'}, {'spam': 'egg out two'}]
 
         response = Mock(
-            status_code=200, json=Mock(return_value=messages_out))
+            status_code=200, content=json.dumps(messages_out).encode())
         client.session.post.return_value = response
 
         received = client.send_and_receive(messages_in)
@@ -89,7 +135,8 @@ class TestBayeuxClient:
                 client.server_uri,
                 timeout=client.timeout,
                 headers={'Content-Type': 'application/json'},
-                data='[{"spam": "egg in one"}, {"spam": "egg in two"}]'
+                data=b'[{"spam": "egg in one"}, {"spam": "egg in two"}]',
+                stream=False,
             ) ==
             client.session.post.call_args
         )
@@ -104,7 +151,7 @@ class TestBayeuxClient:
         messages_out = [{'spam': 'egg out one'}, {'spam': 'egg out two'}]
 
         response = Mock(
-            status_code=200, json=Mock(return_value=messages_out))
+            status_code=200, content=json.dumps(messages_out).encode())
         client.session.post.return_value = response
 
         get_authorisation.return_value = ('Bearer', '*********')
@@ -121,7 +168,8 @@ class TestBayeuxClient:
                     'Content-Type': 'application/json',
                     'Authorization': 'Bearer *********',
                 },
-                data='[{"spam": "egg in one"}, {"spam": "egg in two"}]'
+                data=b'[{"spam": "egg in one"}, {"spam": "egg in two"}]',
+                stream=False,
             ) ==
             client.session.post.call_args
         )
@@ -152,6 +200,97 @@ class TestBayeuxClient:
 
         assert str(exc.value) == error_message
 
+    def test_send_and_stream(self, client):
+
+        messages_in = {'spam': 'egg in one'}
+        messages_out = [{'spam': 'egg out one'}, {'spam': 'egg out two'}]
+
+        response = Mock(status_code=200)
+        response.iter_content.return_value = [
+            b'[{"spam": "egg ', b'out one"}, {"sp', b'am": "egg out two"}]']
+        client.session.post.return_value = response
+
+        received = client.send_and_stream(messages_in)
+
+        assert next(received) == messages_out[0]
+        assert response.close.call_count == 0
+        assert list(received) == messages_out[1:]
+        assert response.close.call_count == 1
+
+        assert (
+            call(
+                client.server_uri,
+                timeout=client.timeout,
+                headers={'Content-Type': 'application/json'},
+                data=b'[{"spam": "egg in one"}]',
+                stream=True,
+            ) ==
+            client.session.post.call_args
+        )
+        assert (
+            call(client.stream_chunk_size) ==
+            response.iter_content.call_args
+        )
+        assert 1 == response.raise_for_status.call_count
+
+    @pytest.mark.parametrize(('exception_class,error_message'), (
+        (
+            requests.ConnectionError,
+            'Failed to post request messages to Bayeux server',
+        ),
+        (
+            requests.exceptions.ChunkedEncodingError,
+            'Failed to post request messages to Bayeux server',
+        ),
+        (requests.Timeout, 'Request to Bayeux server timed out'),
+    ))
+    def test_send_and_stream_failing_while_reading(
+        self, client, exception_class, error_message
+    ):
+
+        def iter_content(chunk_size):
+            yield b'[{"spam": "egg out one"}, '
+            raise exception_class()
+
+        response = Mock(status_code=200, iter_content=iter_content)
+        client.session.post.return_value = response
+
+        received = client.send_and_stream({'spam': 'egg in one'})
+
+        assert next(received) == {'spam': 'egg out one'}
+        with pytest.raises(Reconnect) as exc:
+            next(received)
+
+        assert str(exc.value) == error_message
+        assert response.close.call_count == 1
+
+    @patch.object(BayeuxClient, 'send_and_receive')
+    @patch.object(BayeuxClient, 'send_and_stream')
+    @patch.object(BayeuxClient, 'handle')
+    def test_send_and_handle_streaming(
+        self, handle, send_and_stream, send_and_receive, client
+    ):
+        client.stream_responses = True
+        client.send_and_handle([{'spam': 'egg in one'}])
+        assert handle.call_args == call(send_and_stream.return_value)
+        assert send_and_receive.call_count == 0
+
+    def test_send_and_handle_streaming_closes_stream_on_failure(
+        self, client
+    ):
+        client.stream_responses = True
+        response = Mock(status_code=200)
+        response.iter_content.return_value = [
+            b'[{"channel": "/meta/connect", "successful": false}, ',
+            b'{"channel": "/topic/example", "data": "spam"}]']
+        client.session.post.return_value = response
+        client.register_channel(Connect(client))
+
+        with pytest.raises(Reconnect):
+            client.send_and_handle({'spam': 'egg in one'})
+
+        assert response.close.call_count == 1
+
     @patch.object(BayeuxClient, 'send_and_handle')
     @patch.object(BayeuxClient, 'login')
     def test_handshake_logs_in(self, login, send_and_handle, client):
@@ -160,6 +299,345 @@ class TestBayeuxClient:
         assert Reconnection.handshake == client.reconnection
         assert call() == login.call_args
 
+    @patch.object(BayeuxClient, 'send_and_handle')
+    @patch.object(BayeuxClient, 'login')
+    def test_handshake_reuses_valid_authorisation(
+        self, login, send_and_handle, client
+    ):
+        client.handshake()
+        client.handshake()
+        assert login.call_count == 1
+        client.credentials.invalidate()
+        client.handshake()
+        assert login.call_count == 2
+
+    @patch.object(BayeuxClient, 'get_authorisation')
+    def test_authorisation_headers_are_cached(
+        self, get_authorisation, client
+    ):
+        get_authorisation.return_value = ('Bearer', 'token')
+        headers = client._get_authorisation_headers()
+        assert headers == {'Authorization': 'Bearer token'}
+        assert client._get_authorisation_headers() is headers
+        assert get_authorisation.call_count == 1
+
+    @patch.object(BayeuxClient, 'login')
+    def test_authorise_spawns_refresher(self, login, client):
+        client.container = Mock(config=client.container.config)
+        client.authorise()
+        assert client.container.spawn_managed_thread.call_count == 0
+
+        client.auth = {'TTL': 3600}
+        client.authorise()
+        client.authorise()
+        assert client.container.spawn_managed_thread.call_args_list == [
+            call(client._refresh_credentials)]
+        assert login.call_count == 3
+
+    @patch.object(BayeuxClient, 'get_authorisation_ttl')
+    @patch.object(BayeuxClient, 'login')
+    def test_refresh_credentials(
+        self, login, get_authorisation_ttl, client, caplog
+    ):
+        client.auth = {'REFRESH_MARGIN': 0.01, 'RETRY_DELAY': 0}
+        login.side_effect = [ValueError('Boom'), None]
+        get_authorisation_ttl.side_effect = [0.02, None]
+        client._set_credentials()
+        client._credentials_refresher = Mock()
+
+        with eventlet.Timeout(5):
+            client._refresh_credentials()
+
+        assert login.call_count == 2
+        assert 'Failed to refresh authorisation' in caplog.text
+        assert client.credentials.valid
+        assert client.credentials.expires_at is None
+        assert client._credentials_refresher is None
+
+    @pytest.mark.parametrize(('status_code', 'rejected'), (
+        (401, True), (403, True), (500, False)))
+    def test_rejected_authorisation_is_invalidated(
+        self, client, status_code, rejected
+    ):
+        client.credentials.set({'Authorization': 'Bearer token'})
+        client.reconnection = Reconnection.retry
+        response = Mock(status_code=status_code)
+        response.raise_for_status.side_effect = requests.HTTPError(
+            response=response)
+        client.session.post.return_value = response
+
+        with pytest.raises(Reconnect):
+            client.send_and_receive({'channel': '/meta/connect'})
+
+        assert client.credentials.valid is not rejected
+        assert (client.reconnection == Reconnection.handshake) is rejected
+
+    def test_setup_backoff(self, client, config):
+        assert client.backoff.base == 100
+        assert client.backoff.cap == 30000
+        config['BAYEUX']['BACKOFF_BASE'] = 10
+        config['BAYEUX']['BACKOFF_CAP'] = 1000
+        client.setup()
+        assert client.backoff.base == 10
+        assert client.backoff.cap == 1000
+
+    @patch.object(BayeuxClient, 'connect')
+    @patch.object(BayeuxClient, 'subscribe')
+    @patch.object(BayeuxClient, 'handshake')
+    def test_run_backs_off(self, handshake, subscribe, connect, client):
+
+        class Stop(Exception):
+            pass
+
+        connect.side_effect = [Reconnect, Reconnect, None, Stop]
+        client.interval = 0
+        client.reconnection = Reconnection.retry
+
+        with patch.object(client.backoff, 'get_delay') as get_delay:
+            get_delay.return_value = 0
+            with pytest.raises(Stop):
+                client.run()
+
+        assert get_delay.call_args_list == [call(floor=0)] * 3
+        assert client.backoff.failures == 0
+        assert client.backoff.last_failures == 2
+
+    def test_setup_connection_types(self, client, config):
+        config['BAYEUX']['CONNECTION_TYPES'] = ['websocket', 'long-polling']
+        config['BAYEUX']['WEBSOCKET_URI'] = 'wss://example.com/cometd'
+        client.setup()
+        assert client.connection_types == [
+            ConnectionType.websocket, ConnectionType.long_polling]
+        assert client.websocket_uri == 'wss://example.com/cometd'
+
+    @patch.object(WebSocketTransport, 'is_available')
+    def test_setup_connection_types_websocket_not_installed(
+        self, is_available, client, config
+    ):
+        is_available.return_value = False
+        config['BAYEUX']['CONNECTION_TYPES'] = ['websocket', 'long-polling']
+        client.setup()
+        assert client.connection_types == [ConnectionType.long_polling]
+
+    @patch.object(BayeuxClient, 'send_and_stream')
+    @patch.object(BayeuxClient, 'handle')
+    def test_websocket_exchange_is_not_streamed(
+        self, handle, send_and_stream, client
+    ):
+        client.stream_responses = True
+        client.websocket = Mock()
+        client.send_and_handle([{'spam': 'egg in one'}])
+        assert handle.call_args == call(
+            client.websocket.send_and_receive.return_value)
+        assert send_and_stream.call_count == 0
+
+    @pytest.mark.parametrize('exception_class', [Reconnect, eventlet.Timeout])
+    def test_websocket_exchange_failing(self, client, exception_class):
+        websocket = client.websocket = Mock()
+        websocket.send_and_receive.side_effect = exception_class
+        client.reconnection = Reconnection.retry
+        with pytest.raises(Reconnect):
+            client.send_and_receive({'spam': 'egg in one'})
+        assert client.websocket is None
+        assert websocket.close.call_count == 1
+        assert client.reconnection == Reconnection.handshake
+
+    def test_setup_http(self, client, config):
+        config['BAYEUX']['HTTP'] = {'POOL_SIZE': 2, 'CONTROL_TIMEOUT': 3}
+        client.control_session = requests.Session()
+        client.setup()
+        assert client.control_timeout == 3
+        adapter = client.control_session.get_adapter(client.server_uri)
+        assert adapter._pool_maxsize == 2
+        scheme, session_adapter = client.session.mount.call_args[0]
+        assert scheme == 'https://'
+        assert session_adapter._pool_maxsize == 2
+
+    def test_disconnect_over_control_session(self, client):
+        client.control_session = Mock()
+        client.control_session.post.return_value = Mock(
+            status_code=200, content=json.dumps([{
+                'channel': '/meta/disconnect', 'successful': True,
+            }]).encode())
+        client.register_channel(Disconnect(client))
+
+        client.disconnect()
+
+        assert client.session.post.call_count == 0
+        assert client.control_session.post.call_args[1]['timeout'] == (
+            client.control_timeout)
+        assert client.control_session.post.call_args[1]['data'] == (
+            client.codec.dumps([{
+                'id': 1, 'channel': '/meta/disconnect',
+                'clientId': None,
+            }]))
+
+    def test_urgent_message_over_control_session(self, client):
+        client.client_id = 'client-id'
+        client.control_session = Mock()
+        client.control_session.post.return_value = Mock(
+            status_code=200, content=json.dumps([{
+                'channel': '/topic/a', 'id': '1', 'successful': True,
+            }]).encode())
+        replies = []
+
+        client.queue_message({'channel': '/topic/a'}, replies.append)
+        assert client.control_session.post.call_count == 0
+        client.queue_message(
+            {'channel': '/topic/b'}, replies.append, urgent=True)
+
+        assert client.session.post.call_count == 0
+        assert json.loads(
+            client.control_session.post.call_args[1]['data'].decode()) == [
+            {'channel': '/topic/a', 'id': 1, 'clientId': 'client-id'},
+            {'channel': '/topic/b', 'id': 2, 'clientId': 'client-id'},
+        ]
+        assert replies == [{
+            'channel': '/topic/a', 'id': '1', 'successful': True,
+        }]
+
+    @pytest.mark.parametrize('exception_class', [
+        requests.ConnectionError, eventlet.Timeout])
+    def test_disconnect_over_control_session_failing(
+        self, client, exception_class
+    ):
+        client.control_session = Mock()
+        client.control_session.post.side_effect = exception_class
+        with pytest.raises(Reconnect):
+            client.disconnect()
+
+    def test_setup_compression(self, client, config):
+        assert client.compression.encoding is None
+        config['BAYEUX']['COMPRESSION'] = {
+            'REQUEST_ENCODING': 'deflate',
+            'MIN_SIZE': 10,
+            'ACCEPT_ENCODING': ['gzip'],
+            'MAX_RESPONSE_SIZE': 1000,
+        }
+        client.setup()
+        assert client.compression.encoding == 'deflate'
+        assert client.compression.min_size == 10
+        assert client.compression.accept_encoding == ['gzip']
+        assert client.compression.max_response_size == 1000
+
+    def test_send_and_receive_compressed(self, client):
+        client.metrics = InMemoryCollector()
+        client.compression = Compression(
+            encoding='gzip', min_size=10, accept_encoding=['gzip'])
+        client.session.post.return_value = Mock(
+            status_code=200, content=b'[{"spam": "egg out one"}]')
+
+        received = client.send_and_receive({'spam': 'egg in one'})
+
+        assert received == [{'spam': 'egg out one'}]
+        _, kwargs = client.session.post.call_args
+        assert kwargs['headers'] == {
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip',
+            'Content-Encoding': 'gzip',
+        }
+        assert zlib.decompress(kwargs['data'], 16 + zlib.MAX_WBITS) == (
+            b'[{"spam": "egg in one"}]')
+        assert client.metrics.get_histogram(
+            'request_size_bytes').sum == len(kwargs['data'])
+
+    def test_send_and_receive_limited_response(self, client):
+        client.compression = Compression(max_response_size=25)
+        response = Mock(status_code=200)
+        response.iter_content.return_value = [
+            b'[{"spam": ', b'"egg out one"}]']
+        client.session.post.return_value = response
+
+        received = client.send_and_receive({'spam': 'egg in one'})
+
+        assert received == [{'spam': 'egg out one'}]
+        assert client.session.post.call_args[1]['stream'] is True
+        assert response.close.call_count == 1
+
+    def test_send_and_receive_response_too_large(self, client):
+        client.compression = Compression(max_response_size=24)
+        response = Mock(status_code=200)
+        response.iter_content.return_value = [
+            b'[{"spam": ', b'"egg out one"}]']
+        client.session.post.return_value = response
+
+        with pytest.raises(ResponseTooLarge):
+            client.send_and_receive({'spam': 'egg in one'})
+
+        assert response.close.call_count == 1
+
+    def test_send_and_stream_response_too_large(self, client):
+        client.compression = Compression(max_response_size=30)
+        response = Mock(status_code=200)
+        response.iter_content.return_value = [
+            b'[{"spam": "egg out one"}, ', b'{"spam": "egg out two"}]']
+        client.session.post.return_value = response
+
+        received = client.send_and_stream({'spam': 'egg in one'})
+
+        assert next(received) == {'spam': 'egg out one'}
+        with pytest.raises(ResponseTooLarge):
+            next(received)
+        assert response.close.call_count == 1
+
+    def test_disconnect_response_too_large(self, client):
+        client.compression = Compression(max_response_size=10)
+        client.control_session = Mock()
+        response = client.control_session.post.return_value
+        response.iter_content.return_value = [json.dumps([{
+            'channel': '/meta/disconnect', 'successful': True,
+        }]).encode()]
+
+        with pytest.raises(ResponseTooLarge):
+            client.disconnect()
+
+        assert client.control_session.post.call_args[1]['stream'] is True
+
+    def test_setup_metrics(self, client, config):
+        assert type(client.metrics) is MetricsCollector
+        config['BAYEUX']['METRICS'] = 'prometheus'
+        client.setup()
+        assert isinstance(client.metrics, PrometheusCollector)
+
+    def test_metrics_of_websocket_exchange(self, client):
+        client.metrics = InMemoryCollector()
+        client.websocket = Mock()
+        client.send_and_receive({'channel': '/meta/connect'})
+        histogram = client.metrics.get_histogram(
+            'request_duration_seconds', channel='/meta/connect')
+        assert histogram.count == 1
+
+    def test_metrics_of_streamed_response(self, client):
+        client.metrics = InMemoryCollector()
+        response = Mock(status_code=200)
+        response.iter_content.return_value = [
+            b'[{"spam": "egg ', b'out one"}, {"sp', b'am": "egg out two"}]']
+        client.session.post.return_value = response
+
+        assert len(list(client.send_and_stream([]))) == 2
+
+        assert client.metrics.get_histogram(
+            'request_duration_seconds', channel=None).count == 1
+        size = client.metrics.get_histogram('response_size_bytes')
+        assert size.sum == len(b'{"spam": "egg out one"}') * 2
+        assert client.metrics.get_histogram(
+            'decode_duration_seconds').count == 1
+
+    @patch.object(BayeuxClient, 'connect')
+    def test_metrics_of_reconnects(self, connect, client):
+
+        class Stop(Exception):
+            pass
+
+        client.metrics = InMemoryCollector()
+        client.reconnection = Reconnection.retry
+        connect.side_effect = [Reconnect, Stop]
+        with patch.object(client.backoff, 'get_delay', return_value=0):
+            with pytest.raises(Stop):
+                client.run()
+        assert client.metrics.get_counter(
+            'reconnects_total', reconnection='retry') == 1
+
 
 @pytest.fixture
 def client_id():
@@ -730,6 +1208,79 @@ def test_handlers_do_not_block(
         cometd_server.stop()
 
 
+def test_ordered_processing(
+    config, container_factory, make_cometd_server, message_maker, waiter
+):
+    """ Test that events of the same key are handled one at a time in order
+
+    Events of different keys should be handled concurrently up to the limit.
+
+    """
+
+    log = []
+    running = []
+
+    class Service:
+
+        name = 'example-service'
+
+        @subscribe(
+            '/topic/example', key=lambda data: data['key'], max_concurrency=2)
+        def handle_event(self, channel, payload):
+            running.append(payload)
+            log.append(('start', payload['key'], payload['seq'], len(running)))
+            eventlet.sleep(0.02)
+            running.remove(payload)
+            log.append(('end', payload['key'], payload['seq'], len(running)))
+
+    events = [
+        {'key': key, 'seq': seq}
+        for seq, key in enumerate(['a', 'b', 'a', 'c', 'b', 'a'])
+    ]
+    responses = [
+        [message_maker.make_handshake_response()],
+        [
+            message_maker.make_subscribe_response(
+                subscription='/topic/example'),
+        ],
+        [
+            message_maker.make_connect_response(
+                advice={'reconnect': Reconnection.retry.value}),
+        ] + [
+            message_maker.make_event_delivery_message(
+                channel='/topic/example', data=data)
+            for data in events
+        ],
+    ]
+
+    cometd_server = make_cometd_server(responses)
+    container = container_factory(Service, config)
+
+    cometd_server.start()
+    container.start()
+
+    try:
+        with eventlet.Timeout(5):
+            while len(log) < 2 * len(events):
+                eventlet.sleep(0.01)
+    finally:
+        waiter.wait()
+        container.kill()
+        cometd_server.stop()
+
+    for key in 'abc':
+        key_log = [
+            (action, seq) for action, event_key, seq, _ in log
+            if event_key == key
+        ]
+        seqs = [data['seq'] for data in events if data['key'] == key]
+        # one at a time in the order of delivery
+        assert key_log == [
+            (action, seq) for seq in seqs for action in ('start', 'end')]
+    concurrency = [count for action, _, _, count in log if action == 'start']
+    assert max(concurrency) == 2
+
+
 def fail_with(exception_class):
     def callback(request, context):
         raise exception_class('Yo!')
@@ -1077,6 +1628,11 @@ class TestConnectionFailingRetryReconnection(MockedCometdServerTestCase):
             ]
         )
 
+    def test_failures_tracked(self, service, stack):
+        client = get_extension(service, BayeuxClient)
+        assert client.backoff.failures == 0
+        assert client.backoff.last_failures == 2
+
 
 class TestConnectionFailingUnsuccessfulResponseMessage(
     MockedCometdServerTestCase
@@ -1175,3 +1731,1849 @@ class TestConnectionFailingUnsuccessfulResponseMessage(
                 [message_maker.make_connect_request(id=10)],
             ]
         )
+
+
+class TestStreamingResponses(MockedCometdServerTestCase):
+    """
+    Test streaming decode of response messages
+
+    Response messages should be handled in the same way as when the whole
+    response is decoded at once.
+
+    """
+
+    @pytest.fixture
+    def config(self, config):
+        config['BAYEUX']['STREAM_RESPONSES'] = True
+        config['BAYEUX']['STREAM_CHUNK_SIZE'] = 16
+        return config
+
+    @pytest.fixture
+    def responses(self, message_maker):
+        responses = [
+            {'json': [message_maker.make_handshake_response()]},
+            {
+                'json': [
+                    message_maker.make_subscribe_response(
+                        subscription='/topic/example'),
+                ],
+            },
+            {
+                'json': [
+                    message_maker.make_connect_response(
+                        advice={'reconnect': Reconnection.retry.value}),
+                    message_maker.make_event_delivery_message(
+                        channel='/topic/example', data={'spam': 'one'}),
+                    message_maker.make_event_delivery_message(
+                        channel='/topic/example', data={'spam': 'two'}),
+                ],
+            },
+        ]
+        return responses
+
+    def test_streaming_responses(
+        self, cometd_server, message_maker, stack, tracker
+    ):
+        assert (
+            [request.json() for request in cometd_server.request_history] ==
+            [
+                [message_maker.make_handshake_request(id=1)],
+                [
+                    message_maker.make_subscribe_request(
+                        id=2, subscription='/topic/example'),
+                ],
+                [message_maker.make_connect_request(id=3)],
+                [message_maker.make_connect_request(id=4)],
+            ]
+        )
+        assert tracker.handle_event.call_args_list == [
+            call('/topic/example', {'spam': 'one'}),
+            call('/topic/example', {'spam': 'two'}),
+        ]
+
+
+class TestLazyEvents(MockedCometdServerTestCase):
+    """
+    Test delivery of events as envelopes with lazily decoded data
+
+    Envelopes should be the same whether or not responses are streamed.
+
+    """
+
+    @pytest.fixture(params=[False, True], ids=['whole', 'streamed'])
+    def config(self, config, request):
+        config['BAYEUX']['LAZY_EVENTS'] = True
+        config['BAYEUX']['STREAM_RESPONSES'] = request.param
+        config['BAYEUX']['STREAM_CHUNK_SIZE'] = 16
+        return config
+
+    @pytest.fixture
+    def responses(self, message_maker):
+        responses = [
+            {'json': [message_maker.make_handshake_response()]},
+            {
+                'json': [
+                    message_maker.make_subscribe_response(
+                        subscription='/topic/example'),
+                ],
+            },
+            {
+                'json': [
+                    message_maker.make_connect_response(
+                        advice={'reconnect': Reconnection.retry.value}),
+                    message_maker.make_event_delivery_message(
+                        channel='/topic/example', id='7',
+                        data={'event': {'replayId': 3}, 'spam': 'one'}),
+                ],
+            },
+        ]
+        return responses
+
+    def test_lazy_events(self, cometd_server, message_maker, stack, tracker):
+        ((channel, envelope), _), = tracker.handle_event.call_args_list
+        assert channel == '/topic/example'
+        assert isinstance(envelope, EventEnvelope)
+        assert envelope.channel == '/topic/example'
+        assert envelope.id == '7'
+        assert envelope.replay_id == 3
+        assert envelope.decoded is False
+        assert envelope.data == {'event': {'replayId': 3}, 'spam': 'one'}
+
+
+class FakeWebSocket:
+    """
+    Fake WebSocket connection responding to sent messages
+
+    Meta response messages get IDs of the corresponding request messages.
+    When the responses are exhausted, the waiter is triggered and the fake
+    keeps responding to connect requests.
+
+    """
+
+    def __init__(self, responses, waiter, message_maker):
+        self.responses = responses
+        self.waiter = waiter
+        self.message_maker = message_maker
+        self.requests = []
+        self.pending = []
+
+    def send(self, data):
+        messages = json.loads(data.decode('utf-8'))
+        self.requests.append(messages)
+        ids = {message['channel']: message['id'] for message in messages}
+        try:
+            response = self.responses.pop(0)
+        except IndexError:
+            if not self.waiter.ready():
+                self.waiter.send()
+            eventlet.sleep(0.1)
+            response = [self.message_maker.make_connect_response()]
+        if isinstance(response, Exception):
+            raise response
+        for message in response:
+            if message['channel'] in ids:
+                message['id'] = ids[message['channel']]
+        self.pending.append(json.dumps(response).encode('utf-8'))
+
+    def recv_data(self):
+        return websocket.ABNF.OPCODE_TEXT, self.pending.pop(0)
+
+    def close(self):
+        pass
+
+
+class TestWebSocketConnection:
+    """
+    Test websocket connection type
+
+    The handshake goes over HTTP, subscriptions and connections are then
+    exchanged over a WebSocket connection. If the connection breaks,
+    the client handshakes again and opens another WebSocket connection.
+
+    """
+
+    @pytest.fixture
+    def config(self, config):
+        config['BAYEUX']['CONNECTION_TYPES'] = ['websocket', 'long-polling']
+        return config
+
+    @pytest.fixture
+    def service(self, config, container_factory, tracker):
+
+        class Service:
+
+            name = 'example_service'
+
+            @subscribe('/topic/example')
+            def handle_event(self, channel, payload):
+                tracker.handle_event(channel, payload)
+
+        return container_factory(Service, config)
+
+    @pytest.fixture
+    def cometd_server(self, config, message_maker):
+        handshake_response = message_maker.make_handshake_response(
+            supportedConnectionTypes=['long-polling', 'websocket'])
+        with requests_mock.Mocker() as mocked_requests:
+            mocked_requests.post(
+                config['BAYEUX']['SERVER_URI'],
+                [
+                    {'json': [handshake_response]},
+                    {'json': [handshake_response]},
+                    {'json': [message_maker.make_disconnect_response()]},
+                ])
+            yield mocked_requests
+
+    @pytest.fixture
+    def websocket_server(self, message_maker, waiter):
+        responses = [
+            [
+                message_maker.make_subscribe_response(
+                    subscription='/topic/example'),
+            ],
+            [
+                message_maker.make_connect_response(
+                    advice={'reconnect': Reconnection.retry.value}),
+                message_maker.make_event_delivery_message(
+                    channel='/topic/example', data={'spam': 'one'}),
+            ],
+            websocket.WebSocketConnectionClosedException(),
+            [
+                message_maker.make_subscribe_response(
+                    subscription='/topic/example'),
+            ],
+            [
+                message_maker.make_connect_response(
+                    advice={'reconnect': Reconnection.retry.value}),
+            ],
+            [
+                message_maker.make_event_delivery_message(
+                    channel='/topic/example', data={'spam': 'two'}),
+                message_maker.make_connect_response(),
+            ],
+        ]
+        fake = FakeWebSocket(responses, waiter, message_maker)
+        with patch.object(websocket, 'create_connection') as create:
+            create.return_value = fake
+            yield fake
+
+    def test_websocket_connection(
+        self, cometd_server, message_maker, service, tracker, waiter,
+        websocket_server
+    ):
+        service.start()
+        waiter.wait()
+        service.stop()
+
+        connection_types = ['websocket', 'long-polling']
+        assert (
+            [request.json() for request in cometd_server.request_history] ==
+            [
+                [
+                    message_maker.make_handshake_request(
+                        id=1, supportedConnectionTypes=connection_types),
+                ],
+                [
+                    message_maker.make_handshake_request(
+                        id=5, supportedConnectionTypes=connection_types),
+                ],
+                [message_maker.make_disconnect_request(id=10)],
+            ]
+        )
+        assert websocket_server.requests == [
+            [
+                message_maker.make_subscribe_request(
+                    id=2, subscription='/topic/example'),
+            ],
+            [
+                message_maker.make_connect_request(
+                    id=3, connectionType='websocket'),
+            ],
+            [
+                message_maker.make_connect_request(
+                    id=4, connectionType='websocket'),
+            ],
+            [
+                message_maker.make_subscribe_request(
+                    id=6, subscription='/topic/example'),
+            ],
+            [
+                message_maker.make_connect_request(
+                    id=7, connectionType='websocket'),
+            ],
+            [
+                message_maker.make_connect_request(
+                    id=8, connectionType='websocket'),
+            ],
+            [
+                message_maker.make_connect_request(
+                    id=9, connectionType='websocket'),
+            ],
+        ]
+        assert tracker.handle_event.call_args_list == [
+            call('/topic/example', {'spam': 'one'}),
+            call('/topic/example', {'spam': 'two'}),
+        ]
+
+
+class TestWebSocketConnectionFallback(MockedCometdServerTestCase):
+    """
+    Test falling back to long-polling
+
+    If the WebSocket connection cannot be opened, the client carries
+    on with long-polling connection type.
+
+    """
+
+    @pytest.fixture
+    def config(self, config):
+        config['BAYEUX']['CONNECTION_TYPES'] = ['websocket', 'long-polling']
+        return config
+
+    @pytest.fixture(autouse=True)
+    def create_connection(self):
+        with patch.object(websocket, 'create_connection') as create:
+            create.side_effect = ConnectionRefusedError()
+            yield create
+
+    @pytest.fixture
+    def responses(self, message_maker):
+        responses = [
+            {
+                'json': [
+                    message_maker.make_handshake_response(
+                        supportedConnectionTypes=[
+                            'long-polling', 'websocket'])
+                ],
+            },
+            {
+                'json': [
+                    message_maker.make_subscribe_response(
+                        subscription='/topic/example'),
+                ],
+            },
+            {
+                'json': [
+                    message_maker.make_connect_response(
+                        advice={'reconnect': Reconnection.retry.value}),
+                ],
+            },
+        ]
+        return responses
+
+    def test_websocket_connection_fallback(
+        self, cometd_server, create_connection, message_maker, stack
+    ):
+        assert create_connection.call_count == 1
+        assert (
+            [request.json() for request in cometd_server.request_history] ==
+            [
+                [
+                    message_maker.make_handshake_request(
+                        id=1,
+                        supportedConnectionTypes=[
+                            'websocket', 'long-polling']),
+                ],
+                [
+                    message_maker.make_subscribe_request(
+                        id=2, subscription='/topic/example'),
+                ],
+                [message_maker.make_connect_request(id=3)],
+                [message_maker.make_connect_request(id=4)],
+            ]
+        )
+
+
+class TestPendingEventsLimit(MockedCometdServerTestCase):
+    """
+    Test bounded queue of events pending for a worker
+
+    When the queue of pending events is full, no other connect request
+    should be sent until the queue drains.
+
+    """
+
+    @pytest.fixture
+    def config(self, config):
+        config['max_workers'] = 1
+        config['BAYEUX']['MAX_PENDING_EVENTS'] = 1
+        return config
+
+    @pytest.fixture
+    def work(self):
+        return Event()
+
+    @pytest.fixture
+    def service(self, config, container_factory, tracker, work):
+
+        class Service:
+
+            name = 'example_service'
+
+            @subscribe('/topic/example')
+            def handle_event(self, channel, payload):
+                work.wait()
+                tracker.handle_event(channel, payload)
+
+        container = container_factory(Service, config)
+
+        return container
+
+    @pytest.fixture
+    def responses(self, message_maker):
+        responses = [
+            {'json': [message_maker.make_handshake_response()]},
+            {
+                'json': [
+                    message_maker.make_subscribe_response(
+                        subscription='/topic/example'),
+                ],
+            },
+            {
+                'json': [
+                    message_maker.make_connect_response(
+                        advice={'reconnect': Reconnection.retry.value}),
+                ],
+            },
+            {
+                'json': [
+                    message_maker.make_connect_response(),
+                    message_maker.make_event_delivery_message(
+                        channel='/topic/example', data={'spam': 'one'}),
+                    message_maker.make_event_delivery_message(
+                        channel='/topic/example', data={'spam': 'two'}),
+                    message_maker.make_event_delivery_message(
+                        channel='/topic/example', data={'spam': 'three'}),
+                ],
+            },
+        ]
+        return responses
+
+    def test_pending_events_limit(
+        self, cometd_server, message_maker, service, tracker, waiter, work
+    ):
+        service.start()
+
+        eventlet.sleep(0.1)
+
+        # the first event is being worked on, the second waits for
+        # a worker and the third fills the queue up
+        assert tracker.handle_event.call_args_list == []
+        assert (
+            [request.json() for request in cometd_server.request_history] ==
+            [
+                [message_maker.make_handshake_request(id=1)],
+                [
+                    message_maker.make_subscribe_request(
+                        id=2, subscription='/topic/example'),
+                ],
+                [message_maker.make_connect_request(id=3)],
+                [message_maker.make_connect_request(id=4)],
+            ]
+        )
+
+        work.send()
+        waiter.wait()
+
+        assert tracker.handle_event.call_args_list == [
+            call('/topic/example', {'spam': 'one'}),
+            call('/topic/example', {'spam': 'two'}),
+            call('/topic/example', {'spam': 'three'}),
+        ]
+        assert (
+            cometd_server.request_history[4].json() ==
+            [message_maker.make_connect_request(id=5)])
+
+        service.stop()
+
+
+class TestDispatch:
+
+    @pytest.fixture
+    def client(self):
+        client = BayeuxClient()
+        client.container = Mock()
+        return client
+
+    def test_dispatch_straight_away(self, client):
+        callback = Mock()
+        client.dispatch(callback, 'spam', 'ham')
+        assert callback.call_args == call('spam', 'ham')
+
+    def test_dispatch_via_queue(self, client):
+        client.max_pending_events = 2
+        client.start()
+        assert client.container.spawn_managed_thread.call_args_list == [
+            call(client._dispatch_pending_events),
+            call(client.run),
+        ]
+
+        callback = Mock()
+        client.dispatch(callback, 'spam')
+        client.dispatch(callback, 'ham')
+        assert client._pending_events.full()
+        assert callback.call_count == 0
+
+        dispatcher = eventlet.spawn(client._dispatch_pending_events)
+        try:
+            client._pending_events.join()
+        finally:
+            dispatcher.kill()
+
+        assert callback.call_args_list == [call('spam'), call('ham')]
+
+    @patch.object(BayeuxClient, 'disconnect')
+    def test_stop_with_pending_events(self, disconnect, client, caplog):
+        client.max_pending_events = 2
+        client.shutdown_deadline = 0  # the dispatcher is not running
+        client.start()
+        client.dispatch(Mock(), 'spam')
+        client.stop()
+        assert 'Stopping with 1 events pending' in caplog.text
+
+
+class TestBatchDelivery(MockedCometdServerTestCase):
+    """
+    Test batched event delivery
+
+    Events delivered in the same response or within the maximum wait
+    should be handled by one worker, batches are limited by the maximum
+    size.
+
+    """
+
+    @pytest.fixture
+    def service(self, config, container_factory, tracker):
+
+        class Service:
+
+            name = 'example_service'
+
+            @subscribe_batch('/topic/example', max_size=3, max_wait=0.2)
+            def handle_events(self, channel, payloads):
+                tracker.handle_events(channel, payloads)
+
+        container = container_factory(Service, config)
+
+        return container
+
+    @pytest.fixture
+    def responses(self, message_maker):
+
+        def make_events(*names):
+            return [
+                message_maker.make_event_delivery_message(
+                    channel='/topic/example', data={'spam': name})
+                for name in names
+            ]
+
+        responses = [
+            {'json': [message_maker.make_handshake_response()]},
+            {
+                'json': [
+                    message_maker.make_subscribe_response(
+                        subscription='/topic/example'),
+                ],
+            },
+            {
+                'json': [
+                    message_maker.make_connect_response(
+                        advice={'reconnect': Reconnection.retry.value}),
+                ],
+            },
+            {
+                'json': (
+                    [message_maker.make_connect_response()] +
+                    make_events('one', 'two', 'three', 'four')
+                ),
+            },
+            {
+                'json': (
+                    [message_maker.make_connect_response()] +
+                    make_events('five')
+                ),
+            },
+        ]
+        return responses
+
+    def test_batch_delivery(self, stack, tracker):
+        eventlet.sleep(0.3)  # let the max wait pass
+        assert tracker.handle_events.call_args_list == [
+            call(
+                '/topic/example',
+                [{'spam': 'one'}, {'spam': 'two'}, {'spam': 'three'}]),
+            call('/topic/example', [{'spam': 'four'}, {'spam': 'five'}]),
+        ]
+
+
+class TestBatchMessageHandler:
+
+    @pytest.fixture
+    def handler(self):
+        handler = BayeuxBatchMessageHandler('/topic/example', max_size=2)
+        handler.container = Mock()
+        handler.client = Mock()
+        handler.client.dispatch.side_effect = (
+            lambda callback, *args: callback(*args))
+        return handler
+
+    def test_flush_on_stop(self, handler):
+        handler.handle_message({'spam': 'one'})
+        timer = handler._flush_timer
+        assert handler.container.spawn_worker.call_count == 0
+
+        handler.stop()
+
+        assert timer.kill.call_count == 1
+        assert handler.container.spawn_worker.call_args[0][1] == (
+            '/topic/example', [{'spam': 'one'}])
+        assert handler.client.unregister_provider.call_args == call(handler)
+        # the pending events dispatcher may be gone already
+        assert handler.client.dispatch.call_count == 0
+
+    def test_ignore_events_after_stop(self, handler, caplog):
+        handler.stop()
+        handler.handle_message({'spam': 'one'}, '/topic/example')
+        assert handler._batch == []
+        assert handler.container.spawn_managed_thread.call_count == 0
+        assert handler.container.spawn_worker.call_count == 0
+        assert (
+            'Ignoring event of channel /topic/example delivered after stop'
+            in caplog.text)
+
+    def test_flush_nothing(self, handler):
+        handler.flush()
+        assert handler.client.dispatch.call_count == 0
+
+
+class TestWildcardSubscriptions(MockedCometdServerTestCase):
+    """
+    Test wildcard subscriptions
+
+    Events should be delivered to entrypoints of all matching channels
+    together with the name of the channel they were delivered to.
+    Messages of unexpected channels should be ignored.
+
+    """
+
+    @pytest.fixture
+    def service(self, config, container_factory, tracker):
+
+        class Service:
+
+            name = 'example_service'
+
+            @subscribe('/topic/*')
+            def handle_topic(self, channel, payload):
+                tracker.handle_topic(channel, payload)
+
+            @subscribe('/topic/**')
+            def handle_all_topics(self, channel, payload):
+                tracker.handle_all_topics(channel, payload)
+
+            @subscribe('/topic/example')
+            def handle_example(self, channel, payload):
+                tracker.handle_example(channel, payload)
+
+        container = container_factory(Service, config)
+
+        return container
+
+    @pytest.fixture
+    def responses(self, message_maker):
+        responses = [
+            {'json': [message_maker.make_handshake_response()]},
+            {
+                'json': [
+                    message_maker.make_subscribe_response(
+                        subscription='/topic/*'),
+                    message_maker.make_subscribe_response(
+                        subscription='/topic/**'),
+                    message_maker.make_subscribe_response(
+                        subscription='/topic/example'),
+                ],
+            },
+            {
+                'json': [
+                    message_maker.make_connect_response(
+                        advice={'reconnect': Reconnection.retry.value}),
+                ],
+            },
+            {
+                'json': [
+                    message_maker.make_connect_response(),
+                    message_maker.make_event_delivery_message(
+                        channel='/topic/example', data={'spam': 'one'}),
+                    message_maker.make_event_delivery_message(
+                        channel='/topic/other/deep', data={'spam': 'two'}),
+                    message_maker.make_event_delivery_message(
+                        channel='/unexpected', data={'spam': 'three'}),
+                ],
+            },
+        ]
+        return responses
+
+    def test_wildcard_subscriptions(
+        self, caplog, cometd_server, stack, tracker
+    ):
+        subscriptions = cometd_server.request_history[1].json()
+        assert set(message['subscription'] for message in subscriptions) == {
+            '/topic/*', '/topic/**', '/topic/example'
+        }
+        assert tracker.handle_topic.call_args_list == [
+            call('/topic/example', {'spam': 'one'}),
+        ]
+        assert tracker.handle_all_topics.call_args_list == [
+            call('/topic/example', {'spam': 'one'}),
+            call('/topic/other/deep', {'spam': 'two'}),
+        ]
+        assert tracker.handle_example.call_args_list == [
+            call('/topic/example', {'spam': 'one'}),
+        ]
+        # the stack is set up by a fixture
+        assert 'Unexpected message of channel /unexpected' in [
+            record.getMessage() for record in caplog.get_records('setup')]
+
+
+@pytest.mark.parametrize('channel_name', ['/*/example', '/topic/**/example'])
+def test_wildcard_not_last_rejected(channel_name):
+    client = BayeuxClient()
+    with pytest.raises(ValueError):
+        client.register_event_handler(channel_name, Mock())
+    assert client._channels == {}
+    assert client._subscriptions == set()
+
+
+class TestSharding:
+    """
+    Test subscriptions sharded across multiple sessions
+
+    Each shard should handshake for its own client ID, subscribe to its own
+    channels and run its own connection loop.
+
+    """
+
+    @pytest.fixture
+    def config(self, config):
+        config['BAYEUX']['SHARDS'] = 3
+        config['BAYEUX']['SHARD_MAP'] = {
+            '/topic/example-a': 0,
+            '/topic/example-b': 1,
+            '/topic/example-c': 1,
+        }
+        return config
+
+    @pytest.fixture
+    def service(self, config, container_factory, tracker):
+
+        class Service:
+
+            name = 'example_service'
+
+            @subscribe('/topic/example-a')
+            @subscribe('/topic/example-b')
+            @subscribe('/topic/example-c')
+            def handle_event(self, channel, payload):
+                tracker.handle_event(channel, payload)
+
+        return container_factory(Service, config)
+
+    @pytest.fixture
+    def cometd_server(self, config, message_maker):
+
+        client_ids = iter(['client-one', 'client-two'])
+        subscriptions = collections.defaultdict(set)
+        events = {
+            '/topic/example-a': [{'spam': 'one'}],
+            '/topic/example-b': [{'spam': 'two'}],
+            '/topic/example-c': [{'spam': 'three'}],
+        }
+
+        def respond(request, context):
+            responses = []
+            for message in request.json():
+                channel = message['channel']
+                if channel == '/meta/handshake':
+                    responses.append(message_maker.make_handshake_response(
+                        clientId=next(client_ids)))
+                    continue
+                client_id = message['clientId']
+                if channel == '/meta/subscribe':
+                    subscriptions[client_id].add(message['subscription'])
+                    responses.append(message_maker.make_subscribe_response(
+                        clientId=client_id,
+                        subscription=message['subscription']))
+                elif channel == '/meta/connect':
+                    responses.append(message_maker.make_connect_response(
+                        clientId=client_id,
+                        advice={'reconnect': Reconnection.retry.value}))
+                    for subscription in sorted(subscriptions[client_id]):
+                        while events[subscription]:
+                            responses.append(
+                                message_maker.make_event_delivery_message(
+                                    clientId=client_id,
+                                    channel=subscription,
+                                    data=events[subscription].pop(0)))
+                    eventlet.sleep(0.01)
+                else:
+                    responses.append(message_maker.make_disconnect_response(
+                        clientId=client_id))
+            return responses
+
+        with requests_mock.Mocker() as mocked_requests:
+            mocked_requests.post(config['BAYEUX']['SERVER_URI'], json=respond)
+            mocked_requests.subscriptions = subscriptions
+            yield mocked_requests
+
+    def test_sharding(self, cometd_server, service, tracker):
+
+        service.start()
+        with eventlet.Timeout(5):
+            while tracker.handle_event.call_count < 3:
+                eventlet.sleep(0.01)
+        service.stop()
+
+        assert cometd_server.subscriptions == {
+            'client-one': {'/topic/example-a'},
+            'client-two': {'/topic/example-b', '/topic/example-c'},
+        }
+        assert sorted(tracker.handle_event.call_args_list) == sorted([
+            call('/topic/example-a', {'spam': 'one'}),
+            call('/topic/example-b', {'spam': 'two'}),
+            call('/topic/example-c', {'spam': 'three'}),
+        ])
+        disconnects = [
+            request.json()[0]['clientId']
+            for request in cometd_server.request_history
+            if request.json()[0]['channel'] == '/meta/disconnect'
+        ]
+        assert sorted(disconnects) == ['client-one', 'client-two']
+
+    def test_runtime_subscriptions(
+        self, config, container_factory, cometd_server, tracker
+    ):
+
+        class Service:
+
+            name = 'example_service'
+
+            subscriptions = BayeuxSubscriptions()
+
+            @subscribe('/topic/example-a')
+            def handle_event(self, channel, payload):
+                self.subscriptions.add_subscription('/topic/example-b')
+
+            @subscribe('/topic/*', dynamic=True)
+            def handle_dynamic_event(self, channel, payload):
+                tracker.handle_event(channel, payload)
+
+        container = container_factory(Service, config)
+        client = get_extension(container, BayeuxClient)
+        container.start()
+        # only the shard of the static subscription is running
+        assert client._running_shards == [client.shards[0]]
+        client.add_subscription('/topic/example-a')  # subscribed already
+        assert client._running_shards == [client.shards[0]]
+        with eventlet.Timeout(5):
+            while tracker.handle_event.call_count < 2:
+                eventlet.sleep(0.01)
+        assert client.get_subscription_state('/topic/example-b') == (
+            SubscriptionState.subscribed)
+        client.remove_subscription('/topic/example-b')
+        assert client.get_subscription_state('/topic/example-b') == (
+            SubscriptionState.unsubscribing)
+        assert client.get_subscription_error('/topic/example-b') is None
+        container.stop()
+
+        assert client._running_shards == client.shards[:2]
+        assert cometd_server.subscriptions == {
+            'client-one': {'/topic/example-a'},
+            'client-two': {'/topic/example-b'},
+        }
+        # wildcard channels handle events of all matching channels
+        assert sorted(tracker.handle_event.call_args_list) == [
+            call('/topic/example-a', {'spam': 'one'}),
+            call('/topic/example-b', {'spam': 'two'}),
+        ]
+
+    def test_queued_messages_go_to_shard_of_channel(self, config):
+        client = BayeuxClient()
+        client.container = Mock(config=config)
+        client.setup()
+        client.shards = [
+            Mock(_subscriptions={}), Mock(_subscriptions={}),
+            Mock(_subscriptions={})]
+        client._running_shards = [client.shards[1]]
+        message = {'channel': '/topic/example-a'}
+
+        client.queue_message(message, print, urgent=True)
+        client.queue_message({'channel': '/topic/example-b'})
+
+        assert client.shards[0].queue_message.call_args == call(
+            message, print, True)
+        assert client._running_shards == [client.shards[1], client.shards[0]]
+        assert client.container.spawn_managed_thread.call_args == call(
+            client.shards[0].run)
+
+    def test_shards_share_pending_events(self, config):
+        config['BAYEUX']['MAX_PENDING_EVENTS'] = 1
+        client = BayeuxClient()
+        client.container = Mock(config=config)
+        client.setup()
+        client.start()
+        assert len(client.shards) == 3
+        for shard in client.shards:
+            assert shard._pending_events is client._pending_events
+
+        client.dispatch(Mock(), 'spam')
+        with patch.object(BayeuxClient, 'send_and_handle'):
+            with patch.object(client._pending_events, 'join') as join:
+                client.shards[0].connect()
+        assert join.call_count == 1
+
+    def test_shards_share_extensions(self, config, tmp_path):
+        config['BAYEUX']['REPLAY'] = {'PATH': str(tmp_path / 'checkpoints')}
+        client = BayeuxClient()
+        client.container = Mock(config=config)
+        client.setup()
+        client.start()
+        for shard in client.shards:
+            assert shard.extensions.extensions == client.extensions.extensions
+        message = client.shards[1].extensions.outgoing(
+            Subscribe(client).compose('/topic/example-b'))
+        assert message['ext'] == {'replay': {'/topic/example-b': -1}}
+
+    def test_shards_ack_their_own_sessions(self, config, tmp_path):
+        config['BAYEUX']['ACK'] = True
+        config['BAYEUX']['REPLAY'] = {'PATH': str(tmp_path / 'checkpoints')}
+        client = BayeuxClient()
+        client.container = Mock(config=config)
+        client.setup()
+        client.start()
+        for shard in client.shards:
+            ack_extensions = [
+                extension for extension in shard.extensions.extensions
+                if isinstance(extension, AckExtension)
+            ]
+            assert ack_extensions == [shard.ack_extension]
+            assert shard.ack_extension is not client.ack_extension
+
+        with patch.object(AckExtension, 'begin') as begin:
+            assert client.begin_ack('/topic/example-b') == begin.return_value
+        assert begin.call_args_list == [call()]
+        assert client.shards[1].ack_extension._batches == collections.deque()
+
+    def test_stop_disconnects_shards_independently(self, config, caplog):
+        client = BayeuxClient()
+        client.container = Mock(config=config)
+        client.shards = [
+            Mock(client_id='client-one'),
+            Mock(client_id='client-two'),
+            Mock(client_id='client-three'),
+        ]
+        # the second shard had no subscriptions to start with
+        client._running_shards = [client.shards[0], client.shards[2]]
+        client.shards[0].disconnect.side_effect = Reconnect('Boom')
+        with patch.object(SharedExtension, 'stop') as stop:
+            client.stop()
+        assert [shard.disconnect.call_count for shard in client.shards] == [
+            1, 0, 1]
+        assert 'Failed to disconnect client ID client-one' in caplog.text
+        assert stop.call_count == 1
+
+    def test_setup_shard_map_out_of_range(self, config):
+        config['BAYEUX']['SHARD_MAP']['/topic/example-d'] = 3
+        client = BayeuxClient()
+        client.container = Mock(config=config)
+        with pytest.raises(ValueError) as exc:
+            client.setup()
+        assert str(exc.value) == (
+            'Shard indexes out of range of 3 shards: /topic/example-d')
+
+    def test_shards_of_client_with_arguments(self, config):
+
+        class Client(BayeuxClient):
+            def __init__(self, credentials):
+                super().__init__()
+                self.credentials = credentials
+
+        client = Client('secret')
+        client.container = Mock(config=config)
+        client.setup()
+        client.start()
+        assert [shard.credentials for shard in client.shards] == [
+            'secret'] * 3
+
+    def test_get_shard_index(self, config):
+        client = BayeuxClient()
+        client.container = Mock(config=config)
+        client.setup()
+        assert client.get_shard_index('/topic/example-a') == 0
+        assert client.get_shard_index('/topic/example-c') == 1
+        assert client.get_shard_index('/topic/other') == (
+            zlib.crc32(b'/topic/other') % 3)
+
+
+class TestPublishing:
+    """
+    Test publishing events by workers
+
+    Events published by all workers should be collected and sent in one
+    request, either on their own or along with a connect request.
+
+    """
+
+    @pytest.fixture
+    def config(self, config):
+        config['BAYEUX']['PUBLISH'] = {'MAX_SIZE': 3, 'MAX_WAIT': 0.01}
+        return config
+
+    @pytest.fixture
+    def service(self, config, container_factory):
+
+        class Service:
+
+            name = 'example_service'
+
+            publish = BayeuxPublisher()
+
+            @subscribe('/topic/example')
+            def handle_event(self, channel, payload):
+                pass
+
+            @dummy
+            def publish_events(self, *channel_names):
+                results = [
+                    self.publish(channel_name, {'spam': 'ham'})
+                    for channel_name in channel_names]
+                return [result.done() for result in results], results
+
+        return container_factory(Service, config)
+
+    @pytest.fixture
+    def cometd_server(self, config, message_maker, waiter):
+
+        def respond(request, context):
+            responses = []
+            for message in request.json():
+                channel = message['channel']
+                if channel == '/meta/handshake':
+                    responses.append(message_maker.make_handshake_response())
+                elif channel == '/meta/subscribe':
+                    responses.append(message_maker.make_subscribe_response())
+                elif channel == '/meta/connect':
+                    if not waiter.ready():
+                        waiter.send()
+                    eventlet.sleep(0.5)
+                    responses.append(message_maker.make_connect_response(
+                        advice={'reconnect': Reconnection.retry.value}))
+                elif channel == '/meta/disconnect':
+                    responses.append(
+                        message_maker.make_disconnect_response())
+                elif channel == '/topic/rejected':
+                    responses.append({
+                        'channel': channel,
+                        'id': message['id'],
+                        'successful': False,
+                        'error': '403::Publish denied',
+                    })
+                else:
+                    responses.append({
+                        'channel': channel,
+                        'id': message['id'],
+                        'successful': True,
+                    })
+            return responses
+
+        with requests_mock.Mocker() as mocked_requests:
+            mocked_requests.post(config['BAYEUX']['SERVER_URI'], json=respond)
+            yield mocked_requests
+
+    def get_published(self, cometd_server):
+        return [
+            [message['channel'] for message in request.json()]
+            for request in cometd_server.request_history
+            if request.json()[0]['channel'].startswith('/topic/')
+        ]
+
+    def test_publishes_are_sent_in_one_request(
+        self, cometd_server, service, waiter
+    ):
+        service.start()
+        waiter.wait()
+
+        with entrypoint_hook(service, 'publish_events') as publish_events:
+            done, results = publish_events('/topic/a', '/topic/b')
+
+        assert done == [False, False]
+        with eventlet.Timeout(5):
+            replies = [result.result() for result in results]
+        assert [reply['successful'] for reply in replies] == [True, True]
+        assert self.get_published(cometd_server) == [['/topic/a', '/topic/b']]
+        service.stop()
+
+    def test_publishes_are_sent_when_max_size_reached(
+        self, cometd_server, service, waiter
+    ):
+        service.start()
+        waiter.wait()
+
+        with entrypoint_hook(service, 'publish_events') as publish_events:
+            done, results = publish_events(
+                '/topic/a', '/topic/b', '/topic/rejected')
+
+        assert done == [True, True, True]
+        assert results[0].result()['successful'] is True
+        with pytest.raises(PublishError) as exc:
+            results[2].result()
+        assert str(exc.value) == (
+            'Failed to publish event to channel /topic/rejected: '
+            '403::Publish denied')
+        service.stop()
+
+    def test_publishes_ride_on_connect_before_handshake(
+        self, cometd_server, service
+    ):
+        with entrypoint_hook(service, 'publish_events') as publish_events:
+            _, results = publish_events('/topic/a')
+
+        service.start()
+        with eventlet.Timeout(5):
+            assert results[0].result()['successful'] is True
+        service.stop()
+        connect = [
+            request.json() for request in cometd_server.request_history
+            if request.json()[-1]['channel'] == '/meta/connect'][0]
+        assert [message['channel'] for message in connect] == [
+            '/topic/a', '/meta/connect']
+
+    def test_stop_sends_pending_publishes(
+        self, config, cometd_server, service, waiter
+    ):
+        config['BAYEUX']['PUBLISH']['MAX_WAIT'] = 10
+        service.start()
+        waiter.wait()
+
+        with entrypoint_hook(service, 'publish_events') as publish_events:
+            _, results = publish_events('/topic/a')
+
+        service.stop()
+        assert results[0].result()['successful'] is True
+        assert self.get_published(cometd_server) == [['/topic/a']]
+
+    def test_sharded_client_flushes_running_shards(self):
+        client = BayeuxClient()
+        client.shards = [Mock(), Mock()]
+        client._running_shards = [client.shards[1]]
+
+        client.flush_outbound()
+
+        assert client.shards[0].flush_outbound.call_count == 0
+        assert client.shards[1].flush_outbound.call_count == 1
+
+    def test_result_timeout(self):
+        result = PublishResult('/topic/a')
+        with pytest.raises(eventlet.Timeout):
+            result.result(timeout=0.01)
+        assert not result.done()
+
+
+class TestShutdown:
+    """
+    Test stopping the service
+
+    The pending connect request should be aborted straight away and
+    in-flight workers should be given up to the shutdown deadline.
+
+    """
+
+    @pytest.fixture
+    def config(self, config):
+        config['BAYEUX']['SHUTDOWN_DEADLINE'] = 0.2
+        config['BAYEUX']['METRICS'] = 'memory'
+        return config
+
+    @pytest.fixture
+    def service(self, config, container_factory, tracker):
+
+        class Service:
+
+            name = 'example_service'
+
+            @subscribe('/topic/example')
+            def handle_event(self, channel, payload):
+                tracker.started(payload)
+                eventlet.sleep(payload['duration'])
+                tracker.completed(payload)
+
+        return container_factory(Service, config)
+
+    @pytest.fixture
+    def cometd_server(self, config, message_maker):
+
+        events = []
+
+        def respond(request, context):
+            responses = []
+            for message in request.json():
+                channel = message['channel']
+                if channel == '/meta/handshake':
+                    responses.append(message_maker.make_handshake_response())
+                elif channel == '/meta/subscribe':
+                    responses.append(message_maker.make_subscribe_response())
+                elif channel == '/meta/connect':
+                    responses.append(message_maker.make_connect_response(
+                        advice={'reconnect': Reconnection.retry.value}))
+                    if events:
+                        responses.append(
+                            message_maker.make_event_delivery_message(
+                                channel='/topic/example',
+                                data=events.pop(0)))
+                    else:
+                        eventlet.sleep(60)  # long poll
+                else:
+                    responses.append(
+                        message_maker.make_disconnect_response())
+            return responses
+
+        with requests_mock.Mocker() as mocked_requests:
+            mocked_requests.post(config['BAYEUX']['SERVER_URI'], json=respond)
+            mocked_requests.events = events
+            yield mocked_requests
+
+    def stop(self, service, tracker):
+        with eventlet.Timeout(5):
+            while not tracker.started.called:
+                eventlet.sleep(0.01)
+        started = time.perf_counter()
+        service.stop()
+        return time.perf_counter() - started
+
+    def test_workers_complete_within_deadline(
+        self, cometd_server, service, tracker, caplog
+    ):
+        cometd_server.events.append({'duration': 0.05})
+        service.start()
+
+        assert self.stop(service, tracker) < 1
+        assert tracker.completed.call_args == call({'duration': 0.05})
+        assert 'undelivered' not in caplog.text
+        assert cometd_server.request_history[-1].json()[0]['channel'] == (
+            '/meta/disconnect')
+
+    def test_workers_killed_after_deadline(
+        self, cometd_server, service, tracker, caplog
+    ):
+        cometd_server.events.append({'duration': 60})
+        service.start()
+
+        assert self.stop(service, tracker) < 1
+        assert tracker.completed.call_count == 0
+        assert (
+            'Stopping with 1 undelivered events of channel /topic/example'
+            in caplog.text)
+        client = get_extension(service, BayeuxClient)
+        assert client.metrics.get_counter(
+            'undelivered_events_total', channel='/topic/example') == 1
+
+    def test_worker_gone_before_completion(self, config, caplog):
+        client = BayeuxClient()
+        client.container = Mock(config=config, _worker_threads={})
+        client.setup()
+        client.shutdown_deadline = 0
+        client.track_worker(Mock(), [('/topic/example', 'one')])
+        client.record_undelivered([('/topic/example', 'two')])
+
+        client.shut_down()
+        client.shut_down()
+
+        assert caplog.text.count('undelivered events') == 1
+        assert (
+            'Stopping with 2 undelivered events of channel /topic/example'
+            in caplog.text)
+
+
+class TestPipelinedStartup:
+    """
+    Test pipelined startup
+
+    Subscriptions should be sent in concurrent chunks and the first connect
+    request should not wait for chunks but the first.
+
+    """
+
+    channel_names = [
+        '/topic/example-{}'.format(index) for index in range(5)]
+
+    @pytest.fixture
+    def config(self, config):
+        config['BAYEUX']['STARTUP'] = {'PIPELINED': True, 'CHUNK_SIZE': 2}
+        config['BAYEUX']['METRICS'] = 'memory'
+        return config
+
+    @pytest.fixture
+    def service(self, config, container_factory):
+
+        def handle_event(self, channel, payload):
+            pass
+
+        for channel_name in self.channel_names:
+            handle_event = subscribe(channel_name)(handle_event)
+
+        Service = type(
+            'Service', (), {
+                'name': 'example_service', 'handle_event': handle_event})
+
+        return container_factory(Service, config)
+
+    @pytest.fixture
+    def cometd_server(self, config, message_maker):
+
+        log = []
+        chunks = []
+        subscriptions = set()
+        failing_chunks = []
+
+        def respond(request, context):
+            messages = request.json()
+            channels = [message['channel'] for message in messages]
+            log.append(('request', channels))
+            responses = []
+            if channels[0] == '/meta/subscribe':
+                chunks.append(channels)
+                if len(chunks) > 1:
+                    eventlet.sleep(0.2)  # not the first chunk
+                    if failing_chunks:
+                        failing_chunks.pop()
+                        context.status_code = 500
+                        return []
+            for message in messages:
+                channel = message['channel']
+                if channel == '/meta/handshake':
+                    responses.append(message_maker.make_handshake_response())
+                elif channel == '/meta/subscribe':
+                    subscriptions.add(message['subscription'])
+                    responses.append(message_maker.make_subscribe_response(
+                        subscription=message['subscription']))
+                elif channel == '/meta/connect':
+                    eventlet.sleep(0.05)
+                    responses.append(message_maker.make_connect_response(
+                        advice={'reconnect': Reconnection.retry.value}))
+                else:
+                    responses.append(
+                        message_maker.make_disconnect_response())
+            log.append(('response', channels))
+            return responses
+
+        with requests_mock.Mocker() as mocked_requests:
+            mocked_requests.post(config['BAYEUX']['SERVER_URI'], json=respond)
+            mocked_requests.log = log
+            mocked_requests.subscriptions = subscriptions
+            mocked_requests.failing_chunks = failing_chunks
+            yield mocked_requests
+
+    def wait_for_subscriptions(self, cometd_server):
+        with eventlet.Timeout(5):
+            while cometd_server.subscriptions != set(self.channel_names):
+                eventlet.sleep(0.01)
+
+    def test_connect_follows_first_chunk(
+        self, cometd_server, service, caplog
+    ):
+        caplog.set_level(logging.INFO)
+        service.start()
+        self.wait_for_subscriptions(cometd_server)
+        client = get_extension(service, BayeuxClient)
+        with eventlet.Timeout(5):
+            while 'subscriptions' not in client.startup_timings:
+                eventlet.sleep(0.01)
+        service.stop()
+
+        requests = [
+            channels for entry, channels in cometd_server.log
+            if entry == 'request']
+        assert requests[:3] == [
+            ['/meta/handshake'], ['/meta/subscribe'] * 2, ['/meta/connect']]
+        assert sorted(requests[3:5]) == [
+            ['/meta/subscribe'], ['/meta/subscribe'] * 2]
+        # the first connect completes before the other chunks do
+        assert cometd_server.log.index(('response', ['/meta/connect'])) < (
+            cometd_server.log.index(('response', ['/meta/subscribe'])))
+        assert set(client.startup_timings) == {
+            'login', 'handshake', 'subscribe', 'connect', 'subscriptions'}
+        assert 'Started up in' in caplog.text
+        assert client.metrics.get_histogram(
+            'startup_phase_duration_seconds', phase='connect').count == 1
+        assert client.metrics.get_histogram(
+            'startup_phase_duration_seconds',
+            phase='subscriptions').count == 1
+
+    def test_failed_chunk_is_sent_with_connect(
+        self, cometd_server, service, caplog
+    ):
+        cometd_server.failing_chunks.append(True)
+        service.start()
+        self.wait_for_subscriptions(cometd_server)
+        service.stop()
+
+        assert 'Failed to subscribe to 2 channels' in caplog.text
+        assert ('request', [
+            '/meta/subscribe', '/meta/subscribe', '/meta/connect',
+        ]) in cometd_server.log
+
+    @patch.object(BayeuxClient, 'send_and_handle_control')
+    def test_subscriptions_timing_of_first_startup_only(
+        self, send_and_handle_control, config
+    ):
+        client = BayeuxClient()
+        client.container = Mock(config=config)
+        client.setup()
+
+        client._subscribe_chunks([['chunk']], time.perf_counter())
+        duration = client.startup_timings['subscriptions']
+        client._started_up = True
+        client._subscribe_chunks([['chunk']], time.perf_counter())
+
+        assert send_and_handle_control.call_args_list == [
+            call(['chunk']), call(['chunk'])]
+        assert client.startup_timings['subscriptions'] == duration
+        # the timing is reported along with the other phases
+        assert client.metrics.get_histogram(
+            'startup_phase_duration_seconds', phase='subscriptions') is None
+
+    def test_stop_while_subscribing(self, cometd_server, service):
+        service.start()
+        with eventlet.Timeout(5):
+            while ('request', ['/meta/connect']) not in cometd_server.log:
+                eventlet.sleep(0.01)
+        client = get_extension(service, BayeuxClient)
+        assert client._subscriber is not None
+
+        service.stop()
+
+        assert client._subscriber is None
+        assert cometd_server.subscriptions != set(self.channel_names)
+
+
+class TestMetrics(MockedCometdServerTestCase):
+    """
+    Test metrics collected on the hot path of the client
+    """
+
+    @pytest.fixture
+    def config(self, config):
+        config['BAYEUX']['METRICS'] = 'memory'
+        return config
+
+    @pytest.fixture
+    def service(self, config, container_factory, tracker):
+
+        class Service:
+
+            name = 'example_service'
+
+            metrics = BayeuxMetrics()
+
+            @subscribe('/topic/example')
+            def handle_event(self, channel, payload):
+                tracker.handle_event(channel, payload, self.metrics)
+
+        container = container_factory(Service, config)
+
+        return container
+
+    @pytest.fixture
+    def responses(self, message_maker):
+        responses = [
+            {'json': [message_maker.make_handshake_response()]},
+            {
+                'json': [
+                    message_maker.make_subscribe_response(
+                        subscription='/topic/example'),
+                ],
+            },
+            {
+                'json': [
+                    message_maker.make_connect_response(
+                        advice={'reconnect': Reconnection.retry.value}),
+                    message_maker.make_event_delivery_message(
+                        channel='/topic/example', data={'spam': 'one'}),
+                    message_maker.make_event_delivery_message(
+                        channel='/topic/example', data={'spam': 'two'}),
+                ],
+            },
+        ]
+        return responses
+
+    def test_metrics(self, service, stack, tracker):
+        metrics = get_extension(service, BayeuxClient).metrics
+
+        assert isinstance(metrics, InMemoryCollector)
+        assert tracker.handle_event.call_args_list == [
+            call('/topic/example', {'spam': 'one'}, metrics),
+            call('/topic/example', {'spam': 'two'}, metrics),
+        ]
+
+        def count(name, **labels):
+            return metrics.get_histogram(name, **labels).count
+
+        assert count(
+            'request_duration_seconds', channel='/meta/handshake') == 1
+        assert count(
+            'request_duration_seconds', channel='/meta/subscribe') == 1
+        assert count('request_duration_seconds', channel='/meta/connect') >= 2
+        requests = sum(
+            histogram.count
+            for (name, _), histogram in metrics.histograms.items()
+            if name == 'request_duration_seconds')
+        assert count('response_size_bytes') == requests
+        assert count('decode_duration_seconds') == requests
+        assert metrics.get_counter(
+            'events_total', channel='/topic/example') == 2
+        assert count(
+            'channel_handle_duration_seconds', channel='/topic/example') == 2
+        assert count(
+            'channel_handle_duration_seconds', channel='/meta/connect') >= 2
+        assert count(
+            'spawn_worker_duration_seconds', channel='/topic/example') == 2
+
+
+class TestReplay(MockedCometdServerTestCase):
+    """
+    Test replay of events following the last processed one
+
+    The client should ask for replaying events from the checkpointed
+    replay ID and checkpoint replay IDs of processed events.
+
+    """
+
+    @pytest.fixture
+    def store_path(self, tmp_path):
+        path = str(tmp_path / 'checkpoints.db')
+        SqliteCheckpointStore(path).save({'/topic/example': 5})
+        return path
+
+    @pytest.fixture
+    def config(self, config, store_path):
+        config['BAYEUX']['REPLAY'] = {'STORE': 'sqlite', 'PATH': store_path}
+        return config
+
+    @pytest.fixture
+    def responses(self, message_maker):
+
+        def make_event(replay_id):
+            return message_maker.make_event_delivery_message(
+                channel='/topic/example',
+                data={'event': {'replayId': replay_id}})
+
+        responses = [
+            {'json': [message_maker.make_handshake_response()]},
+            {
+                'json': [
+                    message_maker.make_subscribe_response(
+                        subscription='/topic/example'),
+                ],
+            },
+            {
+                'json': [
+                    message_maker.make_connect_response(
+                        advice={'reconnect': Reconnection.retry.value}),
+                    make_event(6),
+                ],
+            },
+            {
+                'json': [message_maker.make_connect_response(), make_event(7)],
+            },
+        ]
+        return responses
+
+    def test_replay(
+        self, cometd_server, message_maker, service, store_path, tracker,
+        waiter
+    ):
+        service.start()
+        waiter.wait()
+        service.stop()
+
+        requests = cometd_server.request_history[:2]
+        assert (
+            [request.json() for request in requests] ==
+            [
+                [
+                    message_maker.make_handshake_request(
+                        id=1, ext={'replay': True}),
+                ],
+                [
+                    message_maker.make_subscribe_request(
+                        id=2, subscription='/topic/example',
+                        ext={'replay': {'/topic/example': 5}}),
+                ],
+            ]
+        )
+        assert tracker.handle_event.call_count == 2
+        assert SqliteCheckpointStore(store_path).load() == {
+            '/topic/example': 7}
+
+
+class TestCheckpointing:
+
+    @pytest.fixture
+    def client(self, tmp_path):
+        client = BayeuxClient()
+        client.container = Mock()
+        client.replay = {'PATH': str(tmp_path / 'checkpoints.json')}
+        return client
+
+    def test_default_store(self, client, tmp_path):
+        client.start()
+        assert isinstance(client.checkpointer.store, FileCheckpointStore)
+        assert client.checkpointer.store.path == client.replay['PATH']
+        assert client.checkpointer.default == -1
+        assert call(client._flush_checkpoints) in (
+            client.container.spawn_managed_thread.call_args_list)
+
+    @pytest.mark.parametrize(('data', 'replay_id'), (
+        ({'event': {'replayId': 3}}, 3),
+        ({'event': {}}, None),
+        ({'spam': 'ham'}, None),
+        ('spam', None),
+        (None, None),
+    ))
+    def test_get_replay_id(self, client, data, replay_id):
+        assert client.get_replay_id(data) == replay_id
+
+    def test_checkpoint(self, client):
+        client.begin_checkpoint('/topic/example', {'event': {'replayId': 3}})
+        client.checkpoint('/topic/example', {'event': {'replayId': 3}})
+        client.start()
+        for replay_id in (4, 5):
+            client.begin_checkpoint(
+                '/topic/example', {'event': {'replayId': replay_id}})
+        client.begin_checkpoint('/topic/example', {'spam': 'ham'})
+        client.checkpoint('/topic/example', {'event': {'replayId': 5}})
+        client.checkpoint('/topic/example', {'spam': 'ham'})
+        # event 4 is still in flight
+        assert client.checkpointer.get('/topic/example') == -1
+        client.checkpoint('/topic/example', {'event': {'replayId': 4}})
+        assert client.checkpointer.get('/topic/example') == 5
+
+    def test_flush_checkpoints_periodically(self, client, caplog):
+        client.replay['FLUSH_INTERVAL'] = 0.01
+        client.start()
+        client.checkpointer = Mock()
+        client.checkpointer.flush.side_effect = [None, OSError('Boom'), None]
+        flusher = eventlet.spawn(client._flush_checkpoints)
+        try:
+            with eventlet.Timeout(1):
+                while client.checkpointer.flush.call_count < 3:
+                    eventlet.sleep(0.01)
+        finally:
+            flusher.kill()
+        assert 'Failed to save checkpoints' in caplog.text
+
+    def test_flush_checkpoints_when_due(self, client):
+        client.replay['FLUSH_INTERVAL'] = 60
+        client.replay['FLUSH_SIZE'] = 2
+        client.start()
+        flusher = eventlet.spawn(client._flush_checkpoints)
+        try:
+            with patch.object(client.checkpointer, 'flush') as flush:
+                client.checkpointer.update('/topic/example', 1)
+                eventlet.sleep(0.01)
+                assert flush.call_count == 0
+                client.checkpointer.update('/topic/example', 2)
+                client.checkpointer.update('/topic/example', 3)
+                eventlet.sleep(0.01)
+                assert flush.call_count == 1
+        finally:
+            flusher.kill()
+
+    def test_flush_checkpoints_on_stop_when_disconnect_fails(self, client):
+        client.start()
+        client.checkpointer.store = Mock()
+        client.checkpointer.update('/topic/example', 1)
+        with patch.object(BayeuxClient, 'disconnect') as disconnect:
+            disconnect.side_effect = Reconnect('Boom')
+            client.stop()
+        assert client.checkpointer.store.save.call_args == call(
+            {'/topic/example': 1})
+
+    def test_flush_checkpoints_on_stop_failing(self, client, caplog):
+        client.start()
+        client.checkpointer.store = Mock()
+        client.checkpointer.store.save.side_effect = OSError('Disk full')
+        client.checkpointer.update('/topic/example', 1)
+        with patch.object(BayeuxClient, 'disconnect'):
+            client.stop()
+        assert 'Failed to save checkpoints' in caplog.text
+
+    def test_handler_checkpoints_delivered_channel(self):
+        handler = BayeuxMessageHandler('/topic/*')
+        handler.client = Mock()
+        handler.container = Mock()
+        data = {'event': {'replayId': 1}}
+
+        handler.handle_message(data, '/topic/example')
+        assert handler.client.begin_checkpoint.call_args == call(
+            '/topic/example', data)
+
+        worker_ctx = Mock(args=('/topic/example', data))
+        assert handler.handle_result(worker_ctx, 'result', None) == (
+            'result', None)
+        assert handler.client.checkpoint.call_args == call(
+            '/topic/example', data)
+
+    def test_handler_acks_completed_worker(self):
+        handler = BayeuxMessageHandler('/topic/*')
+        handler.client = Mock()
+        handler.client.dispatch.side_effect = (
+            lambda callback, *args: callback(*args))
+        handler.container = Mock()
+
+        handler.handle_message('one', '/topic/a')
+
+        ack = handler.client.begin_ack.return_value
+        assert handler.client.begin_ack.call_args == call('/topic/*')
+        args, kwargs = handler.container.spawn_worker.call_args
+        assert ack.call_count == 0
+        kwargs['handle_result'](
+            Mock(args=args[1]), None, (ValueError, None, None))
+        assert ack.call_count == 1
+        assert handler.client.checkpoint.call_count == 0
+
+    def test_handler_orders_events_by_key(self):
+        handler = BayeuxMessageHandler(
+            '/topic/example', key=lambda data: data['id'])
+        handler.client = Mock()
+        handler.container = Mock()
+
+        handler.spawn_worker({'id': 1, 'seq': 1})
+        handler.spawn_worker({'id': 1, 'seq': 2})
+        assert handler.container.spawn_worker.call_count == 1
+
+        args, kwargs = handler.container.spawn_worker.call_args
+        kwargs['handle_result'](Mock(args=args[1]), 'result', None)
+        done, = handler.container.spawn_managed_thread.call_args[0]
+        done()
+        assert handler.container.spawn_worker.call_count == 2
+        args, _ = handler.container.spawn_worker.call_args
+        assert args[1] == ('/topic/example', {'id': 1, 'seq': 2})
+
+    def test_handler_key_failure(self, caplog):
+        handler = BayeuxMessageHandler(
+            '/topic/example', key=lambda data: data['id'])
+        handler.client = Mock()
+        handler.container = Mock()
+
+        handler.spawn_worker({'seq': 1})
+
+        assert handler.container.spawn_worker.call_count == 1
+        assert (
+            'Failed to get ordering key of event of channel /topic/example'
+            in caplog.text)
+
+    def test_handler_stops_with_ordered_events_pending(self, caplog):
+        handler = BayeuxMessageHandler('/topic/example', key=str)
+        handler.client = Mock()
+        handler.container = Mock()
+        handler.spawn_worker('one')
+        handler.spawn_worker('one')
+
+        handler.stop()
+
+        assert (
+            'Stopping with 1 ordered events of channel /topic/example pending'
+            in caplog.text)
+        assert handler.client.record_undelivered.call_args == call(
+            [('/topic/example', 'one')])
+
+    def test_handler_records_events_dispatched_after_stop(self):
+        handler = BayeuxMessageHandler('/topic/example')
+        handler.client = Mock()
+        handler.container = Mock()
+        handler.stop()
+
+        handler.spawn_worker('one', '/topic/example-a')
+
+        assert handler.container.spawn_worker.call_count == 0
+        assert handler.client.record_undelivered.call_args == call(
+            [('/topic/example-a', 'one')])
+
+    def test_batch_handler_records_batches_dispatched_after_stop(self):
+        handler = BayeuxBatchMessageHandler('/topic/example')
+        handler.client = Mock()
+        handler.container = Mock()
+        handler.stop()
+
+        handler.spawn_worker(['one', 'two'])
+
+        assert handler.container.spawn_worker.call_count == 0
+        assert handler.client.record_undelivered.call_args == call(
+            [('/topic/example', 'one'), ('/topic/example', 'two')])
+
+    def test_handler_without_acks(self):
+        handler = BayeuxMessageHandler('/topic/example')
+        handler.client = Mock()
+        worker_ctx = Mock(args=('/topic/example', 'one'))
+        assert handler.handle_result(worker_ctx, 'result', None) == (
+            'result', None)
+
+    def test_batch_handler_acks_completed_worker(self):
+        handler = BayeuxBatchMessageHandler('/topic/*', max_size=2)
+        handler.client = Mock()
+        handler.client.dispatch.side_effect = (
+            lambda callback, *args: callback(*args))
+        handler.client.begin_ack.side_effect = [Mock(), None]
+        handler.container = Mock()
+
+        handler.handle_message('one', '/topic/a')
+        handler.handle_message('two', '/topic/b')
+
+        args, kwargs = handler.container.spawn_worker.call_args
+        ack, _ = kwargs['handle_result'].keywords['acks']
+        assert ack.call_count == 0
+        kwargs['handle_result'](Mock(args=args[1]), 'result', None)
+        assert ack.call_count == 1
+
+    def test_handler_does_not_checkpoint_failed_worker(self):
+        handler = BayeuxMessageHandler('/topic/example')
+        handler.client = Mock()
+        worker_ctx = Mock(args=('/topic/example', 'one'))
+        exc_info = (ValueError, ValueError('Boom'), None)
+        assert handler.handle_result(worker_ctx, None, exc_info) == (
+            None, exc_info)
+        assert handler.client.checkpoint.call_count == 0
+
+    def test_batch_handler_checkpoints(self):
+        handler = BayeuxBatchMessageHandler('/topic/example')
+        handler.client = Mock()
+        worker_ctx = Mock(args=('/topic/example', ['one', 'two']))
+        assert handler.handle_result(worker_ctx, 'result', None) == (
+            'result', None)
+        assert handler.client.checkpoint.call_args_list == [
+            call('/topic/example', 'one'),
+            call('/topic/example', 'two'),
+        ]
+
+    def test_batch_handler_checkpoints_delivered_channels(self):
+        handler = BayeuxBatchMessageHandler('/topic/*', max_size=2)
+        handler.client = Mock()
+        handler.client.dispatch.side_effect = (
+            lambda callback, *args: callback(*args))
+        handler.container = Mock()
+
+        handler.handle_message('one', '/topic/a')
+        handler.handle_message('two', '/topic/b')
+
+        args, kwargs = handler.container.spawn_worker.call_args
+        assert args[1] == ('/topic/*', ['one', 'two'])
+        handle_result = kwargs['handle_result']
+
+        worker_ctx = Mock(args=args[1])
+        handle_result(worker_ctx, None, (ValueError, None, None))
+        assert handler.client.checkpoint.call_count == 0
+        handle_result(worker_ctx, 'result', None)
+        assert handler.client.checkpoint.call_args_list == [
+            call('/topic/a', 'one'),
+            call('/topic/b', 'two'),
+        ]
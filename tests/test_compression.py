@@ -0,0 +1,82 @@
+import zlib
+
+from mock import patch
+import pytest
+
+from nameko_bayeux_client import compression
+from nameko_bayeux_client.compression import Compression
+from nameko_bayeux_client.exceptions import Reconnect, ResponseTooLarge
+
+
+def test_disabled_by_default():
+    body = b'x' * 2048
+    compressor = Compression()
+    assert compressor.get_headers(body) == {}
+    assert compressor.compress(body) is body
+
+
+@pytest.mark.parametrize('encoding, decompress', [
+    ('gzip', lambda body: zlib.decompress(body, 16 + zlib.MAX_WBITS)),
+    ('deflate', zlib.decompress),
+])
+def test_compress(encoding, decompress):
+    body = b'x' * 2048
+    compressor = Compression(encoding=encoding)
+    assert compressor.get_headers(body) == {'Content-Encoding': encoding}
+    compressed = compressor.compress(body)
+    assert len(compressed) < len(body)
+    assert decompress(compressed) == body
+
+
+def test_small_bodies_are_not_compressed():
+    compressor = Compression(encoding='gzip', min_size=10)
+    assert compressor.get_headers(b'x' * 9) == {}
+    assert compressor.compress(b'x' * 9) == b'x' * 9
+    assert compressor.get_headers(b'x' * 10) == {'Content-Encoding': 'gzip'}
+
+
+@patch.object(compression, 'brotli')
+def test_compress_brotli(brotli):
+    compressor = Compression(encoding='br', level=20, accept_encoding=['br'])
+    assert compressor.get_headers(b'x' * 2048) == {
+        'Accept-Encoding': 'br', 'Content-Encoding': 'br'}
+    assert compressor.compress(b'x' * 2048) == brotli.compress.return_value
+    assert brotli.compress.call_args == ((b'x' * 2048,), {'quality': 11})
+
+
+@patch.object(compression, 'brotli', None)
+def test_brotli_not_installed(caplog):
+    compressor = Compression(
+        encoding='br', accept_encoding=['br', 'gzip'])
+    assert compressor.encoding == 'gzip'
+    assert compressor.accept_encoding == ['gzip']
+    assert 'Request encoding br is not installed' in caplog.text
+
+
+@patch.object(compression, 'brotli', None)
+def test_no_accepted_encoding_available():
+    compressor = Compression(accept_encoding=['br'])
+    assert compressor.get_headers(b'') == {'Accept-Encoding': 'identity'}
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError) as exc:
+        Compression(encoding='zstd')
+    assert str(exc.value) == (
+        'Unknown request encoding zstd, choose one of: br, deflate, gzip')
+
+
+def test_limit():
+    compressor = Compression(max_response_size=4)
+    chunks = compressor.limit(iter([b'ab', b'cd', b'e']))
+    assert next(chunks) == b'ab'
+    assert next(chunks) == b'cd'
+    with pytest.raises(ResponseTooLarge) as exc:
+        next(chunks)
+    assert isinstance(exc.value, Reconnect)
+    assert str(exc.value) == 'Response of Bayeux server exceeds 4 bytes'
+
+
+def test_no_limit():
+    chunks = [b'x' * 100] * 100
+    assert list(Compression().limit(chunks)) == chunks
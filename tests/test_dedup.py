@@ -0,0 +1,37 @@
+from mock import patch
+
+from nameko_bayeux_client.dedup import DeduplicationCache
+
+
+def test_seen():
+    cache = DeduplicationCache()
+    assert cache.seen('a') is False
+    assert cache.seen('b') is False
+    assert cache.seen('a') is True
+    assert len(cache) == 2
+
+
+def test_least_recently_seen_keys_are_evicted():
+    cache = DeduplicationCache(max_size=2)
+    cache.seen('a')
+    cache.seen('b')
+    cache.seen('a')  # refreshes a
+    cache.seen('c')  # evicts b
+    assert len(cache) == 2
+    assert cache.seen('a') is True
+    assert cache.seen('b') is False
+
+
+@patch('nameko_bayeux_client.dedup.time.monotonic')
+def test_keys_expire(monotonic):
+    cache = DeduplicationCache(ttl=10)
+    monotonic.return_value = 100
+    cache.seen('a')
+    monotonic.return_value = 105
+    cache.seen('b')
+    monotonic.return_value = 110
+    assert cache.seen('b') is True
+    assert cache.seen('a') is False
+    monotonic.return_value = 200
+    cache.seen('c')
+    assert len(cache) == 1
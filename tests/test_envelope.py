@@ -0,0 +1,57 @@
+import json
+
+from mock import Mock
+import pytest
+
+from nameko_bayeux_client.envelope import EventEnvelope
+
+
+def make_envelope(raw_data):
+    loads = Mock(side_effect=json.loads)
+    return EventEnvelope('/topic/a', '5', raw_data, loads), loads
+
+
+def test_metadata():
+    envelope, loads = make_envelope(b'{"spam": "egg"}')
+    assert envelope.channel == '/topic/a'
+    assert envelope.id == '5'
+    assert repr(envelope) == '<EventEnvelope /topic/a id=5>'
+    assert loads.call_count == 0
+
+
+def test_data_are_decoded_once_on_first_access():
+    envelope, loads = make_envelope(b'{"spam": "egg"}')
+    assert envelope.decoded is False
+    assert envelope.data == {'spam': 'egg'}
+    assert envelope.decoded is True
+    assert envelope.data == {'spam': 'egg'}
+    assert loads.call_count == 1
+
+
+def test_replay_id_is_found_without_decoding_data():
+    envelope, loads = make_envelope(
+        b'{"payload": {"a": [1, 2]}, "event": {"replayId": 11}}')
+    assert envelope.replay_id == 11
+    assert envelope.replay_id == 11
+    assert envelope.decoded is False
+    assert loads.call_args_list == [((b'11',),)]
+
+
+def test_replay_id_of_decoded_data():
+    envelope, _ = make_envelope(b'{"event": {"replayId": 11}}')
+    envelope.data
+    assert envelope.replay_id == 11
+
+
+@pytest.mark.parametrize('raw_data', [
+    b'"spam"',
+    b'{"payload": {}}',
+    b'{"event": []}',
+    b'{"event": {"createdDate": "2024-01-01"}}',
+])
+def test_no_replay_id(raw_data):
+    envelope, _ = make_envelope(raw_data)
+    assert envelope.replay_id is None
+    envelope, _ = make_envelope(raw_data)
+    envelope.data
+    assert envelope.replay_id is None
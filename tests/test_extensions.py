@@ -0,0 +1,190 @@
+from mock import Mock
+import pytest
+
+from nameko_bayeux_client.extensions import (
+    AckExtension,
+    ExtensionPipeline,
+    MessageExtension,
+    ReplayExtension,
+)
+
+
+class Recorder(MessageExtension):
+
+    def __init__(self, name, calls, channel_names=None):
+        self.name = name
+        self.calls = calls
+        self.channel_names = channel_names
+
+    def outgoing(self, message):
+        self.calls.append(('outgoing', self.name))
+        message.setdefault('ext', {})[self.name] = True
+        return message
+
+    def incoming(self, message):
+        self.calls.append(('incoming', self.name))
+        return message
+
+
+class Dropper(MessageExtension):
+
+    def incoming(self, message):
+        return None
+
+
+def test_empty_pipeline():
+    pipeline = ExtensionPipeline()
+    assert not pipeline
+    message = {'channel': '/topic/a'}
+    assert pipeline.outgoing(message) is message
+    assert pipeline.incoming(message) is message
+
+
+def test_hooks_order():
+    calls = []
+    pipeline = ExtensionPipeline()
+    pipeline.register(Recorder('one', calls))
+    pipeline.register(Recorder('two', calls))
+    assert pipeline
+
+    message = pipeline.outgoing({'channel': '/meta/connect'})
+    pipeline.incoming({'channel': '/meta/connect'})
+
+    assert message['ext'] == {'one': True, 'two': True}
+    assert calls == [
+        ('outgoing', 'one'), ('outgoing', 'two'),
+        ('incoming', 'two'), ('incoming', 'one'),
+    ]
+
+
+def test_hooks_of_channels():
+    calls = []
+    pipeline = ExtensionPipeline()
+    pipeline.register(Recorder('one', calls, channel_names={'/topic/a'}))
+    pipeline.register(MessageExtension())
+    pipeline.resolve(['/topic/a', '/topic/b'])
+
+    # hooks not overridden are not called
+    assert pipeline._outgoing == {
+        '/topic/a': (pipeline.extensions[0].outgoing,),
+        '/topic/b': (),
+    }
+
+    pipeline.outgoing({'channel': '/topic/a'})
+    pipeline.outgoing({'channel': '/topic/b'})
+    pipeline.outgoing({'channel': '/topic/c'})  # resolved when first seen
+    assert calls == [('outgoing', 'one')]
+    assert '/topic/c' in pipeline._outgoing
+
+
+def test_register_clears_resolved_hooks():
+    pipeline = ExtensionPipeline()
+    pipeline.resolve(['/topic/a'])
+    pipeline.register(MessageExtension())
+    assert pipeline._outgoing == {}
+    assert pipeline._incoming == {}
+
+
+def test_drop_message():
+    calls = []
+    pipeline = ExtensionPipeline()
+    pipeline.register(Recorder('one', calls))
+    pipeline.register(Dropper())
+    assert pipeline.incoming({'channel': '/topic/a'}) is None
+    assert calls == []
+
+
+def test_base_hooks_pass_messages():
+    extension = MessageExtension()
+    message = {'channel': '/topic/a'}
+    assert extension.outgoing(message) is message
+    assert extension.incoming(message) is message
+
+
+class TestReplayExtension:
+
+    def test_handshake(self):
+        extension = ReplayExtension(Mock())
+        message = extension.outgoing({'channel': '/meta/handshake'})
+        assert message['ext'] == {'replay': True}
+
+    def test_subscribe(self):
+        checkpointer = Mock()
+        checkpointer.get.return_value = 123
+        extension = ReplayExtension(checkpointer)
+        message = extension.outgoing(
+            {'channel': '/meta/subscribe', 'subscription': '/spam/ham'})
+        assert message['ext'] == {'replay': {'/spam/ham': 123}}
+
+    def test_channels(self):
+        extension = ReplayExtension(Mock())
+        assert extension.matches('/meta/handshake')
+        assert extension.matches('/meta/subscribe')
+        assert not extension.matches('/meta/connect')
+
+
+class TestAckExtension:
+
+    @pytest.fixture
+    def extension(self):
+        extension = AckExtension()
+        extension.outgoing({'channel': '/meta/handshake'})
+        extension.incoming(
+            {'channel': '/meta/handshake', 'ext': {'ack': True}})
+        return extension
+
+    def connected(self, extension, batch_id):
+        extension.incoming({
+            'channel': '/meta/connect',
+            'successful': True,
+            'ext': {'ack': batch_id},
+        })
+
+    def connect(self, extension):
+        return extension.outgoing({'channel': '/meta/connect'})['ext']['ack']
+
+    def test_handshake(self):
+        extension = AckExtension()
+        message = extension.outgoing({'channel': '/meta/handshake'})
+        assert message['ext'] == {'ack': True}
+
+    def test_server_does_not_support_acks(self):
+        extension = AckExtension()
+        extension.incoming({'channel': '/meta/handshake'})
+        assert extension.enabled is False
+        assert extension.outgoing({'channel': '/meta/connect'}) == {
+            'channel': '/meta/connect', 'ext': {}}
+
+    def test_ack_batches_of_completed_workers(self, extension):
+        assert self.connect(extension) == 0
+
+        # events of the first batch are delivered before connect response
+        complete_one = extension.begin()
+        complete_two = extension.begin()
+        self.connected(extension, 1)
+        assert self.connect(extension) == 0
+
+        self.connected(extension, 2)  # empty batch
+        complete_three = extension.begin()
+        self.connected(extension, 3)
+
+        complete_two()
+        complete_one()
+        assert self.connect(extension) == 2
+        complete_three()
+        assert self.connect(extension) == 3
+
+    def test_unsuccessful_connect(self, extension):
+        extension.begin()()
+        extension.incoming({'channel': '/meta/connect', 'successful': False})
+        assert self.connect(extension) == 0
+
+    def test_handshake_resets_acks(self, extension):
+        complete = extension.begin()
+        self.connected(extension, 5)
+        complete()
+        assert self.connect(extension) == 5
+
+        extension.incoming(
+            {'channel': '/meta/handshake', 'ext': {'ack': True}})
+        assert self.connect(extension) == 0
@@ -0,0 +1,115 @@
+import pytest
+
+from nameko_bayeux_client import metrics
+
+
+def test_collector_collects_nothing():
+    collector = metrics.MetricsCollector()
+    collector.increment('events_total', channel='/topic/a')
+    collector.observe('request_duration_seconds', 0.1)
+
+
+@pytest.mark.parametrize(('name', 'collector_class'), (
+    (None, metrics.MetricsCollector),
+    ('memory', metrics.InMemoryCollector),
+    ('prometheus', metrics.PrometheusCollector),
+))
+def test_get_collector(name, collector_class):
+    assert type(metrics.get_collector(name)) is collector_class
+
+
+def test_get_unknown_collector():
+    with pytest.raises(ValueError) as exc:
+        metrics.get_collector('statsd')
+    assert str(exc.value) == (
+        'Unknown metrics collector statsd, choose one of: memory, prometheus')
+
+
+class TestHistogram:
+
+    def test_observe(self):
+        histogram = metrics.Histogram((1, 10))
+        for value in (0.5, 1, 5, 20):
+            histogram.observe(value)
+        assert histogram.count == 4
+        assert histogram.sum == 26.5
+        assert histogram.counts == [2, 1, 1]
+        assert list(histogram.cumulative_counts()) == [
+            (1, 2), (10, 3), (float('inf'), 4)]
+
+
+class TestInMemoryCollector:
+
+    @pytest.fixture
+    def collector(self):
+        return metrics.InMemoryCollector()
+
+    def test_increment(self, collector):
+        collector.increment('events_total', channel='/topic/a')
+        collector.increment('events_total', 2, channel='/topic/a')
+        collector.increment('events_total', channel='/topic/b')
+        assert collector.get_counter('events_total', channel='/topic/a') == 3
+        assert collector.get_counter('events_total', channel='/topic/b') == 1
+        assert collector.get_counter('events_total', channel='/topic/c') == 0
+
+    def test_observe(self, collector):
+        collector.observe('request_duration_seconds', 0.2, channel='/a')
+        collector.observe('request_duration_seconds', 0.4, channel='/a')
+        histogram = collector.get_histogram(
+            'request_duration_seconds', channel='/a')
+        assert histogram.count == 2
+        assert histogram.sum == pytest.approx(0.6)
+        assert histogram.buckets == metrics.DURATION_BUCKETS
+        assert collector.get_histogram(
+            'request_duration_seconds', channel='/b') is None
+
+    def test_size_buckets(self, collector):
+        collector.observe('response_size_bytes', 2048)
+        histogram = collector.get_histogram('response_size_bytes')
+        assert histogram.buckets == metrics.SIZE_BUCKETS
+
+
+class TestPrometheusCollector:
+
+    @pytest.fixture
+    def collector(self):
+
+        class Collector(metrics.PrometheusCollector):
+            def get_buckets(self, name):
+                return (0.5, 1)
+
+        return Collector()
+
+    def test_render(self, collector):
+        collector.increment('events_total', channel='/topic/b')
+        collector.increment('events_total', 2, channel='/topic/a')
+        collector.observe('decode_duration_seconds', 0.25)
+        collector.observe('decode_duration_seconds', 2)
+        assert collector.render() == (
+            '# TYPE bayeux_events_total counter\n'
+            'bayeux_events_total{channel="/topic/a"} 2\n'
+            'bayeux_events_total{channel="/topic/b"} 1\n'
+            '# TYPE bayeux_decode_duration_seconds histogram\n'
+            'bayeux_decode_duration_seconds_bucket{le="0.5"} 1\n'
+            'bayeux_decode_duration_seconds_bucket{le="1.0"} 1\n'
+            'bayeux_decode_duration_seconds_bucket{le="+Inf"} 2\n'
+            'bayeux_decode_duration_seconds_sum 2.25\n'
+            'bayeux_decode_duration_seconds_count 2\n'
+        )
+
+    def test_render_nothing(self, collector):
+        assert collector.render() == ''
+
+    def test_render_escapes_label_values(self, collector):
+        collector.increment('events_total', channel='a"b\\c\nd')
+        assert (
+            'bayeux_events_total{channel="a\\"b\\\\c\\nd"} 1\n' in
+            collector.render())
+
+    def test_render_prefix(self):
+        collector = metrics.PrometheusCollector(prefix='cometd_')
+        collector.increment('reconnects_total', reconnection='retry')
+        assert collector.render() == (
+            '# TYPE cometd_reconnects_total counter\n'
+            'cometd_reconnects_total{reconnection="retry"} 1\n'
+        )
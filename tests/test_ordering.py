@@ -0,0 +1,86 @@
+import pytest
+
+from nameko_bayeux_client.ordering import KeyedScheduler
+
+
+class Tasks:
+    """ Records tasks started and keeps their done callbacks """
+
+    def __init__(self):
+        self.started = []
+        self.done = {}
+
+    def make(self, name):
+        def task(done):
+            self.started.append(name)
+            self.done[name] = done
+        return task
+
+
+@pytest.fixture
+def tasks():
+    return Tasks()
+
+
+def test_tasks_of_the_same_key_run_in_order(tasks):
+    scheduler = KeyedScheduler()
+    scheduler.submit('a', tasks.make('a1'))
+    scheduler.submit('a', tasks.make('a2'))
+    scheduler.submit('b', tasks.make('b1'))
+    assert tasks.started == ['a1', 'b1']
+    assert scheduler.running == 2
+    assert len(scheduler) == 1
+
+    tasks.done['a1']()
+    assert tasks.started == ['a1', 'b1', 'a2']
+    tasks.done['a2']()
+    tasks.done['b1']()
+    assert scheduler.running == 0
+    assert len(scheduler) == 0
+    assert scheduler._pending == {}
+
+
+def test_max_concurrency(tasks):
+    scheduler = KeyedScheduler(max_concurrency=2)
+    scheduler.submit('a', tasks.make('a1'))
+    scheduler.submit('b', tasks.make('b1'))
+    scheduler.submit('c', tasks.make('c1'))
+    scheduler.submit('a', tasks.make('a2'))
+    assert tasks.started == ['a1', 'b1']
+
+    # keys take turns in the order they became ready
+    tasks.done['a1']()
+    assert tasks.started == ['a1', 'b1', 'c1']
+    tasks.done['b1']()
+    assert tasks.started == ['a1', 'b1', 'c1', 'a2']
+
+
+def test_failed_task_frees_its_slot(tasks):
+    scheduler = KeyedScheduler(max_concurrency=1)
+
+    def fail(done):
+        raise ValueError('Boom')
+
+    with pytest.raises(ValueError):
+        scheduler.submit('a', fail)
+    assert scheduler.running == 0
+
+    scheduler.submit('a', tasks.make('a2'))
+    assert tasks.started == ['a2']
+
+
+def test_clear(tasks):
+    scheduler = KeyedScheduler(max_concurrency=1)
+    scheduler.submit('a', tasks.make('a1'))
+    scheduler.submit('a', tasks.make('a2'))
+    scheduler.submit('b', tasks.make('b1'))
+
+    assert len(scheduler.clear()) == 2
+    assert len(scheduler) == 0
+
+    # the running task still starts tasks submitted later
+    scheduler.submit('a', tasks.make('a3'))
+    tasks.done['a1']()
+    assert tasks.started == ['a1', 'a3']
+    tasks.done['a3']()
+    assert scheduler._pending == {}
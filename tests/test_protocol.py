@@ -0,0 +1,705 @@
+import asyncio
+import collections
+
+import pytest
+
+from nameko_bayeux_client.client import BayeuxClient
+from nameko_bayeux_client.constants import (
+    ConnectionType, Reconnection, SubscriptionState)
+from nameko_bayeux_client.envelope import EventEnvelope
+from nameko_bayeux_client.exceptions import BayeuxError, Reconnect
+from nameko_bayeux_client.extensions import MessageExtension
+from nameko_bayeux_client.metrics import InMemoryCollector
+from nameko_bayeux_client.protocol import BayeuxProtocol
+
+
+class ServerGone(Exception):
+    pass
+
+
+class FakeServer:
+    """ Answers request messages following a script of connect responses
+
+    Each connect request is answered by the next list of messages of the
+    script, after the script is exhausted the server is gone.
+
+    """
+
+    def __init__(self, *connect_responses):
+        self.requests = []
+        self.connect_responses = list(connect_responses)
+        self.rejected_subscriptions = set()
+
+    def send_and_receive(self, messages):
+        if not isinstance(messages, list):
+            messages = [messages]
+        self.requests.append(messages)
+        messages_in = []
+        for message in messages:
+            channel_name = message['channel']
+            if channel_name == '/meta/connect':
+                if not self.connect_responses:
+                    raise ServerGone()
+                messages_in.extend(self.connect_responses.pop(0))
+            elif channel_name == '/meta/handshake':
+                messages_in.append({
+                    'channel': channel_name,
+                    'clientId': 'client-{}'.format(len(self.requests)),
+                    'supportedConnectionTypes': ['long-polling'],
+                    'version': '1.0',
+                    'successful': True,
+                    'ext': message.get('ext', {}),
+                })
+            else:
+                subscription = message.get('subscription')
+                rejected = subscription in self.rejected_subscriptions
+                messages_in.append({
+                    'channel': channel_name,
+                    'id': message.get('id'),
+                    'successful': not rejected,
+                    'subscription': subscription,
+                })
+                if rejected:
+                    messages_in[-1]['error'] = '403::Forbidden'
+
+        return messages_in
+
+    def get_channels(self):
+        return [
+            [message['channel'] for message in messages]
+            for messages in self.requests
+        ]
+
+
+class EventletEngine:
+
+    def __init__(self, config, server):
+        self.client = BayeuxClient()
+        self.client.container = collections.namedtuple(
+            'container', ('config',))(config={'BAYEUX': config})
+        self.client.setup()
+        self.client.send_and_receive = server.send_and_receive
+        # control requests take a connection of their own
+        self.client.send_and_handle_control = (
+            lambda messages: self.client.handle(
+                server.send_and_receive(messages)))
+
+    def call(self, method_name, *args):
+        return getattr(self.client, method_name)(*args)
+
+    def close(self):
+        pass
+
+
+class AsyncioEngine:
+
+    def __init__(self, config, server):
+        from nameko_bayeux_client.aio import AsyncBayeuxClient
+
+        async def send_and_receive(messages):
+            return server.send_and_receive(messages)
+
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncBayeuxClient(config)
+        self.client.send_and_receive = send_and_receive
+
+    def call(self, method_name, *args):
+        return self.loop.run_until_complete(
+            getattr(self.client, method_name)(*args))
+
+    def close(self):
+        self.loop.close()
+
+
+@pytest.fixture(params=['eventlet', 'asyncio'])
+def make_engine(request):
+
+    if request.param == 'asyncio':
+        pytest.importorskip('aiohttp')
+
+    engine_class = {
+        'eventlet': EventletEngine,
+        'asyncio': AsyncioEngine,
+    }[request.param]
+    engines = []
+
+    def make_engine(server, **config):
+        config.setdefault('SERVER_URI', 'http://localhost/cometd')
+        engine = engine_class(config, server)
+        engine.client._register_meta_channels()
+        engines.append(engine)
+        return engine
+
+    yield make_engine
+
+    for engine in engines:
+        engine.close()
+
+
+def event(channel_name, data):
+    return {'channel': channel_name, 'data': data}
+
+
+def connected(**advice):
+    return {'channel': '/meta/connect', 'successful': True, 'advice': advice}
+
+
+def test_handshake(make_engine):
+    server = FakeServer()
+    engine = make_engine(server, VERSION='1.0', MINIMUM_VERSION='1.0')
+
+    engine.call('handshake')
+
+    assert server.requests == [[{
+        'id': 1,
+        'channel': '/meta/handshake',
+        'version': '1.0',
+        'minimumVersion': '1.0',
+        'supportedConnectionTypes': ['long-polling'],
+    }]]
+    assert engine.client.client_id == 'client-1'
+    assert engine.client.connection_type == ConnectionType.long_polling
+
+
+def test_subscribe(make_engine):
+    server = FakeServer()
+    engine = make_engine(server)
+    engine.client.register_event_handler('/topic/a', print)
+
+    engine.call('handshake')
+    engine.call('subscribe')
+
+    assert server.requests[1] == [{
+        'id': 2,
+        'channel': '/meta/subscribe',
+        'clientId': 'client-1',
+        'subscription': '/topic/a',
+    }]
+
+
+def test_connect_delivers_events(make_engine):
+    server = FakeServer([
+        connected(),
+        event('/topic/a', 'a'),
+        event('/topic/b/c', 'c'),
+    ])
+    engine = make_engine(server)
+    delivered = []
+    engine.client.register_event_handler('/topic/a', delivered.append)
+    engine.client.register_event_handler(
+        '/topic/**', lambda data, channel: delivered.append((channel, data)))
+
+    engine.call('handshake')
+    engine.call('connect')
+
+    assert server.requests[1] == [{
+        'id': 2,
+        'channel': '/meta/connect',
+        'clientId': 'client-1',
+        'connectionType': 'long-polling',
+    }]
+    assert sorted(delivered, key=str) == [
+        ('/topic/a', 'a'), ('/topic/b/c', 'c'), 'a']
+
+
+def test_connect_takes_advice(make_engine):
+    server = FakeServer(
+        [connected(timeout=5000, interval=10, reconnect='retry')])
+    engine = make_engine(server)
+
+    engine.call('handshake')
+    engine.call('connect')
+
+    assert engine.client.timeout == 5000
+    assert engine.client.interval == 10
+    assert engine.client.reconnection == Reconnection.retry
+
+
+def test_run(make_engine):
+    server = FakeServer(
+        [connected(reconnect='retry', interval=0)],
+        [connected(), event('/topic/a', 'a')],
+        [connected(reconnect='handshake')],
+        [{
+            'channel': '/meta/connect',
+            'successful': False,
+            'advice': {'reconnect': 'retry'},
+        }],
+        [connected(reconnect='retry')],
+    )
+    engine = make_engine(server, BACKOFF_BASE=0)
+    delivered = []
+    engine.client.register_event_handler('/topic/a', delivered.append)
+
+    with pytest.raises(ServerGone):
+        engine.call('run')
+
+    assert server.get_channels() == [
+        ['/meta/handshake'],
+        ['/meta/subscribe'],
+        ['/meta/connect'],
+        ['/meta/connect'],
+        ['/meta/connect'],
+        ['/meta/handshake'],
+        ['/meta/subscribe'],
+        ['/meta/connect'],
+        ['/meta/connect'],  # retried after unsuccessful connect
+        ['/meta/connect'],
+    ]
+    assert delivered == ['a']
+    assert engine.client.backoff.failures == 0
+
+
+def test_duplicate_events_are_dropped(make_engine):
+    replayed = {'event': {'replayId': 7}}
+    server = FakeServer(
+        [connected(), event('/topic/a', replayed), event('/topic/b', 'b')],
+        [connected(reconnect='handshake')],
+        [
+            connected(reconnect='retry'),
+            event('/topic/a', replayed),  # resent after handshake
+            event('/topic/a', {'event': {'replayId': 8}}),
+            event('/topic/b', replayed),  # same replay ID, other channel
+            event('/topic/b', 'b'),  # no ID
+        ],
+    )
+    engine = make_engine(server, DEDUP={'MAX_SIZE': 10})
+    engine.client.metrics = InMemoryCollector()
+    delivered = []
+    engine.client.register_event_handler('/topic/a', delivered.append)
+    engine.client.register_event_handler('/topic/b', delivered.append)
+
+    with pytest.raises(ServerGone):
+        engine.call('run')
+
+    assert delivered == [
+        replayed, 'b', {'event': {'replayId': 8}}, replayed, 'b']
+    assert engine.client.metrics.get_counter(
+        'duplicate_events_total', channel='/topic/a') == 1
+    assert engine.client.metrics.get_counter(
+        'events_total', channel='/topic/a') == 2
+
+
+def test_duplicate_events_by_message_id(make_engine):
+    server = FakeServer([
+        connected(),
+        dict(event('/topic/a', 'a'), id='1'),
+        dict(event('/topic/a', 'a'), id='1'),
+        dict(event('/topic/a', 'b'), id='2'),
+    ])
+    engine = make_engine(server, DEDUP={'TTL': 60})
+    delivered = []
+    engine.client.register_event_handler('/topic/a', delivered.append)
+
+    engine.call('handshake')
+    engine.call('connect')
+
+    assert delivered == ['a', 'b']
+
+
+def test_message_extensions(make_engine):
+
+    class AckExtension(MessageExtension):
+
+        channel_names = ('/meta/connect', '/topic/a')
+
+        def outgoing(self, message):
+            message['ext'] = {'ack': True}
+            return message
+
+        def incoming(self, message):
+            if message.get('data') == 'drop':
+                return None
+            return message
+
+    server = FakeServer([
+        connected(),
+        event('/topic/a', 'drop'),
+        event('/topic/a', 'a'),
+    ])
+    engine = make_engine(server)
+    engine.client.register_extension(AckExtension())
+    delivered = []
+    engine.client.register_event_handler('/topic/a', delivered.append)
+    engine.client.resolve_extensions()
+
+    engine.call('handshake')
+    engine.call('connect')
+
+    handshake, connect = server.requests
+    assert 'ext' not in handshake[0]
+    assert connect[0]['ext'] == {'ack': True}
+    assert delivered == ['a']
+
+
+def test_ack(make_engine):
+    server = FakeServer(
+        [event('/topic/a', 'a'), dict(connected(), ext={'ack': 1})],
+        [dict(connected(), ext={'ack': 2})],
+    )
+    engine = make_engine(server, ACK=True)
+    acks = []
+    engine.client.register_event_handler(
+        '/topic/a',
+        lambda data: acks.append(engine.client.begin_ack('/topic/a')))
+    engine.client.resolve_extensions()
+
+    engine.call('handshake')
+    engine.call('connect')
+    engine.call('connect')
+    acks.pop()()  # the worker completes
+    with pytest.raises(ServerGone):
+        engine.call('connect')
+
+    assert server.requests[0][0]['ext'] == {'ack': True}
+    assert [messages[0]['ext'] for messages in server.requests[1:]] == [
+        {'ack': 0}, {'ack': 0}, {'ack': 2}]
+
+
+def test_disconnect(make_engine):
+    server = FakeServer()
+    engine = make_engine(server)
+
+    engine.call('handshake')
+    engine.call('disconnect')
+
+    assert server.requests[1] == [{
+        'id': 2,
+        'channel': '/meta/disconnect',
+        'clientId': 'client-1',
+    }]
+
+
+def test_unsuccessful_subscribe(make_engine):
+
+    class Server(FakeServer):
+        def send_and_receive(self, messages):
+            messages_in = super().send_and_receive(messages)
+            for message in messages_in:
+                message['successful'] = message['channel'] != (
+                    '/meta/subscribe')
+            return messages_in
+
+    engine = make_engine(Server())
+    engine.client.register_event_handler('/topic/a', print)
+
+    engine.call('handshake')
+    with pytest.raises(BayeuxError):
+        engine.call('subscribe')
+
+
+def test_decode_lazy_events():
+    protocol = BayeuxProtocol()
+    protocol.configure({'LAZY_EVENTS': True})
+
+    connect, event, other = protocol.decode(
+        b'[{"channel": "/meta/connect", "successful": true},'
+        b' {"channel": "/topic/a", "id": "3", "data": '
+        b'{"event": {"replayId": 7}}}, [1]]')
+
+    assert connect == {'channel': '/meta/connect', 'successful': True}
+    envelope = event['data']
+    assert isinstance(envelope, EventEnvelope)
+    assert (envelope.channel, envelope.id) == ('/topic/a', '3')
+    assert protocol.get_event_key(event) == 7
+    assert envelope.decoded is False
+    assert envelope.data == {'event': {'replayId': 7}}
+    assert other == [1]
+
+
+def test_runtime_subscription_changes(make_engine):
+    server = FakeServer(
+        [connected()], [connected(), event('/topic/b', 'b')], [connected()])
+    engine = make_engine(server)
+    client = engine.client
+    delivered = []
+    client.register_event_handler('/topic/a', delivered.append)
+
+    engine.call('handshake')
+    engine.call('subscribe')
+    client.add_subscription('/topic/b', delivered.append)
+    client.add_subscription('/topic/b')  # subscribed already
+    assert client.get_subscription_state('/topic/b') == (
+        SubscriptionState.pending)
+    engine.call('connect')
+    assert client.get_subscription_state('/topic/b') == (
+        SubscriptionState.subscribed)
+    client.remove_subscription('/topic/a')
+    client.remove_subscription('/topic/c')  # not subscribed
+    assert client.get_subscription_state('/topic/a') == (
+        SubscriptionState.unsubscribing)
+    engine.call('connect')
+    engine.call('connect')
+
+    assert [messages for messages in server.get_channels()[1:]] == [
+        ['/meta/subscribe'],
+        ['/meta/subscribe', '/meta/connect'],
+        ['/meta/unsubscribe', '/meta/connect'],
+        ['/meta/connect'],
+    ]
+    assert server.requests[2][0]['subscription'] == '/topic/b'
+    assert server.requests[3][0]['subscription'] == '/topic/a'
+    assert client.get_subscription_state('/topic/a') is None
+    assert delivered == ['b']
+
+
+def test_dynamic_wildcard_handler(make_engine):
+    server = FakeServer([connected(), event('/topic/b', 'b')])
+    engine = make_engine(server)
+    delivered = []
+    engine.client.register_event_handler(
+        '/topic/*', lambda data, channel: delivered.append((channel, data)),
+        subscribe=False)
+
+    engine.call('handshake')
+    engine.call('subscribe')
+    engine.client.add_subscription('/topic/b')
+    engine.call('connect')
+
+    assert server.requests[1] == []
+    assert delivered == [('/topic/b', 'b')]
+
+
+def test_failed_runtime_subscription_changes(make_engine, caplog):
+    server = FakeServer([connected()], [connected()])
+    server.rejected_subscriptions = {'/topic/a', '/topic/b'}
+    engine = make_engine(server)
+    client = engine.client
+    client.register_event_handler('/topic/a', print)
+    client.register_event_handler('/topic/b', print, subscribe=False)
+
+    engine.call('handshake')
+    with pytest.raises(BayeuxError):
+        engine.call('subscribe')  # subscriptions at startup must succeed
+    client.add_subscription('/topic/b')
+    engine.call('connect')
+    client.remove_subscription('/topic/a')
+    engine.call('connect')
+
+    for channel_name in ('/topic/a', '/topic/b'):
+        assert client.get_subscription_state(channel_name) == (
+            SubscriptionState.failed)
+        assert client.get_subscription_error(channel_name) == (
+            '403::Forbidden')
+    assert not client._subscriptions
+    assert 'Failed to subscribe to channel /topic/b' in caplog.text
+    assert 'Failed to unsubscribe from channel /topic/a' in caplog.text
+
+
+def test_retried_runtime_subscription_clears_error(make_engine):
+    server = FakeServer([connected()], [connected()])
+    server.rejected_subscriptions = {'/topic/a'}
+    engine = make_engine(server)
+    client = engine.client
+
+    engine.call('handshake')
+    client.add_subscription('/topic/a', print)
+    engine.call('connect')
+    server.rejected_subscriptions = set()
+    client.add_subscription('/topic/a')
+    engine.call('connect')
+
+    assert client.get_subscription_state('/topic/a') == (
+        SubscriptionState.subscribed)
+    assert client.get_subscription_error('/topic/a') is None
+
+
+def test_runtime_subscription_changes_cancel_out(make_engine):
+    server = FakeServer([connected()])
+    engine = make_engine(server)
+    client = engine.client
+    client.register_event_handler('/topic/a', print)
+
+    engine.call('handshake')
+    engine.call('subscribe')
+    client.add_subscription('/topic/b')
+    client.remove_subscription('/topic/b')
+    client.remove_subscription('/topic/a')
+    client.add_subscription('/topic/a')
+    engine.call('connect')
+
+    assert server.get_channels()[-1] == ['/meta/connect']
+    assert client.get_subscription_state('/topic/a') == (
+        SubscriptionState.subscribed)
+    assert client.get_subscription_state('/topic/b') is None
+
+
+def test_runtime_subscription_changes_before_handshake(make_engine):
+    server = FakeServer()
+    engine = make_engine(server)
+    client = engine.client
+    client.register_event_handler('/topic/a', print)
+    client.add_subscription('/topic/b', print)
+    client.remove_subscription('/topic/a')
+
+    engine.call('handshake')
+    engine.call('subscribe')
+
+    assert [message['subscription'] for message in server.requests[1]] == [
+        '/topic/b']
+    assert client.get_subscription_state('/topic/a') is None
+    assert client.get_subscription_state('/topic/b') == (
+        SubscriptionState.subscribed)
+
+
+def test_lost_runtime_subscription_changes_are_resent(make_engine):
+    server = FakeServer()
+    engine = make_engine(server)
+    client = engine.client
+
+    engine.call('handshake')
+    client.add_subscription('/topic/a', print)
+    with pytest.raises(ServerGone):
+        engine.call('connect')
+    server.connect_responses.append([connected()])
+    engine.call('connect')
+
+    assert server.get_channels()[1:] == [
+        ['/meta/subscribe', '/meta/connect'],
+        ['/meta/subscribe', '/meta/connect'],
+    ]
+    assert client.get_subscription_state('/topic/a') == (
+        SubscriptionState.subscribed)
+
+
+def test_runtime_subscription_changed_while_sent(make_engine):
+
+    class Server(FakeServer):
+        def send_and_receive(self, messages):
+            # the subscription is removed while the request is pending
+            if not self.requests:
+                client.remove_subscription('/topic/a')
+            return super().send_and_receive(messages)
+
+    server = Server([connected()])
+    engine = make_engine(server)
+    client = engine.client
+    client.add_subscription('/topic/a', print)
+
+    engine.call('connect')
+
+    assert client.get_subscription_state('/topic/a') == (
+        SubscriptionState.unsubscribing)
+    assert client.compose_subscription_changes()[0]['channel'] == (
+        '/meta/unsubscribe')
+
+
+class FailingServer(FakeServer):
+    """ Fails all requests after the handshake """
+
+    def send_and_receive(self, messages):
+        if self.requests:
+            self.requests.append(messages)
+            raise Reconnect('Boom')
+        return super().send_and_receive(messages)
+
+
+def test_queued_messages_ride_on_connect(make_engine):
+    server = FakeServer([connected()])
+    engine = make_engine(server)
+    client = engine.client
+    delivered = []
+    replies = []
+    client.register_event_handler('/topic/a', delivered.append)
+    client.queue_message({'channel': '/topic/a', 'data': 'a'}, replies.append)
+    client.queue_message({'channel': '/service/echo', 'data': 'b'})
+
+    engine.call('handshake')
+    engine.call('connect')
+
+    assert server.requests[1] == [
+        {'channel': '/topic/a', 'data': 'a', 'id': 1, 'clientId': 'client-1'},
+        {
+            'channel': '/service/echo', 'data': 'b', 'id': 2,
+            'clientId': 'client-1',
+        },
+        {
+            'channel': '/meta/connect', 'id': 4, 'clientId': 'client-1',
+            'connectionType': 'long-polling',
+        },
+    ]
+    assert [reply['id'] for reply in replies] == [1]
+    assert replies[0]['successful'] is True
+    assert delivered == []  # replies are not events
+
+
+def test_publish_replies_without_callback(make_engine):
+    server = FakeServer([connected()])
+    engine = make_engine(server)
+    client = engine.client
+    delivered = []
+    client.register_event_handler('/topic/a', delivered.append)
+    client.queue_message({'channel': '/topic/a', 'data': 'a'})
+
+    engine.call('handshake')
+    engine.call('connect')
+
+    assert delivered == []
+
+
+def test_queued_meta_message_replies(make_engine):
+    server = FakeServer([connected()])
+    engine = make_engine(server)
+    client = engine.client
+    replies = []
+    client.queue_message(
+        {'channel': '/meta/subscribe', 'subscription': '/topic/a'},
+        replies.append)
+
+    engine.call('handshake')
+    engine.call('connect')
+
+    # handled by the subscribe channel as well, as a startup subscription
+    assert [reply['channel'] for reply in replies] == ['/meta/subscribe']
+
+
+def test_queued_messages_of_failed_connect(make_engine):
+    server = FailingServer()
+    engine = make_engine(server)
+    client = engine.client
+    replies = []
+    client.queue_message({'channel': '/topic/a', 'data': 'a'}, replies.append)
+    client.queue_message({'channel': '/topic/b', 'data': 'b'})
+
+    engine.call('handshake')
+    with pytest.raises(Reconnect):
+        engine.call('connect')
+
+    assert replies == [{
+        'channel': '/topic/a',
+        'id': 1,
+        'successful': False,
+        'error': 'Request to Bayeux server failed',
+    }]
+    assert not client._reply_callbacks
+
+
+def test_flush_outbound(make_engine):
+    server = FakeServer()
+    engine = make_engine(server)
+    client = engine.client
+    replies = []
+
+    engine.call('flush_outbound')
+    client.queue_message({'channel': '/topic/a', 'data': 'a'}, replies.append)
+    engine.call('flush_outbound')  # waits for the handshake
+    engine.call('handshake')
+    engine.call('flush_outbound')
+    engine.call('flush_outbound')  # nothing queued
+
+    assert server.get_channels() == [['/meta/handshake'], ['/topic/a']]
+    assert [reply['successful'] for reply in replies] == [True]
+
+
+def test_flush_outbound_failing(make_engine, caplog):
+    server = FailingServer()
+    engine = make_engine(server)
+    client = engine.client
+    replies = []
+    client.queue_message({'channel': '/topic/a', 'data': 'a'}, replies.append)
+
+    engine.call('handshake')
+    engine.call('flush_outbound')
+
+    assert [reply['successful'] for reply in replies] == [False]
+    assert 'Failed to send 1 queued messages' in caplog.text
@@ -0,0 +1,57 @@
+import sys
+
+from mock import patch
+import pytest
+
+from nameko_bayeux_client import serialization
+
+
+MESSAGES = [
+    {'channel': '/meta/connect', 'id': 1, 'clientId': 'abc'},
+    {'channel': '/topic/example', 'data': {'text': 'spam ☃', 'ham': None}},
+]
+
+
+@pytest.mark.parametrize('name', sorted(serialization.CODECS))
+def test_round_trip(name):
+    pytest.importorskip(name)
+    codec = serialization.get_codec(name)
+    assert codec.name == name
+    encoded = codec.dumps(MESSAGES)
+    assert isinstance(encoded, bytes)
+    assert codec.loads(encoded) == MESSAGES
+
+
+@pytest.mark.parametrize('name', sorted(serialization.CODECS))
+def test_decodes_bytes(name):
+    pytest.importorskip(name)
+    codec = serialization.get_codec(name)
+    data = '[{"channel": "/meta/connect", "text": "☃"}]'.encode('utf-8')
+    assert codec.loads(data) == [{'channel': '/meta/connect', 'text': '☃'}]
+
+
+def test_stdlib_codec_encoding():
+    codec = serialization.get_codec('json')
+    assert codec.dumps([{'spam': 'ham'}]) == b'[{"spam": "ham"}]'
+
+
+def test_ujson_does_not_escape_slashes():
+    pytest.importorskip('ujson')
+    codec = serialization.get_codec('ujson')
+    assert codec.dumps(['/meta/connect']) == b'["/meta/connect"]'
+
+
+@pytest.mark.parametrize('name', ['orjson', 'ujson', 'rapidjson'])
+def test_fallback_to_stdlib_if_not_installed(name):
+    with patch.dict(sys.modules, {name: None}):
+        codec = serialization.get_codec(name)
+    assert type(codec) is serialization.JsonCodec
+    assert codec.loads(codec.dumps(MESSAGES)) == MESSAGES
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError) as exc:
+        serialization.get_codec('yaml')
+    assert str(exc.value) == (
+        'Unknown JSON codec yaml, choose one of: '
+        'json, orjson, rapidjson, ujson')
@@ -0,0 +1,73 @@
+import socket
+
+from mock import patch
+import pytest
+import requests
+from urllib3.connection import HTTPConnection
+
+from nameko_bayeux_client.sessions import (
+    configure_session,
+    get_socket_options,
+)
+
+
+@pytest.mark.parametrize('tcp_keepalive', [None, False, {}])
+def test_get_socket_options_keepalive_disabled(tcp_keepalive):
+    assert get_socket_options(tcp_keepalive) is None
+
+
+def test_get_socket_options_keepalive():
+    assert get_socket_options(True) == (
+        HTTPConnection.default_socket_options +
+        [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)])
+
+
+@pytest.mark.skipif(
+    not hasattr(socket, 'TCP_KEEPIDLE'), reason='Linux socket options')
+def test_get_socket_options_keepalive_timing():
+    socket_options = get_socket_options({'IDLE': 60, 'COUNT': 5})
+    assert socket_options[-3:] == [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5),
+    ]
+
+
+def test_get_socket_options_skips_unsupported():
+    with patch('nameko_bayeux_client.sessions.socket') as mocked_socket:
+        del mocked_socket.TCP_KEEPIDLE
+        del mocked_socket.TCP_KEEPALIVE
+        socket_options = get_socket_options({'IDLE': 60})
+    assert len(socket_options) == len(get_socket_options(True))
+
+
+def test_configure_session_defaults():
+    session = configure_session(requests.Session(), {})
+    adapter = session.get_adapter('https://example.com')
+    assert adapter._pool_maxsize == 10
+    assert adapter._pool_block is False
+    assert adapter.max_retries.total == 0
+    assert adapter.socket_options is None
+    assert 'socket_options' not in adapter.poolmanager.connection_pool_kw
+    assert session.headers['Connection'] == 'keep-alive'
+
+
+def test_configure_session():
+    session = configure_session(requests.Session(), {
+        'POOL_SIZE': 2,
+        'POOL_BLOCK': True,
+        'KEEP_ALIVE': False,
+        'TCP_KEEPALIVE': True,
+        'RETRIES': 3,
+        'RETRY_BACKOFF_FACTOR': 0.5,
+    })
+    adapter = session.get_adapter('http://example.com')
+    assert adapter is session.get_adapter('https://example.com')
+    assert adapter._pool_maxsize == 2
+    assert adapter._pool_block is True
+    assert adapter.max_retries.connect == 3
+    assert adapter.max_retries.read == 0
+    assert adapter.max_retries.backoff_factor == 0.5
+    assert adapter.poolmanager.connection_pool_kw['socket_options'] == (
+        get_socket_options(True))
+    assert session.headers['Connection'] == 'close'
@@ -0,0 +1,131 @@
+import json
+
+import pytest
+
+from nameko_bayeux_client.streaming import (
+    ArraySplitter, iter_array_items, split_object)
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+MESSAGES = [
+    {'channel': '/meta/connect', 'successful': True, 'id': '1'},
+    {'channel': '/topic/a', 'data': {'text': 'spam, [ham] and {eggs}'}},
+    {'channel': '/topic/b', 'data': {'text': 'quoted \\" and \\\\ ☃'}},
+    {'channel': '/topic/c', 'data': [[1, 2], {'nested': [{}, []]}]},
+    'scalar, string',
+    42,
+    None,
+]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 100000])
+def test_iter_array_items(chunk_size):
+    data = json.dumps(MESSAGES).encode('utf-8')
+    items = list(iter_array_items(chunked(data, chunk_size)))
+    assert [json.loads(item.decode('utf-8')) for item in items] == MESSAGES
+
+
+@pytest.mark.parametrize('data', [b'[]', b'  [ ]  ', b'[\n]\n'])
+def test_iter_empty_array(data):
+    assert list(iter_array_items(chunked(data, 1))) == []
+
+
+def test_items_are_returned_as_soon_as_complete():
+    splitter = ArraySplitter()
+    assert splitter.feed(b'[{"a": 1}, {"b"') == [b'{"a": 1}']
+    assert splitter.feed(b': 2}') == []
+    assert splitter.feed(b', 3') == [b'{"b": 2}']
+    assert splitter.feed(b']') == [b'3']
+    splitter.close()
+
+
+def test_buffer_holds_incomplete_item_only():
+    splitter = ArraySplitter()
+    splitter.feed(b'[{"a": 1}, {"b": 2}, {"c"')
+    assert bytes(splitter.buffer) == b' {"c"'
+
+
+def test_escaped_quote_split_between_chunks():
+    splitter = ArraySplitter()
+    assert splitter.feed(b'["\\') == []
+    assert splitter.feed(b'"", "b"]') == [b'"\\""', b'"b"']
+    splitter.close()
+
+
+def test_whitespace_after_end_of_array():
+    splitter = ArraySplitter()
+    assert splitter.feed(b'[1]') == [b'1']
+    assert splitter.feed(b' \n') == []
+    splitter.close()
+
+
+@pytest.mark.parametrize('chunks', [
+    [b'{"a": 1}'],
+    [b'"spam"'],
+    [b']'],
+])
+def test_not_an_array(chunks):
+    with pytest.raises(ValueError) as exc:
+        list(iter_array_items(chunks))
+    assert str(exc.value) == 'Expected a JSON array'
+
+
+@pytest.mark.parametrize('chunks', [
+    [b'[1] 2'],
+    [b'[1]', b'2'],
+])
+def test_data_after_end_of_array(chunks):
+    with pytest.raises(ValueError) as exc:
+        list(iter_array_items(chunks))
+    assert str(exc.value) == 'Unexpected data after the end of array'
+
+
+@pytest.mark.parametrize('chunks', [[], [b'[1, 2'], [b'["]']])
+def test_incomplete_array(chunks):
+    with pytest.raises(ValueError) as exc:
+        list(iter_array_items(chunks))
+    assert str(exc.value) == 'Incomplete JSON array'
+
+
+def test_members():
+    splitter = ArraySplitter(members=True)
+    assert splitter.feed(
+        b'[{"channel": "/a", "data": {"b": [1, {"c": ",}"}]}, "id" :"1"},'
+        b' 3, [1, 2], {}, {"d\\"e": 1}]') == [
+        (
+            b'{"channel": "/a", "data": {"b": [1, {"c": ",}"}]}, "id" :"1"}',
+            [
+                ('channel', b'"/a"'),
+                ('data', b'{"b": [1, {"c": ",}"}]}'),
+                ('id', b'"1"'),
+            ],
+        ),
+        (b'3', None),
+        (b'[1, 2]', None),
+        (b'{}', []),
+        (b'{"d\\"e": 1}', [('d"e', b'1')]),
+    ]
+    splitter.close()
+
+
+def test_members_of_empty_array():
+    splitter = ArraySplitter(members=True)
+    assert splitter.feed(b'[ ]') == []
+    splitter.close()
+
+
+def test_members_split_between_chunks():
+    chunks = [b'[{"a', b'": {"b": 1', b'}, "c\\', b'\\": 2}', b', ', b'{}]']
+    assert list(iter_array_items(chunks, members=True)) == [
+        (b'{"a": {"b": 1}, "c\\\\": 2}', [('a', b'{"b": 1}'), ('c\\', b'2')]),
+        (b'{}', []),
+    ]
+
+
+def test_split_object():
+    assert split_object(b'{"a": {"b": 1}, "c": [2]}') == {
+        'a': b'{"b": 1}', 'c': b'[2]'}
+    assert split_object(b'[1]') is None
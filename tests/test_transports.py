@@ -0,0 +1,98 @@
+import json
+
+from mock import call, Mock, patch
+import pytest
+import websocket
+
+from nameko_bayeux_client.exceptions import Reconnect
+from nameko_bayeux_client.serialization import JsonCodec
+from nameko_bayeux_client.transports import WebSocketTransport
+
+
+class TestWebSocketTransport:
+
+    @pytest.fixture
+    def create_connection(self):
+        with patch.object(websocket, 'create_connection') as create_connection:
+            yield create_connection
+
+    @pytest.fixture
+    def connection(self, create_connection):
+        return create_connection.return_value
+
+    @pytest.fixture
+    def transport(self, create_connection):
+        transport = WebSocketTransport('ws://localhost/cometd', JsonCodec())
+        transport.open({'Authorization': 'Bearer *****'}, 10)
+        return transport
+
+    def frame(self, messages):
+        return websocket.ABNF.OPCODE_TEXT, json.dumps(messages).encode()
+
+    def test_is_available(self):
+        assert WebSocketTransport.is_available() is True
+
+    def test_open(self, create_connection, transport):
+        assert create_connection.call_args == call(
+            'ws://localhost/cometd', timeout=10,
+            header={'Authorization': 'Bearer *****'})
+        assert transport.connection == create_connection.return_value
+
+    @pytest.mark.parametrize('exception', [
+        websocket.WebSocketBadStatusException('Nope', 404),
+        ConnectionRefusedError(),
+    ])
+    def test_open_failing(self, create_connection, exception):
+        create_connection.side_effect = exception
+        transport = WebSocketTransport('ws://localhost/cometd', JsonCodec())
+        with pytest.raises(Reconnect):
+            transport.open({}, 10)
+        assert transport.connection is None
+
+    def test_close(self, connection, transport):
+        transport.close()
+        assert connection.close.call_count == 1
+        assert transport.connection is None
+        transport.close()
+        assert connection.close.call_count == 1
+
+    def test_send_and_receive(self, connection, transport):
+
+        messages_out = [
+            {'id': 3, 'channel': '/meta/subscribe'},
+            {'id': 4, 'channel': '/meta/connect'},
+        ]
+        connection.recv_data.side_effect = [
+            self.frame([
+                {'id': '3', 'channel': '/meta/subscribe'},
+                {'id': '4', 'channel': '/topic/example', 'data': 'one'},
+            ]),
+            self.frame([
+                {'channel': '/topic/example', 'data': 'two'},
+                {'id': '4', 'channel': '/meta/connect'},
+            ]),
+        ]
+
+        messages_in = transport.send_and_receive(messages_out)
+
+        assert messages_in == [
+            {'id': '3', 'channel': '/meta/subscribe'},
+            {'id': '4', 'channel': '/topic/example', 'data': 'one'},
+            {'channel': '/topic/example', 'data': 'two'},
+            {'id': '4', 'channel': '/meta/connect'},
+        ]
+        assert connection.send.call_args == call(
+            json.dumps(messages_out).encode())
+
+    @pytest.mark.parametrize('recv_data', [
+        Mock(side_effect=websocket.WebSocketConnectionClosedException()),
+        Mock(side_effect=ConnectionResetError()),
+        Mock(return_value=(websocket.ABNF.OPCODE_CLOSE, b'')),
+    ])
+    def test_send_and_receive_failing(self, connection, transport, recv_data):
+        connection.recv_data = recv_data
+        with pytest.raises(Reconnect) as exc:
+            transport.send_and_receive([{'id': 1, 'channel': '/meta/connect'}])
+        assert str(exc.value) == 'Failed to exchange messages over WebSocket'
+        assert connection.close.call_count == 1
+        assert transport.connection is None
@@ -0,0 +1,61 @@
+import pytest
+
+from nameko_bayeux_client.trie import ChannelTrie, is_wildcard
+
+
+@pytest.mark.parametrize(('channel_name', 'expected'), (
+    ('/foo', False),
+    ('/foo/bar', False),
+    ('/foo/*', True),
+    ('/foo/**', True),
+    ('/*', True),
+    ('/**', True),
+    ('/foo/*bar', False),
+))
+def test_is_wildcard(channel_name, expected):
+    assert is_wildcard(channel_name) is expected
+
+
+class TestChannelTrie:
+
+    @pytest.fixture
+    def trie(self):
+        trie = ChannelTrie()
+        for pattern in (
+            '/**', '/*', '/foo/*', '/foo/**', '/foo/bar/*', '/foo/bar',
+            '/baz/**',
+        ):
+            trie.add(pattern, pattern)
+        return trie
+
+    def test_len(self, trie):
+        assert len(trie) == 7
+        assert not ChannelTrie()
+
+    @pytest.mark.parametrize(('channel_name', 'expected'), (
+        ('/foo', ['/**', '/*']),
+        ('/foo/bar', ['/**', '/foo/**', '/foo/*', '/foo/bar']),
+        ('/foo/baz', ['/**', '/foo/**', '/foo/*']),
+        ('/foo/bar/baz', ['/**', '/foo/**', '/foo/bar/*']),
+        ('/foo/bar/baz/qux', ['/**', '/foo/**']),
+        ('/baz', ['/**', '/*']),
+        ('/baz/qux/quux', ['/**', '/baz/**']),
+        ('/qux/quux', ['/**']),
+    ))
+    def test_match(self, trie, channel_name, expected):
+        assert trie.match(channel_name) == expected
+
+    def test_multiple_values(self):
+        trie = ChannelTrie()
+        trie.add('/foo/*', 'one')
+        trie.add('/foo/*', 'two')
+        assert trie.match('/foo/bar') == ['one', 'two']
+        assert trie.match('/foo') == []
+
+    @pytest.mark.parametrize('pattern', ['/*/foo', '/foo/**/bar'])
+    def test_wildcard_not_last(self, pattern):
+        with pytest.raises(ValueError) as exc:
+            ChannelTrie().add(pattern, 'spam')
+        assert str(exc.value) == (
+            'Wildcard is allowed as the last segment only: {}'
+            .format(pattern))